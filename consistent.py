@@ -1,16 +1,73 @@
 import ipaddress
 import enum
 
+import array
 import copy
 import logging
+import logging.handlers
+import queue
 import random
+import sys
 
-import sched
+import heapq
+import itertools
+import math
 import threading
+import time
+
+import consistent_checkpoint as ck
+from consistent_alloc import BestFitAllocator, BuddyAllocator
+from consistent_pmap import PMap, TransientMap
 
 
 _TRACE_LEVEL = 1
 
+_TRACE_FORMAT = '%(asctime)-15s %(levelname)-8s [%(filename)s:%(lineno)d - %(funcName)20s()] %(message)s'
+
+# trace points are written as "if _tracing: log.log(...)" so a disabled
+# trace costs one global lookup and never formats its arguments
+_tracing = False
+_trace_listener = None
+_trace_handler = None
+
+
+def enable_tracing(filename = "log.txt", level = _TRACE_LEVEL, handler: logging.Handler = None):
+    global _tracing, _trace_listener, _trace_handler
+
+    disable_tracing()
+
+    if handler is None:
+        handler = logging.FileHandler(filename, mode = "w")
+        handler.setFormatter(logging.Formatter(_TRACE_FORMAT))
+
+    # records are handed to a background thread which does the file I/O
+    q = queue.SimpleQueue()
+    _trace_handler = logging.handlers.QueueHandler(q)
+    _trace_listener = logging.handlers.QueueListener(q, handler)
+
+    log = logging.getLogger("c_hash")
+    log.addHandler(_trace_handler)
+    log.setLevel(level)
+    _trace_listener.start()
+
+    _tracing = True
+
+
+def disable_tracing():
+    global _tracing, _trace_listener, _trace_handler
+
+    _tracing = False
+
+    if _trace_listener:
+        logging.getLogger("c_hash").removeHandler(_trace_handler)
+        _trace_listener.stop()
+        for h in _trace_listener.handlers:
+            h.close()
+
+    _trace_listener = None
+    _trace_handler = None
+
+
 class pSet:
     def __init__(self, s):
         self._s = copy.copy(s)
@@ -65,37 +122,200 @@ class Nexthop :
         return hash(self._ipaddr)
 
 
+class NexthopRegistry:
+    # interns next hops to small integer ids, never reused
+
+    def __init__(self):
+        self._ids = {}
+        self._nhs = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nhs)
+
+    def intern(self, nh):
+        nh_id = self._ids.get(nh)
+        if nh_id is not None:
+            return nh_id
+
+        addr = nh.ipaddress if isinstance(nh, Nexthop) else ipaddress.ip_address(nh)
+
+        with self._lock:
+            nh_id = self._ids.get(addr)
+            if nh_id is None:
+                nh_id = len(self._nhs)
+                self._nhs.append(Nexthop(addr))
+                self._ids[addr] = nh_id
+            if not isinstance(nh, Nexthop):
+                self._ids[nh] = nh_id
+
+        return nh_id
+
+    def find(self, nh):
+        if isinstance(nh, Nexthop):
+            nh = nh.ipaddress
+        return self._ids.get(nh)
+
+    def nexthop(self, nh_id):
+        return self._nhs[nh_id]
+
+    def address(self, nh_id):
+        return self._nhs[nh_id].ipaddress
+
+
+_nh_registry = NexthopRegistry()
+
+
+class NexthopSet:
+    # immutable next hop set, bit i set when registry id i is a member
+
+    __slots__ = ("_bits",)
+
+    def __init__(self, bits = 0):
+        self._bits = bits
+
+    @staticmethod
+    def of(nhs):
+        if isinstance(nhs, NexthopSet):
+            return nhs
+        if isinstance(nhs, pSet):
+            return NexthopSet.of(nhs.s)
+
+        bits = 0
+        for nh in nhs:
+            bits |= 1 << _nh_registry.intern(nh)
+        return NexthopSet(bits)
+
+    @property
+    def bits(self):
+        return self._bits
+
+    def ids(self):
+        b = self._bits
+        while b:
+            low = b & -b
+            yield low.bit_length() - 1
+            b ^= low
+
+    def __iter__(self):
+        for i in self.ids():
+            yield _nh_registry.address(i)
+
+    def __len__(self):
+        return self._bits.bit_count()
+
+    def __bool__(self):
+        return self._bits != 0
+
+    def __contains__(self, nh):
+        nh_id = _nh_registry.find(nh)
+        if nh_id is None and not isinstance(nh, Nexthop):
+            nh_id = _nh_registry.find(ipaddress.ip_address(nh))
+        return nh_id is not None and (self._bits >> nh_id) & 1 == 1
+
+    def __eq__(self, other):
+        if isinstance(other, NexthopSet):
+            return self._bits == other._bits
+        if isinstance(other, (set, frozenset)):
+            return self._bits == NexthopSet.of(other)._bits
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def issubset(self, other):
+        return self._bits & ~other._bits == 0
+
+    def issuperset(self, other):
+        return other._bits & ~self._bits == 0
+
+    def distance(self, other):
+        return (self._bits ^ other._bits).bit_count()
+
+    def __or__(self, other):
+        return NexthopSet(self._bits | other._bits)
+
+    def __and__(self, other):
+        return NexthopSet(self._bits & other._bits)
+
+    def __sub__(self, other):
+        return NexthopSet(self._bits & ~other._bits)
+
+    def __xor__(self, other):
+        return NexthopSet(self._bits ^ other._bits)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # ids are per process, ship the addresses
+        return (NexthopSet.of, (tuple(self),))
+
+    def __str__(self):
+        return "{" + ", ".join(str(s) for s in self) + "}"
+
+    def __repr__(self):
+        return "NexthopSet(" + str(self) + ")"
+
+
 class Prefix:
     def __init__(self):
-        self._prefix = ipaddress.ip_address(0)
+        self.set_prefix(0)
 
     def set_prefix(self, prefix):
         self._prefix = ipaddress.ip_network(prefix, strict = False)
+        self._key = Prefix.make_key(self._prefix)
+
+    @staticmethod
+    def make_key(net):
+        # (network << 8 | prefixlen) << 1 | is_v6 - canonical and cheap to hash
+        return (((int(net.network_address) << 8) | net.prefixlen) << 1) | (net.version == 6)
+
+    @staticmethod
+    def from_key(k):
+        # the ipaddress network object is only built when it is needed
+        p = Prefix.__new__(Prefix)
+        p._prefix = None
+        p._key = k
+        return p
+
+    def _network(self):
+        if self._prefix is None:
+            k = self._key
+            net = (k >> 9, (k >> 1) & 0xFF)
+            self._prefix = ipaddress.IPv6Network(net) if k & 1 else ipaddress.IPv4Network(net)
+        return self._prefix
 
     def __str__(self):
-        return str(self._prefix)
+        return str(self._network())
 
     def __eq__(self, other):
-        return self._prefix == other._prefix
+        return self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
 
 
     @property
     def network(self):
-        return self._prefix.network_address
+        return self._network().network_address
 
     @property
     def mask(self):
-        return self._prefix.netmask
+        return self._network().netmask
 
     @property
     def hashable(self):
-        return self._prefix.with_prefixlen
+        return self._key
 
 class Route:
     def __init__(self, prefix, nhset):
         
         self._prefix = copy.copy(prefix)
-        self._nhset = copy.copy(nhset)
+        self._nhset = NexthopSet.of(nhset)
         self._dc = None
 
     @property
@@ -116,11 +336,11 @@ class Route:
 
     @nh_set.setter
     def nh_set(self, nh_set):
-        self._nhset = copy.copy(nh_set)
+        self._nhset = NexthopSet.of(nh_set)
     
     @nh_set.deleter
     def nh_set(self):
-        self._nhset = set()
+        self._nhset = NexthopSet()
     
     @property
     def desired_container(self):
@@ -128,60 +348,623 @@ class Route:
 
     @desired_container.setter
     def desired_container(self, dc):
+        if self._dc is not None:
+            self._dc.detach(self)
         self._dc = dc
+        if dc is not None:
+            dc.attach(self)
 
     @desired_container.deleter
     def desired_container(self):
-        self._dc = None
+        self.desired_container = None
+
+    @property
+    def key(self):
+        return self._prefix.hashable
 
     def __str__(self):
-        return str(self._prefix) + "\t-->\t{" + ", ".join(str(s) for s in self._nhset) + "}"  + "(0x{:02X})".format(id(self._dc))
+        return str(self.prefix) + "\t-->\t{" + ", ".join(str(s) for s in self.nh_set) + "}"  + "(0x{:02X})".format(id(self.desired_container))
+
+class _TrieNode:
+    __slots__ = ("net", "plen", "key", "kids")
+
+    def __init__(self, net, plen, key = None):
+        self.net = net
+        self.plen = plen
+        self.key = key
+        self.kids = [None, None]
+
+
+class PrefixTrie:
+    # path compressed binary trie of prefix keys (see Prefix.make_key)
+
+    def __init__(self, width):
+        self._width = width
+        self._root = _TrieNode(0, 0)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @staticmethod
+    def split_key(key):
+        return key >> 9, (key >> 1) & 0xFF
+
+    def _bit(self, net, pos):
+        return (net >> (self._width - pos - 1)) & 1
+
+    def _common(self, net1, plen1, net2, plen2):
+        return min(plen1, plen2, self._width - (net1 ^ net2).bit_length())
+
+    def _mask(self, net, plen):
+        return (net >> (self._width - plen)) << (self._width - plen) if plen else 0
+
+    def insert(self, key):
+        net, plen = self.split_key(key)
+        node = self._root
+
+        while True:
+            if node.plen == plen:
+                if node.key is None:
+                    self._len += 1
+                node.key = key
+                return
+
+            bit = self._bit(net, node.plen)
+            child = node.kids[bit]
+
+            if child is None:
+                node.kids[bit] = _TrieNode(net, plen, key)
+                self._len += 1
+                return
+
+            cpl = self._common(child.net, child.plen, net, plen)
+
+            if cpl == child.plen:
+                node = child
+                continue
+
+            if cpl == plen:
+                new = _TrieNode(net, plen, key)
+                new.kids[self._bit(child.net, plen)] = child
+                node.kids[bit] = new
+            else:
+                mid = _TrieNode(self._mask(net, cpl), cpl)
+                mid.kids[self._bit(child.net, cpl)] = child
+                mid.kids[self._bit(net, cpl)] = _TrieNode(net, plen, key)
+                node.kids[bit] = mid
+
+            self._len += 1
+            return
+
+    def remove(self, key):
+        net, plen = self.split_key(key)
+        node = self._root
+        path = []
+
+        while node is not None and node.plen < plen:
+            path.append(node)
+            node = node.kids[self._bit(net, node.plen)]
+
+        if node is None or node.key != key:
+            return False
+
+        node.key = None
+        self._len -= 1
+
+        # splice out nodes that no longer carry a key or a branch
+        while path and node.key is None:
+            parent = path.pop()
+            kids = [k for k in node.kids if k is not None]
+            slot = parent.kids.index(node)
+            if len(kids) == 0:
+                parent.kids[slot] = None
+            elif len(kids) == 1:
+                parent.kids[slot] = kids[0]
+            else:
+                break
+            node = parent
+
+        return True
+
+    def lookup(self, addr):
+        node = self._root
+        best = None
+
+        while node is not None:
+            if self._mask(addr, node.plen) != node.net:
+                break
+            if node.key is not None:
+                best = node.key
+            if node.plen == self._width:
+                break
+            node = node.kids[self._bit(addr, node.plen)]
+
+        return best
+
+    def covered(self, key):
+        net, plen = self.split_key(key)
+        node = self._root
+
+        while node is not None and node.plen < plen:
+            if self._mask(net, node.plen) != node.net:
+                return
+            node = node.kids[self._bit(net, node.plen)]
+
+        if node is None or self._mask(node.net, plen) != net:
+            return
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.key is not None:
+                yield node.key
+            stack.extend(k for k in node.kids if k is not None)
+
 
 class RouteContainer:
     def __init__(self, log: logging.Logger):
         self._d = {}
+        # restored rows while the prefix index _d is None, see load_columns
+        self._columns = None
+        self._trie = None
         self._log = log.getChild("r_cont")
-    
+
+    def _tries(self):
+        # built on the first prefix-range query, maintained from then on
+        if self._trie is None:
+            self._trie = {False: PrefixTrie(32), True: PrefixTrie(128)}
+            for k in self._keys():
+                self._trie[k & 1 == 1].insert(k)
+        return self._trie
+
+    def _trie_insert(self, k):
+        if self._trie is not None:
+            self._trie[k & 1 == 1].insert(k)
+
+    def _trie_remove(self, k):
+        if self._trie is not None:
+            self._trie[k & 1 == 1].remove(k)
+
+    def _keys(self):
+        return self._ensure_index().keys()
+
+    def _ensure_index(self):
+        # a restored table builds its prefix index on first use
+        if self._d is None:
+            self._index_columns()
+        return self._d
+
+    def load_columns(self, hi, lo, meta, slots, dcs, uses):
+        # restored rows: packed network, prefix length/family and the index
+        # of the desired container in dcs (-1 for none)
+        self._d = None
+        self._trie = None
+        self._columns = (hi, lo, meta, slots, dcs)
+
+    def _index_columns(self):
+        hi, lo, meta, slots, dcs = self._columns
+        self._columns = None
+        empty = NexthopSet()
+        d = {}
+        for h, l, m, slot in zip(hi, lo, meta, slots):
+            k = (((h << 64) | l) << 9) | m
+            r = Route.__new__(Route)
+            r._prefix = Prefix.from_key(k)
+            r._dc = dcs[slot] if slot >= 0 else None
+            r._nhset = r._dc.nh_set if slot >= 0 else empty
+            d[k] = r
+        self._d = d
+
+    def dc_items(self):
+        # (route key, desired container) of every route with one, straight
+        # from the restored rows while they are not indexed yet
+        if self._d is None:
+            hi, lo, meta, slots, dcs = self._columns
+            for h, l, m, slot in zip(hi, lo, meta, slots):
+                if slot >= 0:
+                    yield (((h << 64) | l) << 9) | m, dcs[slot]
+            return
+        for k, r in self._ensure_index().items():
+            if r._dc is not None:
+                yield k, r._dc
+
     def add(self, r: Route):
-        self._d[r.prefix.hashable] = r
+        k = r.prefix.hashable
+        self._ensure_index()[k] = r
+        self._trie_insert(k)
+        return r
 
     def remove(self, r: Route):
-        self._d.pop(r.prefix.hashable)
+        self.pop(r.prefix)
     
     def __iter__(self):
-        for s in self._d.keys():
-            yield self._d[s]
+        d = self._ensure_index()
+        for s in d.keys():
+            yield d[s]
 
     def __str__(self):
-        return "\n".join(str(self._d[s]) for s in self._d.keys())
+        d = self._ensure_index()
+        return "\n".join(str(d[s]) for s in d.keys())
 
     def prefixes(self):
         s: Route
-        for s in self._d.keys():
-            yield self._d[s].prefix
+        d = self._ensure_index()
+        for s in d.keys():
+            yield d[s].prefix
+
+    def __len__(self):
+        return len(self._ensure_index())
+
+    def __contains__(self, r: Prefix):
+        return r.hashable in self._ensure_index()
+
+    def contains(self, r: Prefix):
+        return r.hashable in self._ensure_index()
+
+    def get(self, r: Prefix):
+        return self._ensure_index().get(r.hashable)
+
+    def pop(self, r: Prefix):
+        k = r.hashable
+        route = self._ensure_index().pop(k, None)
+        if route:
+            self._trie_remove(k)
+        return route
+
+    def by_key(self, k):
+        return self._ensure_index().get(k)
+
+    def lookup(self, addr):
+        addr = ipaddress.ip_address(addr)
+        k = self._tries()[addr.version == 6].lookup(int(addr))
+        return None if k is None else self.by_key(k)
+
+    def covered_by(self, supernet):
+        k = Prefix.make_key(ipaddress.ip_network(supernet, strict = False))
+        for s in list(self._tries()[k & 1 == 1].covered(k)):
+            yield self.by_key(s)
 
     def __getitem__(self, r:Prefix):
-        if r in self.prefixes():
-            return self._d[r.hashable]
-        else:
-            return None
+        return self.get(r)
 
     def __setitem__(self, idx: Prefix, r: Route):
-        self._d[idx.hashable] = r
+        self._ensure_index()[idx.hashable] = r
+        self._trie_insert(idx.hashable)
 
     def __delitem__(self, r: Prefix):
-        self._d.pop(r.hashable)
+        if self.pop(r) is None:
+            raise KeyError(str(r))
+
+class _CompactRoute(Route):
+    # a Route materialized on demand from a CompactRouteContainer row;
+    # desired_container reads and writes the row directly
+
+    def __init__(self, store, row, nhset = None):
+        self._store = store
+        self._row = row
+        self._prefix = None
+        self._nhset = None if nhset is None else NexthopSet.of(nhset)
+
+    @property
+    def prefix(self):
+        if self._prefix is None:
+            self._prefix = self._store._row_prefix(self._row)
+        return self._prefix
+
+    @property
+    def nh_set(self):
+        if self._nhset is None:
+            dc = self.desired_container
+            return dc.nh_set if dc else NexthopSet()
+        return self._nhset
+
+    @nh_set.setter
+    def nh_set(self, nh_set):
+        self._nhset = NexthopSet.of(nh_set)
+
+    @property
+    def desired_container(self):
+        return self._store._row_dc(self._row)
+
+    @desired_container.setter
+    def desired_container(self, dc):
+        old = self.desired_container
+        if old is not None:
+            old.detach(self)
+        self._store._set_row_dc(self._row, dc)
+        if dc is not None:
+            dc.attach(self)
+
+    @property
+    def key(self):
+        return self._store._row_key(self._row)
+
+    def __eq__(self, other):
+        return isinstance(other, _CompactRoute) and self._store is other._store and self._row == other._row
+
+    def __hash__(self):
+        return hash(self._row)
+
+
+class CompactRouteContainer(RouteContainer):
+    # column store: one row per route holding the packed network, the
+    # prefix length/family and the slot of its desired container. The
+    # next-hop set of a route is the one of its desired container.
+
+    def __init__(self, log: logging.Logger):
+        super().__init__(log)
+        self._net_hi = array.array("Q")
+        self._net_lo = array.array("Q")
+        self._meta = array.array("H")
+        self._dc = array.array("l")
+        self._free_rows = []
+
+        self._dcs = []
+        self._dc_slot = {}
+        self._dc_uses = array.array("L")
+        self._free_slots = []
+
+        # rows of every slot and the position of each row in them, the
+        # routes of a desired container without a set of keys
+        self._slot_rows = []
+        self._row_pos = array.array("I")
+
+    def _row_key(self, row):
+        return (((self._net_hi[row] << 64) | self._net_lo[row]) << 9) | self._meta[row]
+
+    def _row_prefix(self, row):
+        return Prefix.from_key(self._row_key(row))
+
+    def _row_dc(self, row):
+        slot = self._dc[row]
+        return None if slot < 0 else self._dcs[slot]
+
+    def _set_row_dc(self, row, dc):
+        old = self._dc[row]
+        if old >= 0:
+            self._release_slot(old, row)
+        self._dc[row] = -1 if dc is None else self._acquire_slot(dc, row)
+
+    def _acquire_slot(self, dc, row):
+        slot = self._dc_slot.get(dc)
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+                self._dcs[slot] = dc
+                self._dc_uses[slot] = 0
+            else:
+                slot = len(self._dcs)
+                self._dcs.append(dc)
+                self._dc_uses.append(0)
+                self._slot_rows.append(array.array("I"))
+            self._dc_slot[dc] = slot
+        rows = self._slot_rows[slot]
+        self._row_pos[row] = len(rows)
+        rows.append(row)
+        self._dc_uses[slot] += 1
+        return slot
+
+    def _release_slot(self, slot, row):
+        # the last row of the slot takes the place of the removed one
+        rows = self._slot_rows[slot]
+        last = rows.pop()
+        if last != row:
+            pos = self._row_pos[row]
+            rows[pos] = last
+            self._row_pos[last] = pos
+        self._dc_uses[slot] -= 1
+        if self._dc_uses[slot] == 0:
+            del self._dc_slot[self._dcs[slot]]
+            self._dcs[slot] = None
+            self._free_slots.append(slot)
+
+    def load_columns(self, hi, lo, meta, slots, dcs, uses):
+        # the restored rows become the columns as they are, desired
+        # container i of dcs gets slot i
+        self._d = None
+        self._trie = None
+        self._net_hi, self._net_lo, self._meta, self._dc = hi, lo, meta, slots
+        self._free_rows = []
+        self._dcs = list(dcs)
+        self._dc_slot = {dc: i for i, dc in enumerate(self._dcs)}
+        self._dc_uses = uses
+        self._free_slots = []
+        self._slot_rows = []
+        self._row_pos = array.array("I")
+
+    def _index_columns(self):
+        self._d = {(((h << 64) | l) << 9) | m: row
+                   for row, (h, l, m) in enumerate(zip(self._net_hi, self._net_lo, self._meta))}
+
+        slot_rows = [array.array("I") for _ in self._dcs]
+        pos = array.array("I", bytes(4 * len(self._dc)))
+        for row, slot in enumerate(self._dc):
+            if slot >= 0:
+                rows = slot_rows[slot]
+                pos[row] = len(rows)
+                rows.append(row)
+        self._slot_rows = slot_rows
+        self._row_pos = pos
+
+    def uses(self, dc):
+        slot = self._dc_slot.get(dc)
+        return 0 if slot is None else self._dc_uses[slot]
+
+    def keys_of(self, dc):
+        slot = self._dc_slot.get(dc)
+        if slot is None:
+            return []
+        self._ensure_index()
+        key = self._row_key
+        return [key(row) for row in self._slot_rows[slot]]
+
+    def dc_items(self):
+        if self._d is None:
+            dcs = self._dcs
+            for h, l, m, slot in zip(self._net_hi, self._net_lo, self._meta, self._dc):
+                if slot >= 0:
+                    yield (((h << 64) | l) << 9) | m, dcs[slot]
+            return
+        for k, row in self._d.items():
+            slot = self._dc[row]
+            if slot >= 0:
+                yield k, self._dcs[slot]
+
+    def add(self, r: Route):
+        k = r.prefix.hashable
+        d = self._ensure_index()
+        row = d.get(k)
+
+        if row is None:
+            net = k >> 9
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self._net_hi[row] = net >> 64
+                self._net_lo[row] = net & 0xFFFFFFFFFFFFFFFF
+                self._meta[row] = k & 0x1FF
+                self._dc[row] = -1
+            else:
+                row = len(self._meta)
+                self._net_hi.append(net >> 64)
+                self._net_lo.append(net & 0xFFFFFFFFFFFFFFFF)
+                self._meta.append(k & 0x1FF)
+                self._dc.append(-1)
+                self._row_pos.append(0)
+            d[k] = row
+            self._trie_insert(k)
+
+        view = _CompactRoute(self, row, r.nh_set)
+        view._prefix = r.prefix
+        if r.desired_container is not None:
+            view.desired_container = r.desired_container
+        return view
+
+    def by_key(self, k):
+        row = self._ensure_index().get(k)
+        return None if row is None else _CompactRoute(self, row)
+
+    def get(self, r: Prefix):
+        return self.by_key(r.hashable)
+
+    def pop(self, r: Prefix):
+        k = r.hashable
+        row = self._ensure_index().pop(k, None)
+        if row is None:
+            return None
+
+        dc = self._row_dc(row)
+        route = Route(r, dc.nh_set if dc else NexthopSet())
+
+        self._set_row_dc(row, None)
+        self._free_rows.append(row)
+        self._trie_remove(k)
+        return route
+
+    def __iter__(self):
+        for row in list(self._ensure_index().values()):
+            yield _CompactRoute(self, row)
+
+    def __str__(self):
+        return "\n".join(str(r) for r in self)
+
+    def prefixes(self):
+        for r in self:
+            yield r.prefix
+
+    def __setitem__(self, idx: Prefix, r: Route):
+        self.add(r)
+
+    @property
+    def nbytes(self):
+        columns = (self._net_hi, self._net_lo, self._meta, self._dc, self._dc_uses, self._row_pos)
+        return sum(a.itemsize * len(a) for a in itertools.chain(columns, self._slot_rows))
+
+
+class _ContainerIds:
+    # container ids are unique in the process, engines of several tables
+    # may share one SDK. Restore moves the counter past restored ids.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 1
+
+    def take(self):
+        with self._lock:
+            n = self._next
+            self._next += 1
+            return n
+
+    def peek(self):
+        with self._lock:
+            return self._next
+
+    def reserve(self, last):
+        with self._lock:
+            self._next = max(self._next, last + 1)
+
+
+_container_ids = _ContainerIds()
+
+# bucket tables hold the member slot of every bucket: a bytearray while
+# there are fewer than 255 slots, 16 or 32 bit arrays beyond. The largest
+# value of the item type marks a bucket without a member.
+_NO_MEMBER = 0xff
+
+_BUCKET_FREE = {"B": _NO_MEMBER, "H": 0xffff, "I": 0xffffffff}
+
+
+def _bucket_code(slots):
+    return "B" if slots < _NO_MEMBER else "H" if slots < 0xffff else "I"
+
+
+def _bucket_table(code, values = ()):
+    return bytearray(values) if code == "B" else array.array(code, values)
+
+
+def _table_code(table):
+    return "B" if type(table) is bytearray else table.typecode
+
+
+def _fit_table(table, slots):
+    # the same buckets in a table wide enough for `slots` member slots
+    code = _bucket_code(slots)
+    old = _table_code(table)
+    if code == old:
+        return table
+    old_free, free = _BUCKET_FREE[old], _BUCKET_FREE[code]
+    return _bucket_table(code, (free if s == old_free else s for s in table))
+
+
+def _positions(table, value):
+    if type(table) is bytearray:
+        out = []
+        i = table.find(value)
+        while i != -1:
+            out.append(i)
+            i = table.find(value, i + 1)
+        return out
+    return [i for i, s in enumerate(table) if s == value]
+
 
 class ActualContainer:
     def __init__(self, log: logging.Logger):
+        self._sid = _container_ids.take()
         self._dc = None
         self._resolved = False
-        self._nh_set = set()
+        self._nh_set = pSet(NexthopSet())
         self._log = log.getChild("a_cont")
         self._consistent = False
+        self._block = None
+        self._users = 0
+
+        # bucket table, each entry is a slot in _members (next hop ids)
+        self._buckets = bytearray()
+        self._members = []
 
     def delete(self):
-        self._log.log(_TRACE_LEVEL, "deleting a_cont %s\n", str(self))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "deleting a_cont %s\n", self)
         pass
 
 
@@ -193,6 +976,14 @@ class ActualContainer:
     def desired_container(self, dc):
         self._dc = dc
 
+    @property
+    def sid(self):
+        return self._sid
+
+    def __hash__(self):
+        # ids follow creation order, so set iteration is the same in every run
+        return self._sid
+
     @property
     def resolved(self):
         return self._resolved
@@ -200,6 +991,8 @@ class ActualContainer:
     @resolved.setter
     def resolved(self, res):
         self._resolved = res
+        if self._dc is not None:
+            self._dc.touch()
 
     @property
     def consistent(self):
@@ -209,13 +1002,131 @@ class ActualContainer:
     def consistent(self, val: bool):
         self._consistent = val
 
+    @property
+    def block(self):
+        # offset of the member block in the SDK table, None without an allocator
+        return self._block
+
+    @block.setter
+    def block(self, offset):
+        self._block = offset
+
+    @property
+    def users(self):
+        # desired containers programmed with this container
+        return self._users
+
+    @users.setter
+    def users(self, n):
+        self._users = n
+
+    @property
+    def buckets(self):
+        # member slot of every bucket, bytes while the table is one byte wide
+        b = self._buckets
+        return bytes(b) if type(b) is bytearray else tuple(b)
+
+    @property
+    def members(self):
+        return tuple(self._members)
+
+    def bucket(self, i):
+        slot = self._buckets[i]
+        return None if slot == _BUCKET_FREE[_table_code(self._buckets)] else self._members[slot]
+
+    def bucket_counts(self):
+        return {m: self._buckets.count(slot) for slot, m in enumerate(self._members) if m is not None}
+
+    def fill(self, nhset, size):
+        ids = sorted(NexthopSet.of(nhset).ids())
+        n = len(ids)
+        self._members = ids
+        if n == 0:
+            self._buckets = bytearray([_NO_MEMBER]) * size
+        elif n < _NO_MEMBER:
+            slots = bytes(range(n))
+            self._buckets = bytearray(slots * (size // n) + slots[:size % n])
+        else:
+            self._buckets = _bucket_table(_bucket_code(n), (i % n for i in range(size)))
+
+    def copy_buckets(self, ac: "ActualContainer"):
+        self._buckets = ac._buckets[:]
+        self._members = list(ac._members)
+
+    def rebalance(self, nhset):
+        # move buckets only off members that left or hold more than their
+        # share, returns the number of buckets rewritten. On one byte tables
+        # scans and remaps run in C (translate/count/find), Python only
+        # touches moved buckets.
+        want = set(NexthopSet.of(nhset).ids())
+        members = self._members
+        buckets = self._buckets
+        code = _table_code(buckets)
+        free = _BUCKET_FREE[code]
+
+        gone = [slot for slot, m in enumerate(members) if m is not None and m not in want]
+        for slot in gone:
+            members[slot] = None
+        if gone and code == "B":
+            table = bytearray(range(256))
+            for slot in gone:
+                table[slot] = free
+            buckets = buckets.translate(table)
+        elif gone:
+            gone = set(gone)
+            buckets = _bucket_table(code, (free if s in gone else s for s in buckets))
+
+        present = {m for m in members if m is not None}
+        holes = [slot for slot, m in enumerate(members) if m is None]
+        holes.reverse()
+        for m in sorted(want - present):
+            if holes:
+                members[holes.pop()] = m
+            else:
+                members.append(m)
+        while members and members[-1] is None:
+            members.pop()
+
+        size = len(buckets)
+
+        if not want:
+            moved = size - self._buckets.count(free)
+            self._buckets = bytearray([_NO_MEMBER]) * size
+            return moved
+
+        buckets = _fit_table(buckets, len(members))
+        free = _BUCKET_FREE[_table_code(buckets)]
+
+        counts = {slot: buckets.count(slot) for slot, m in enumerate(members) if m is not None}
+
+        # the remainder goes to the members already holding the most buckets
+        base, extra = divmod(size, len(counts))
+        order = sorted(counts, key = lambda slot: (-counts[slot], members[slot]))
+        quota = {slot: base + (1 if rank < extra else 0) for rank, slot in enumerate(order)}
+
+        positions = _positions(buckets, free)
+        for slot, c in counts.items():
+            if c > quota[slot]:
+                positions.extend(_positions(buckets, slot)[quota[slot]:])
+
+        positions.sort()
+        it = iter(positions)
+        for slot in order:
+            for _ in range(quota[slot] - counts[slot]):
+                buckets[next(it)] = slot
+
+        self._buckets = buckets
+        return len(positions)
+
     @property
     def nh_set(self):
         return self._nh_set
 
     @nh_set.setter
     def nh_set(self, nhset):
-        self._nh_set = pSet(nhset)
+        self._nh_set = pSet(NexthopSet.of(nhset))
+        if self._dc is not None:
+            self._dc.touch()
 
     def __str__(self):
 
@@ -224,6 +1135,8 @@ class ActualContainer:
         for a,b in vars(self).items():
             if a == "_dc":
                 s += " {} : 0x{:X}".format(a,id(b))
+            elif a == "_buckets":
+                s += " {} : {}".format(a,len(b))
             else:
                 s += " {} : {}".format(a,b)
         return s + "\n"
@@ -237,20 +1150,26 @@ class DesiredContainer:
         PARTIAL = 3
         REALLOCATE = 4
 
-    def __init__(self, log: logging.Logger):
+    def __init__(self, log: logging.Logger, store = None):
+        self._sid = _container_ids.take()
         self._current_state = self.State.FAILED
-        self._nh_set = set()
+        self._nh_set = pSet(NexthopSet())
         self._ac = None
         self._child_set = set()
         self._father = None
-        self._ref_count = 0
+        # a column store keeps the routes itself, see CompactRouteContainer.
+        # Otherwise the route keys, None until loaded for a restored container.
+        self._store = store
+        self._routes = set() if store is None else None
+        self._owner = None
         self._log = log.getChild("d_cont")
 
     def delete(self):
 
         # need to delete all references to father
 
-        self._log.log(_TRACE_LEVEL, "deleting d_cont %s\n", str(self))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "deleting d_cont %s\n", self)
 
         for dc in self._child_set:
             dc.father =  None
@@ -274,7 +1193,8 @@ class DesiredContainer:
         if self._ac:
             self._ac.delete()
         self._ac = None
-        self._ref_count = 0
+        if self._store is None:
+            self._routes = set()
       
    
     @property
@@ -283,11 +1203,14 @@ class DesiredContainer:
 
     @nh_set.setter
     def nh_set(self, nh_set):
-        self._nh_set = pSet(nh_set)
+        old = self._nh_set
+        self._nh_set = pSet(NexthopSet.of(nh_set))
+        if self._owner is not None:
+            self._owner.rekey(self, old.s)
 
     @nh_set.deleter
     def nh_set(self):
-        self._nh_set = pSet(set())
+        self.nh_set = NexthopSet()
 
     @property
     def actual_container(self):
@@ -296,6 +1219,24 @@ class DesiredContainer:
     @actual_container.setter
     def actual_container(self, ac: ActualContainer):
         self._ac = ac
+        self.touch()
+
+    @property
+    def sid(self):
+        return self._sid
+
+    def __hash__(self):
+        return self._sid
+
+    def touch(self):
+        if self._owner is not None and self._owner.tracking:
+            self._owner.touched(self)
+
+    def _ensure_index(self):
+        # restored containers get their route sets on first use
+        if self._routes is None:
+            self._owner.load_routes()
+        return self._routes
 
     @property
     def child_set(self):
@@ -317,9 +1258,29 @@ class DesiredContainer:
     def father(self):
         self._father = None
 
+    def attach(self, route: Route):
+        k = route.key
+        if self._store is None:
+            self._ensure_index().add(k)
+        if self._owner is not None and self._owner.tracking:
+            self._owner.route_touched(k)
+            self._owner.touched(self)
+
+    def detach(self, route: Route):
+        k = route.key
+        if self._store is None:
+            self._ensure_index().discard(k)
+        if self._owner is not None and self._owner.tracking:
+            self._owner.route_touched(k)
+            self._owner.touched(self)
+
+    @property
+    def route_keys(self):
+        return self._ensure_index() if self._store is None else self._store.keys_of(self)
+
     @property
     def ref_count(self):
-        return self._ref_count
+        return len(self._ensure_index()) if self._store is None else self._store.uses(self)
 
     @property
     def current_state(self):
@@ -328,18 +1289,12 @@ class DesiredContainer:
     @current_state.setter
     def current_state(self, newS):
         self._current_state = newS
+        if self._owner is not None:
+            self._owner.state_changed(self)
 
     @current_state.deleter
     def current_state(self):
-        self._current_state =  self.State.FAILED
-
-    @ref_count.setter
-    def ref_count(self, ref_c):
-        self._ref_count = ref_c
-
-    @ref_count.deleter
-    def ref_count(self):
-        self._ref_count = 0
+        self.current_state = self.State.FAILED
 
     def print_me(self, level):
         
@@ -351,6 +1306,10 @@ class DesiredContainer:
                     s += ", _father: None"
                 else:
                     s += ", _father: 0x{:02X}".format(id(self._father))
+            elif a == "_owner" or a == "_store":
+                continue
+            elif a == "_routes":
+                s += ", _ref_count : {}".format(self.ref_count)
             elif a == "_ac":
                 if b == None:
                     s += ", {}: None".format(a)
@@ -374,6 +1333,10 @@ class DesiredContainer:
                     s += ", _father: None"
                 else:
                     s += ", _father: 0x{:02X}".format(id(self._father))
+            elif a == "_owner" or a == "_store":
+                continue
+            elif a == "_routes":
+                s += ", _ref_count : {}".format(self.ref_count)
             else:
                 s += ", {} : {}".format(a, b)
         return s
@@ -382,6 +1345,17 @@ class cDesiredContainers:
     def __init__(self, log: logging.Logger):
         self._log = log.getChild("d_conts")
         self._s = set()
+        self._by_nh = {}
+        self._by_member = {}    # next hop id -> next hop sets in _by_nh using it
+        self._unresolved = set()
+
+        # restored route table the route sets are filled from, see load_routes
+        self._route_source = None
+
+        # changes since the last snapshot was published
+        self.tracking = False
+        self._dirty_dcs = set()
+        self._dirty_routes = set()
 
     def __str__(self):
 
@@ -395,82 +1369,921 @@ class cDesiredContainers:
         for s in self._s:
             yield s
 
+    def __len__(self):
+        return len(self._s)
+
+    @staticmethod
+    def _key(nh_set):
+        return NexthopSet.of(nh_set)
+
+    def _index(self, dc: DesiredContainer, nh_set):
+        key = self._key(nh_set)
+        group = self._by_nh.get(key)
+        if group is None:
+            self._by_nh[key] = group = set()
+            for i in key.ids():
+                self._by_member.setdefault(i, set()).add(key)
+        group.add(dc)
+
+    def _unindex(self, dc: DesiredContainer, nh_set):
+        key = self._key(nh_set)
+        group = self._by_nh[key]
+        group.discard(dc)
+        if not group:
+            del self._by_nh[key]
+            for i in key.ids():
+                keys = self._by_member[i]
+                keys.discard(key)
+                if not keys:
+                    del self._by_member[i]
+
     def add(self, dc: DesiredContainer):
         self._s.add(dc)
+        self._index(dc, dc.nh_set)
+        dc._owner = self
+        self.state_changed(dc)
+        if self.tracking:
+            self._dirty_dcs.add(dc)
+            self._dirty_routes.update(dc.route_keys)
 
     def remove(self, dc: DesiredContainer):
         self._s.remove(dc)
+        self._unindex(dc, dc.nh_set)
+        self._unresolved.discard(dc)
+        if self.tracking:
+            self._dirty_dcs.add(dc)
+            self._dirty_routes.update(dc.route_keys)
+        dc._owner = None
+
+    def load_routes(self):
+        # restored containers start without route sets, the first one used
+        # fills them all in one pass over the route table
+        source, self._route_source = self._route_source, None
+        for dc in self._s:
+            if dc._store is None and dc._routes is None:
+                dc._routes = set()
+        if source is not None:
+            for k, dc in source.dc_items():
+                dc._routes.add(k)
+
+    def touched(self, dc: DesiredContainer):
+        self._dirty_dcs.add(dc)
+
+    def route_touched(self, k):
+        self._dirty_routes.add(k)
+
+    def take_dirty(self):
+        dcs, routes = self._dirty_dcs, self._dirty_routes
+        self._dirty_dcs = set()
+        self._dirty_routes = set()
+        return dcs, routes
+
+    def state_changed(self, dc: DesiredContainer):
+        if self.tracking:
+            self._dirty_dcs.add(dc)
+        if dc.current_state == DesiredContainer.State.RESOLVED:
+            self._unresolved.discard(dc)
+        else:
+            self._unresolved.add(dc)
 
+    def unresolved(self):
+        # oldest first, the order does not depend on the set's history
+        return sorted(self._unresolved, key = lambda dc: dc.sid)
+
+    @property
+    def unresolved_count(self):
+        return len(self._unresolved)
+
+    def rekey(self, dc: DesiredContainer, old_nh_set):
+        self._unindex(dc, old_nh_set)
+        self._index(dc, dc.nh_set)
+        if self.tracking:
+            self._dirty_dcs.add(dc)
+
+    def __contains__(self, dc: DesiredContainer):
+        return dc in self._s
+
+    def lookup(self, nh_set):
+        return self._by_nh.get(self._key(nh_set), ())
+
+    def nearest(self, nh_set):
+        # resolved container sharing next hops with nh_set that needs the
+        # fewest members added or removed to match it, returns (dc, distance)
+        target = self._key(nh_set)
+        common = {}
+        for i in target.ids():
+            for key in self._by_member.get(i, ()):
+                common[key] = common.get(key, 0) + 1
+
+        # ties go to the oldest container
+        best = None
+        best_d = None
+        for key, c in common.items():
+            d = len(key) + len(target) - 2 * c
+            if best_d is not None and d > best_d:
+                continue
+            for dc in self._by_nh[key]:
+                if dc.current_state == DesiredContainer.State.RESOLVED and (best is None or d < best_d or dc.sid < best.sid):
+                    best, best_d = dc, d
+        return best, best_d
+
+    def duplicates(self):
+        return [list(group) for group in self._by_nh.values() if len(group) > 1]
+
+
+class MemoryAccountant:
+    # container memory budget, one instance may be shared by several SDKs
+
+    def __init__(self, memory):
+        self._free = memory
+        self._lock = threading.Lock()
+
+    @property
+    def free(self):
+        return self._free
+
+    def reserve(self, size):
+        with self._lock:
+            if self._free < size:
+                return False
+            self._free -= size
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self._free += size
 
-    
 
 class SDK:
 
+    # default bucket count of a consistent container, one member table
+    # entry per bucket
     _CONSISTENT_HASH_SIZE = 5
     _SINGLE_HASH_SIZE = 1
 
-    def __init__(self, log: logging.Logger, memory = 7):
+    # commit order of queued operations
+    _PHASE_MOVE = 0
+    _PHASE_CREATE = 1
+    _PHASE_ALIGN = 2
+    _PHASE_PROGRAM = 3
+    _PHASE_REPLACE = 4
+    _PHASE_DELETE = 5
+    _PHASES = 6
+
+    def __init__(self, log: logging.Logger, memory = 7, accountant: MemoryAccountant = None, allocator = None,
+                 buckets = _CONSISTENT_HASH_SIZE, backend = None):
         self._log = log.getChild("sdk")
+        self._backend = backend
+        self.failed_batches = 0
+        self._buckets = buckets
+        self.aligns = 0
+        self.buckets_moved = 0
+
+        # open transaction: per phase {key: op}, nested begin() calls join it
+        self._txn = None
+        self._txn_depth = 0
+        self._txn_cancelled = set()
+        self.calls = 0
+        self.batches = 0
+        self.writes = 0
         self._memory = memory
-        
-        
+        self._accountant = accountant
+        self._allocator = allocator
+        self._used = 0
+
+        # member table placement, only with an allocator. Blocks of containers
+        # deleted in the open transaction stay taken until the delete is sent.
+        self._placed = {}
+        self._releasing = {}
+        self.failures = 0
+        self.fragmented_failures = 0
+        self.compactions = 0
+        self.moved = 0
+
+        # restart reconciliation: containers taken over as they were, writes
+        # needed to bring containers and routes back in line
+        self.adopted = 0
+        self.repaired = 0
+
+    @property
+    def memory(self):
+        if self._accountant is not None:
+            return self._accountant.free
+        if self._allocator is not None:
+            return self._allocator.free
+        return self._memory
+
+    @property
+    def allocator(self):
+        return self._allocator
+
+    @property
+    def used(self):
+        return self._used
+
+    def _reserve(self, total):
+        if self._accountant is not None:
+            if not self._accountant.reserve(total):
+                return False
+        elif self._allocator is not None:
+            pass
+        elif self._memory >= total:
+            self._memory -= total
+        else:
+            return False
+
+        self._used += total
+        return True
+
+    def _release(self, total):
+        if self._accountant is not None:
+            self._accountant.release(total)
+        elif self._allocator is None:
+            self._memory += total
+        self._used -= total
+
+    def charged(self, ac: ActualContainer):
+        # memory held by a container, what deleting it gives back
+        if ac.block is not None:
+            return self._allocator.length(ac.block)
+        return len(ac._buckets) if ac.consistent else len(ac.nh_set) * SDK._SINGLE_HASH_SIZE
+
+    def _container_size(self, nhset, if_consistent):
+        total = self._buckets if if_consistent else len(nhset) * SDK._SINGLE_HASH_SIZE
+        return self._allocator.block_size(total) if self._allocator is not None else total
+
+    def begin(self):
+        if self._txn_depth == 0:
+            self._txn = [{} for _ in range(SDK._PHASES)]
+        self._txn_depth += 1
+
+    def commit(self):
+        self._txn_depth -= 1
+        if self._txn_depth > 0:
+            return
+
+        txn, cancelled = self._txn, self._txn_cancelled
+        self._txn = None
+        self._txn_cancelled = set()
+
+        if cancelled:
+            self._retarget(txn, cancelled)
+
+        ops = [self._op(op) for phase in txn for op in phase.values()]
+        if ops:
+            self._submit(ops)
+
+        # the deletes are on their way, later batches may reuse the blocks
+        for block in self._releasing:
+            n = self._allocator.length(block)
+            self._allocator.release(block)
+            self._release(n)
+        self._releasing = {}
+
+    @staticmethod
+    def _retarget(txn, cancelled):
+        # containers created and deleted in the transaction are never sent.
+        # Routes programmed to one, and replaces into one, follow the
+        # replaces out of it to the container that is left; with none left
+        # they are dropped like the container.
+        replaces = txn[SDK._PHASE_REPLACE]
+        successor = {}
+        for a, b in replaces:
+            if a in cancelled:
+                successor.setdefault(a, b)
+
+        def final(sid):
+            seen = set()
+            while sid in cancelled and sid not in seen:
+                seen.add(sid)
+                sid = successor.get(sid)
+            return None if sid in cancelled else sid
+
+        programs = txn[SDK._PHASE_PROGRAM]
+        for k, (name, arg) in list(programs.items()):
+            if name == "program" and arg[1] in cancelled:
+                sid = final(arg[1])
+                if sid is None:
+                    del programs[k]
+                else:
+                    programs[k] = ("program", (k, sid))
+
+        kept = {}
+        for (a, b), op in replaces.items():
+            if a in cancelled:
+                continue
+            if b in cancelled:
+                b = final(b)
+                if b is None or b == a:
+                    continue
+                op = ("replace", (a, b))
+            kept.setdefault((a, b), op)
+        txn[SDK._PHASE_REPLACE] = kept
+
+    @property
+    def in_transaction(self):
+        return self._txn is not None
+
+    def _queue(self, phase, key, op):
+        # outside a transaction every operation is its own batch
+        self.calls += 1
+        if self._txn is None:
+            self._submit([self._op(op)])
+        else:
+            self._txn[phase][key] = op
+
+    @staticmethod
+    def _op(op):
+        # tables are read when the operation is sent, so queued creates and
+        # aligns carry the final state of the container
+        name, arg = op
+        if name in ("create", "align"):
+            ac = arg
+            return name, (ac.sid, ac.consistent, ac.block, ac.members, ac.buckets)
+        return op
+
+    def _submit(self, ops):
+        self.batches += 1
+        self.writes += len(ops)
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "batch of %d operations", len(ops))
+
+        # a backend completes batches asynchronously, only failures come back
+        if self._backend is not None:
+            self._backend.submit(ops).add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, fut):
+        if fut.exception() is not None:
+            self.failed_batches += 1
+            self._log.error("SDK batch failed: %s", fut.exception())
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def flush(self):
+        if self._backend is not None:
+            self._backend.flush()
 
     def SDKProgramRoute(self, route: Route):
 
-        self._log.log(_TRACE_LEVEL, "route=%s memory=%d", str(route), self._memory)
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "route=%s memory=%d", route, self.memory)
         assert route.desired_container.actual_container != None
 
+        ac = route.desired_container.actual_container
+        self._queue(SDK._PHASE_PROGRAM, route.key, ("program", (route.key, ac.sid)))
+
+    def SDKUnprogramRoute(self, route: Route):
+
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "route=%s", route)
+
+        self._queue(SDK._PHASE_PROGRAM, route.key, ("unprogram", (route.key,)))
+
     def SDKCloneAC(self, ac: ActualContainer):
-        self._log.log(_TRACE_LEVEL, "ac=%s memory=%d", str(ac), self._memory)
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "ac=%s memory=%d", ac, self.memory)
         
         new_ac = self.SDKCreateContainer(ac.nh_set, ac.consistent)
+        if new_ac:
+            new_ac.nh_set = ac.nh_set
+            new_ac.copy_buckets(ac)
         return new_ac
 
     def SDKAlign(self, ac: ActualContainer, nhset):
-        self._log.log(_TRACE_LEVEL, "ac = %s nhset=%s memory=%d", str(ac), str(pSet(nhset)),  self._memory)
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "ac = %s nhset=%s memory=%d", ac, pSet(nhset),  self.memory)
+
+        if ac.consistent:
+            moved = ac.rebalance(nhset)
+        else:
+            ac.fill(nhset, len(NexthopSet.of(nhset)))
+            moved = len(ac.buckets)
         ac.nh_set = nhset
 
+        self.aligns += 1
+        self.buckets_moved += moved
+        if self._txn is None or ac.sid not in self._txn[SDK._PHASE_CREATE]:
+            self._queue(SDK._PHASE_ALIGN, ac.sid, ("align", ac))
+        return moved
+
 
     def SDKCreateContainer(self, nhset, if_consistent: bool):
 
-        self._log.log(_TRACE_LEVEL, "nhset=%s, consistent=%s memory=%d", str(pSet(nhset)), str(if_consistent), self._memory)
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "nhset=%s, consistent=%s memory=%d", pSet(nhset), if_consistent, self.memory)
 
-        if if_consistent:
-            total = SDK._CONSISTENT_HASH_SIZE
-        else:
-            total = len(nhset)* SDK._SINGLE_HASH_SIZE
-        
-        if self._memory >= total:
-            self._memory -= total
-            self._log.log(logging.DEBUG, "Created container nhset=%s consistent=%s size=%d(memory=%d)", str(pSet(nhset)), str(if_consistent), total, self._memory)
+        total = self._container_size(nhset, if_consistent)
+
+        block = None
+        ok = self._reserve(total)
+        if ok and self._allocator is not None:
+            block = self._allocator.reserve(total)
+            if block is None:
+                if self._allocator.free >= total:
+                    self.fragmented_failures += 1
+                self._release(total)
+                ok = False
+
+        if ok:
+            if _tracing:
+                self._log.log(logging.DEBUG, "Created container nhset=%s consistent=%s size=%d(memory=%d)", pSet(nhset), if_consistent, total, self.memory)
         else:
-            self._log.log(logging.DEBUG, "Failed to allocate container nh=%s consistent=%s %d(memory=%d)", str(pSet(nhset)), str(if_consistent), total, self._memory)
+            self.failures += 1
+            if _tracing:
+                self._log.log(logging.DEBUG, "Failed to allocate container nh=%s consistent=%s %d(memory=%d)", pSet(nhset), if_consistent, total, self.memory)
             return None
 
         ac = ActualContainer(self._log)
 
         ac.consistent = if_consistent
+        ac.fill(nhset, self._buckets if if_consistent else len(NexthopSet.of(nhset)))
+        if block is not None:
+            ac.block = block
+            self._placed[block] = ac
+
+        self._queue(SDK._PHASE_CREATE, ac.sid, ("create", ac))
 
         return ac
 
+    def SDKDefragment(self, nhset, if_consistent: bool):
+        # compact the member table when a container of this kind fails only
+        # because the free entries are scattered. Returns True if it did.
+        if self._allocator is None:
+            return False
+
+        total = self._container_size(nhset, if_consistent)
+        if self._allocator.largest_free >= total or self._allocator.free < total:
+            return False
+
+        # the moves are queued in the order the allocator gives them, which
+        # never writes over a block that has not moved yet. Each compaction
+        # gets its own moves, sent after those of earlier ones.
+        moves = self._allocator.compact()
+        placed = {}
+        releasing = {}
+        for off, new in moves.items():
+            ac = self._placed.pop(off, None)
+            if ac is not None:
+                ac.block = new
+                placed[new] = ac
+                if self._txn is not None and ac.sid in self._txn[SDK._PHASE_CREATE]:
+                    continue
+            else:
+                # waiting for its delete, still in the table
+                ac = self._releasing.pop(off)
+                releasing[new] = ac
+            self._queue(SDK._PHASE_MOVE, (ac.sid, self.compactions), ("move", (ac.sid, new)))
+        self._placed.update(placed)
+        self._releasing.update(releasing)
+
+        self.compactions += 1
+        self.moved += len(moves)
+
+        if _tracing:
+            self._log.log(logging.DEBUG, "Compacted member table, moved %d containers (largest free=%d)", len(moves), self._allocator.largest_free)
+
+        return True
+
 
     def SDKDeleteContainer(self, ac: ActualContainer):
         
-        self._log.log(_TRACE_LEVEL, "delete: ac=%s, memory=%d", str(ac), self._memory)
-
-        free_mem = 0
-        if ac.consistent:
-            free_mem = SDK._CONSISTENT_HASH_SIZE
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "delete: ac=%s, memory=%d", ac, self.memory)
+
+        free_mem = self.charged(ac)
+        cancelled = self._txn is not None and self._txn[SDK._PHASE_CREATE].pop(ac.sid, None) is not None
+
+        if ac.block is not None:
+            del self._placed[ac.block]
+            if self._txn is not None and not cancelled:
+                # still in the table until the delete phase, nothing created
+                # or moved in this transaction may land on it
+                self._releasing[ac.block] = ac
+            else:
+                self._allocator.release(ac.block)
+                self._release(free_mem)
+            ac.block = None
         else:
-            free_mem = len(ac.nh_set) * SDK._SINGLE_HASH_SIZE
+            self._release(free_mem)
 
-        self._memory += free_mem
+        if cancelled:
+            # created and deleted in the same transaction, nothing to send
+            self._txn[SDK._PHASE_ALIGN].pop(ac.sid, None)
+            self._txn_cancelled.add(ac.sid)
+            self.calls += 1
+        else:
+            self._queue(SDK._PHASE_DELETE, ac.sid, ("delete", (ac.sid,)))
 
-        self._log.log(logging.DEBUG, "Deleted container nhset=%s consistent=%s size=%d(memory=%d)", str(ac.nh_set), str(ac.consistent), free_mem, self._memory)
+        if _tracing:
+            self._log.log(logging.DEBUG, "Deleted container nhset=%s consistent=%s size=%d(memory=%d)", ac.nh_set, ac.consistent, free_mem, self.memory)
 
             
+    def SDKAdopt(self, ac: ActualContainer, size):
+        # a container the SDK still holds from before a restart, memory and
+        # placement are accounted and nothing is sent
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "ac=%s size=%d memory=%d", ac, size, self.memory)
+
+        if not self._reserve(size):
+            raise ValueError("no memory for restored container %d" % ac.sid)
+        if ac.block is not None:
+            if self._allocator is None or self._allocator.reserve_at(ac.block, size) is None:
+                self._release(size)
+                raise ValueError("member table block %d of restored container %d is not free" % (ac.block, ac.sid))
+            self._placed[ac.block] = ac
+
+    def SDKReconcile(self, acs, expected, routes_of):
+        # compares the restored containers with what the SDK holds and only
+        # writes the differences. expected is {sid: (route count, key sum)}
+        # of the routes programmed to each container, routes_of(sids) gives
+        # ({sid: route keys} of the restored routes of those containers,
+        # keys of the routes without a container to program them to). The
+        # latter are left as the SDK has them, they may still forward.
+        # Without a backend there is nothing to compare against. A backend
+        # that cannot be read is treated as empty and gets everything.
+        if self._backend is None:
+            self.adopted += len(acs)
+            return
+
+        read = getattr(self._backend, "read", None)
+        containers, digests = read().result() if read is not None else ({}, {})
+
+        for ac in acs:
+            held = containers.pop(ac.sid, None)
+            if held == self._op(("create", ac))[1]:
+                self.adopted += 1
+            elif held is None:
+                self._queue(SDK._PHASE_CREATE, ac.sid, ("create", ac))
+                self.repaired += 1
+            else:
+                self._queue(SDK._PHASE_ALIGN, ac.sid, ("align", ac))
+                self.repaired += 1
+
+        # left over from before the checkpoint
+        for sid in containers:
+            self._queue(SDK._PHASE_DELETE, sid, ("delete", (sid,)))
+            self.repaired += 1
+
+        stale = [sid for sid in set(digests) | set(expected) if digests.get(sid) != expected.get(sid)]
+        if not stale:
+            return
+
+        held = self._backend.read_routes(stale).result() if read is not None else {}
+        want, unplaced = routes_of(stale)
+
+        # withdrawals first, a route moving between containers keeps the program
+        for sid in stale:
+            for k in held.get(sid, set()) - want.get(sid, set()) - unplaced:
+                self._queue(SDK._PHASE_PROGRAM, k, ("unprogram", (k,)))
+                self.repaired += 1
+        for sid in stale:
+            for k in want.get(sid, set()) - held.get(sid, set()):
+                self._queue(SDK._PHASE_PROGRAM, k, ("program", (k, sid)))
+                self.repaired += 1
+
+        if _tracing:
+            self._log.log(logging.DEBUG, "Reconciled containers adopted=%d repaired=%d stale=%d", self.adopted, self.repaired, len(stale))
+
     def SDKReplaceContainer(self, ac1: ActualContainer, ac2: ActualContainer):
-        self._log.log(_TRACE_LEVEL, "ac1= [%s] ac2=  [%s] memory=%d", str(ac1), str(ac2), self._memory)
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "ac1= [%s] ac2=  [%s] memory=%d", ac1, ac2, self.memory)
+
+        key = (ac1.sid if ac1 is not None else None, ac2.sid)
+        self._queue(SDK._PHASE_REPLACE, key, ("replace", key))
+
+    def __str__(self):
+        s = "".join(" {}: {}".format(a,b) for a,b in vars(self).items() if a not in ("_accountant", "_allocator", "_backend", "_placed", "_releasing", "_txn", "_txn_cancelled"))
+        if self._accountant is not None:
+            s += " shared memory: {}".format(self.memory)
+        return s
+
+
+class Timer:
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerEngine:
+    # deadline heap served by one thread which sleeps until the earliest
+    # deadline, an engine without timers does not wake up at all
+
+    def __init__(self, clock = time.monotonic):
+        self._clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def now(self):
+        return self._clock()
+
+    def schedule(self, delay, callback, *args):
+        return self.schedule_at(self._clock() + delay, callback, *args)
+
+    def schedule_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def cancel(self, timer: Timer):
+        # lazily dropped when it reaches the top of the heap
+        timer.cancel()
+
+    def __len__(self):
+        return sum(1 for e in self._heap if not e[2].cancelled)
+
+    def next_deadline(self):
+        with self._cond:
+            self._drop_cancelled()
+            return self._heap[0][0] if self._heap else None
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now):
+        with self._cond:
+            self._drop_cancelled()
+            if self._heap and self._heap[0][0] <= now:
+                return heapq.heappop(self._heap)[2]
+        return None
+
+    def run_due(self):
+        # fire everything that is due, for callers driving their own clock
+        count = 0
+        timer = self._pop_due(self._clock())
+        while timer:
+            timer.callback(*timer.args)
+            count += 1
+            timer = self._pop_due(self._clock())
+        return count
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    self._drop_cancelled()
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - self._clock()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+
+                if not self._running:
+                    return
+
+                timer = heapq.heappop(self._heap)[2]
+
+            timer.callback(*timer.args)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target = self._run, name = "c_hash-timers", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+
+class Dampening:
+    # penalty/half-life flap dampening parameters (same scheme as RFC 2439)
+
+    def __init__(self, penalty = 1000, suppress = 2000, reuse = 750, half_life = 15.0, max_penalty = 12000):
+        self.penalty = penalty
+        self.suppress = suppress
+        self.reuse = reuse
+        self.half_life = half_life
+        self.max_penalty = max_penalty
+
+    def decay(self, penalty, elapsed):
+        return penalty * math.pow(2.0, -elapsed / self.half_life)
+
+    def time_to_reuse(self, penalty):
+        return self.time_to_decay(penalty, self.reuse)
+
+    def time_to_decay(self, penalty, level):
+        if penalty <= level:
+            return 0.0
+        return self.half_life * math.log2(penalty / level)
+
+    def __str__(self):
+        return "".join(" {}: {}".format(a,b) for a,b in vars(self).items())
+
+
+class _FlapState:
+    __slots__ = ("penalty", "updated", "suppressed", "pending", "timer", "expires")
+
+    def __init__(self, now):
+        self.penalty = 0.0
+        self.updated = now
+        self.suppressed = False
+        self.pending = None
+        self.timer = None
+        self.expires = now
+
+
+class FlapDampener:
+    # per prefix penalty, suppressed prefixes keep their programmed state and
+    # only the latest wanted route is remembered until the penalty decays to
+    # the reuse threshold
+
+    def __init__(self, config: Dampening, timers: TimerEngine, release):
+        self._config = config
+        self._timers = timers
+        self._release = release
+        self._d = {}
+        # (expires, key) for entries that may be dropped once decayed, stale
+        # pairs are skipped when they surface
+        self._expiry = []
+
+        self.flaps = 0
+        self.suppressed_updates = 0
+        self.released = 0
+
+    @property
+    def config(self):
+        return self._config
+
+    def __len__(self):
+        return len(self._d)
+
+    def _decayed(self, st: _FlapState, now):
+        st.penalty = self._config.decay(st.penalty, now - st.updated)
+        st.updated = now
+        return st.penalty
+
+    def penalty(self, key, now):
+        st = self._d.get(key)
+        return 0.0 if st is None else self._decayed(st, now)
+
+    def is_suppressed(self, key):
+        st = self._d.get(key)
+        return st is not None and st.suppressed
+
+    def discard_pending(self, key):
+        st = self._d.get(key)
+        if st is not None:
+            st.pending = None
+
+    def flap(self, key, now, route: Route = None):
+        # returns True when the update must not be programmed now
+        self._prune(now)
+        st = self._d.get(key)
+        if st is None:
+            self._d[key] = st = _FlapState(now)
+
+        self.flaps += 1
+        penalty = self._decayed(st, now) + self._config.penalty
+        st.penalty = min(penalty, self._config.max_penalty)
+        st.expires = now + self._config.time_to_decay(st.penalty, self._config.reuse / 2)
+        heapq.heappush(self._expiry, (st.expires, key))
+
+        if not st.suppressed and st.penalty >= self._config.suppress:
+            st.suppressed = True
+
+        if st.suppressed:
+            st.pending = route
+            self._arm(key, st)
+            if route:
+                self.suppressed_updates += 1
+
+        return st.suppressed and route is not None
+
+    def _arm(self, key, st: _FlapState):
+        if st.timer:
+            st.timer.cancel()
+        st.timer = self._timers.schedule(self._config.time_to_reuse(st.penalty), self._release, key)
+
+    def release(self, key, now):
+        # called from the reuse timer, returns the route to apply if any
+        st = self._d.get(key)
+        if st is None or not st.suppressed:
+            return None
+
+        st.timer = None
+        if self._decayed(st, now) > self._config.reuse:
+            self._arm(key, st)
+            return None
+
+        st.suppressed = False
+        route, st.pending = st.pending, None
+        self.released += 1
+
+        # decayed entries that are not suppressed are not worth keeping, the
+        # ones that came due while suppressed go back on the heap
+        if st.expires <= now:
+            heapq.heappush(self._expiry, (st.expires, key))
+        self._prune(now)
+
+        return route
+
+    def _prune(self, now):
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            expires, key = heapq.heappop(expiry)
+            st = self._d.get(key)
+            if st is not None and st.expires == expires and not st.suppressed:
+                del self._d[key]
+
+    def __str__(self):
+        return "".join(" {}: {}".format(a, getattr(self, a)) for a in ("flaps", "suppressed_updates", "released")) + " tracked: {}".format(len(self._d))
+
+
+class SnapshotAC:
+    __slots__ = ("id", "nh_set", "resolved", "consistent")
+
+    def __init__(self, ac: ActualContainer):
+        self.id = ac.sid
+        self.nh_set = ac.nh_set.s
+        self.resolved = ac.resolved
+        self.consistent = ac.consistent
+
+    def __str__(self):
+        return "ac {} {} resolved={} consistent={}".format(self.id, self.nh_set, self.resolved, self.consistent)
+
+
+class SnapshotGroup:
+    __slots__ = ("id", "nh_set", "state", "ac", "ref_count")
+
+    def __init__(self, dc: DesiredContainer):
+        self.id = dc.sid
+        self.nh_set = dc.nh_set
+        self.state = dc.current_state
+        self.ac = SnapshotAC(dc.actual_container) if dc.actual_container is not None else None
+        self.ref_count = dc.ref_count
+
+    def __str__(self):
+        return "group {} {} {} refs={} [{}]".format(self.id, self.nh_set, self.state.name, self.ref_count, self.ac)
+
+
+class Snapshot:
+    # frozen route -> next hop group -> actual container view. Versions share
+    # structure, taking one is a reference read.
+
+    def __init__(self, version, routes: PMap, groups: PMap, resolved, stable):
+        self.version = version
+        self.routes = routes
+        self.groups = groups
+        self.resolved = resolved
+        self.stable = stable
+
+    def __len__(self):
+        return len(self.routes)
+
+    def group(self, prefix: Prefix):
+        gid = self.routes.get(prefix.hashable)
+        return None if gid is None else self.groups.get(gid)
+
+    def nh_set(self, prefix: Prefix):
+        g = self.group(prefix)
+        return None if g is None else g.nh_set
+
+    def actual_container(self, prefix: Prefix):
+        g = self.group(prefix)
+        return None if g is None else g.ac
+
+    def items(self):
+        for k, gid in self.routes.items():
+            yield Prefix.from_key(k), self.groups.get(gid)
+
+    def __str__(self):
+        return "version: {} routes: {} groups: {} resolved: {} stable: {}".format(
+            self.version, len(self.routes), len(self.groups), self.resolved, self.stable)
+
+
+class BatchResult:
+    def __init__(self):
+        self.added = 0
+        self.changed = 0
+        self.dampened = 0
+        self.deleted = 0
+        self.missing = 0
+
+    @property
+    def total(self):
+        return self.added + self.changed + self.dampened + self.deleted + self.missing
 
     def __str__(self):
         return "".join(" {}: {}".format(a,b) for a,b in vars(self).items())
@@ -490,82 +2303,277 @@ class ConsistentHash:
 
     _periodic_timer = 2 #seconds
 
-    _timer_tick = 1 #sec
+    _retry_max = 16 #seconds, backoff cap of the resolution retry
 
     _degrage_max = 10
+
+    _seed_max = (1 << 64) - 1 # journal and checkpoint keep the seed as u64
+
+    # survivor preference when merging equal desired containers
+    _merge_rank = {
+        DesiredContainer.State.RESOLVED: 0,
+        DesiredContainer.State.PARTIAL: 1,
+        DesiredContainer.State.REALLOCATE: 2,
+        DesiredContainer.State.FAILED: 3,
+    }
     
-    def __init__(self, debug_level = _TRACE_LEVEL):
+    def __init__(self, debug_level = None, compact_routes = False, clock = time.monotonic, dampening: Dampening = None,
+                 accountant: MemoryAccountant = None, allocator = None, sdk_backend = None, journal = None,
+                 seed = None, buckets = SDK._CONSISTENT_HASH_SIZE):
         self._log = logging.getLogger("c_hash")
         self.DesiredContainers = cDesiredContainers(self._log)
-        self.SdkObject = SDK(self._log)
+        self.SdkObject = SDK(self._log, accountant = accountant, allocator = allocator, buckets = buckets,
+                             backend = sdk_backend)
         self.ActualContainers = pSet(set())
-        self.Routes = RouteContainer(self._log)
+        self._shared_by_nh = {}     # next hop id -> resolved actual containers using it
+        self.Routes = CompactRouteContainer(self._log) if compact_routes else RouteContainer(self._log)
 
         self._system_resolved = self.SystemResolved.RESOLVED
         self._system_stable = self.SystemState.STABLE #need to be stable
         self._last_resolved = 0
         self._consistent_adm = False
 
-        self._sched = sched.scheduler()
-        self._current_time = 0
-        self._last_periodic = 0
+        self._timers = TimerEngine(clock)
+        self._start_time = self._timers.now()
+        self._stable_deadline = self._start_time + self._long_period_of_time
+        self._retry_timer = None
+        self._retry_interval = self._periodic_timer
+        self._stable_timer = None
         self._lock = threading.Lock()
 
+        self._dampener = FlapDampener(dampening, self._timers, self._on_reuse_timer) if dampening is not None else None
+
         self._running = True
         self._freeze = False
 
-        FORMAT = '%(asctime)-15s %(levelname)-8s [%(filename)s:%(lineno)d - %(funcName)20s()] %(message)s'
+        self._batch = False
+        self._periodic_pending = False
 
-        logging.basicConfig(filename = "log.txt", format=FORMAT, level= debug_level, filemode = "w")
+        # published read view, built on the first snapshot() call
+        self._snapshot = None
+        self._snap_routes = None
+        self._snap_groups = None
 
-        #start ticking
-        self._sched.enter(1, 1, self._periodic_tick)
-        self._timer_thread = threading.Thread(target=self._sched.run)
-        
+        # fallback choices come from a seeded generator so a journal replays exactly
+        if seed is None:
+            seed = random.getrandbits(63)
+        elif not 0 <= seed <= self._seed_max:
+            raise ValueError("seed must fit in 64 bits unsigned: %r" % (seed,))
+        self._seed = seed
+        self._random = random.Random(self._seed)
+
+        # event recorder (consistent_journal.JournalWriter), written under the lock
+        self._journal = journal
+        if journal is not None:
+            journal.seed(self._seed)
+
+        if debug_level is not None:
+            enable_tracing(level = debug_level)
 
     
     def add_route(self, route: Route):
 
-        self._lock.acquire()
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.add(self._now(), route)
+            self._add_route(route)
+        finally:
+            self._unlock()
 
-        if route.prefix in self.Routes.prefixes():
-            self._change_route(route)
-        else:
+    def _add_route(self, route: Route):
+
+        currR = self.Routes.get(route.prefix)
+
+        if currR is None:
             self._new_route(route)
-        
+            return "added"
+
+        if self._dampener is not None:
+            if currR.nh_set != route.nh_set:
+                if self._dampener.flap(route.prefix.hashable, self._timers.now(), Route(route.prefix, route.nh_set)):
+                    if _tracing:
+                        self._log.log(_TRACE_LEVEL, "dampened route %s", route)
+                    return "dampened"
+            elif self._dampener.is_suppressed(route.prefix.hashable):
+                # back to what is programmed, nothing left to release
+                self._dampener.discard_pending(route.prefix.hashable)
+                return "dampened"
+
+        self._change_route(route)
+        return "changed"
+
+    def _on_reuse_timer(self, key):
+
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.tick(self._now())
+
+            route = self._dampener.release(key, self._timers.now())
+
+            if route and self.Routes.by_key(key) is not None:
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "releasing dampened route %s", route)
+                self._change_route(route)
+        finally:
+            self._unlock()
+
+    def _acquire(self):
+        # one SDK transaction per locked section
+        self._lock.acquire()
+        self.SdkObject.begin()
+
+    def _unlock(self):
+        self.SdkObject.commit()
+        self._arm_timers()
+        if self._snapshot is not None:
+            self._publish()
         self._lock.release()
 
+    def snapshot(self) -> Snapshot:
+        # readers only ever see a snapshot published at the end of a locked
+        # section, so they do not take the lock and never see half an update
+        snap = self._snapshot
+        if snap is not None:
+            return snap
+
+        self._lock.acquire()
+        if self._snapshot is None:
+            self.DesiredContainers.tracking = True
+            self.DesiredContainers.take_dirty()
+            self._snap_routes = TransientMap()
+            self._snap_groups = TransientMap()
+            for dc in self.DesiredContainers:
+                self._snap_groups.set(dc.sid, SnapshotGroup(dc))
+            for r in self.Routes:
+                if r.desired_container is not None:
+                    self._snap_routes.set(r.key, r.desired_container.sid)
+            self._snapshot = Snapshot(0, self._snap_routes.persistent(), self._snap_groups.persistent(),
+                                      self._system_resolved == self.SystemResolved.RESOLVED,
+                                      self._system_stable == self.SystemState.STABLE)
+        snap = self._snapshot
+        self._lock.release()
+        return snap
+
+    def _publish(self):
+        dcs, keys = self.DesiredContainers.take_dirty()
+        prev = self._snapshot
+        resolved = self._system_resolved == self.SystemResolved.RESOLVED
+        stable = self._system_stable == self.SystemState.STABLE
+
+        if not dcs and not keys and prev.resolved == resolved and prev.stable == stable:
+            return
+
+        for dc in dcs:
+            if dc._owner is None:
+                self._snap_groups.delete(dc.sid)
+            else:
+                self._snap_groups.set(dc.sid, SnapshotGroup(dc))
+
+        for k in keys:
+            r = self.Routes.by_key(k)
+            if r is None or r.desired_container is None:
+                self._snap_routes.delete(k)
+            else:
+                self._snap_routes.set(k, r.desired_container.sid)
+
+        self._snapshot = Snapshot(prev.version + 1, self._snap_routes.persistent(), self._snap_groups.persistent(),
+                                  resolved, stable)
+
+    def add_routes(self, routes):
+
+        result = BatchResult()
+
+        self._acquire()
+        try:
+            if self._journal is not None:
+                routes = list(routes)
+                self._journal.add_batch(self._now(), routes)
+            self._begin_batch()
+
+            for route in routes:
+                outcome = self._add_route(route)
+                setattr(result, outcome, getattr(result, outcome) + 1)
+        finally:
+            self._end_batch()
+            self._unlock()
+
+        if _tracing:
+            self._log.log(logging.DEBUG, "batch: %s", result)
+
+        return result
+
+    def del_routes(self, routes):
+
+        result = BatchResult()
+
+        self._acquire()
+        try:
+            if self._journal is not None:
+                routes = list(routes)
+                self._journal.delete_batch(self._now(), routes)
+            self._begin_batch()
+
+            for route in routes:
+                if self._del_route(route):
+                    result.deleted += 1
+                else:
+                    result.missing += 1
+        finally:
+            self._end_batch()
+            self._unlock()
+
+        if _tracing:
+            self._log.log(logging.DEBUG, "batch: %s", result)
+
+        return result
+
+    def _begin_batch(self):
+        self._batch = True
+        self._periodic_pending = False
+
+    def _end_batch(self):
+        self._batch = False
+        if self._periodic_pending:
+            self._periodic_pending = False
+            self._periodic(lock = False)
+
     def _new_route(self, route: Route):
 
         newRoute = Route(route.prefix, route.nh_set)
 
-        self._log.log(_TRACE_LEVEL, "New route %s\n", str(newRoute))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "New route %s\n", newRoute)
 
-        self.Routes.add(newRoute)
+        newRoute = self.Routes.add(newRoute)
 
-        l_dc = [dc for dc in self.DesiredContainers if dc.nh_set == newRoute.nh_set]
+        l_dc = self.DesiredContainers.lookup(newRoute.nh_set)
         
         if l_dc:
             if len(l_dc)!= 1:
                 raise AssertionError
-            dc = l_dc[0]
+            dc = next(iter(l_dc))
             newRoute.desired_container = dc
-            dc.ref_count += 1
 
-            self._log.log(_TRACE_LEVEL, "Adding route %s to existing d_cont %s\n", str(newRoute), str(dc))
+            if _tracing:
+                self._log.log(_TRACE_LEVEL, "Adding route %s to existing d_cont %s\n", newRoute, dc)
+
+            if dc.current_state != DesiredContainer.State.FAILED:
+                self.SdkObject.SDKProgramRoute(newRoute)
 
             return
 
         dc: DesiredContainer
 
-        dc = DesiredContainer(self._log)
+        dc = self._new_dc()
         newRoute.desired_container = dc
-        dc.ref_count = 1
-        dc.nh_set = copy.copy(newRoute.nh_set)
+        dc.nh_set = newRoute.nh_set
         self._allocate_new_ac(dc)
         self.DesiredContainers.add(dc)
 
-        self._log.log(_TRACE_LEVEL, "Creating container %s for route %s\n", str(dc), str(newRoute))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "Creating container %s for route %s\n", dc, newRoute)
 
         if dc.current_state != DesiredContainer.State.FAILED:
             self.SdkObject.SDKProgramRoute(newRoute)
@@ -579,57 +2587,47 @@ class ConsistentHash:
         currR: Route
         currDC: DesiredContainer
 
-        currR = self.Routes[newR.prefix]
+        currR = self.Routes.get(newR.prefix)
 
         currDC = currR.desired_container
-        currDC.ref_count -= 1
 
         currR.nh_set = newR.nh_set
 
         if (self._system_stable == self.SystemState.STABLE) and (self._consistent_adm == True):
-            dc_child_list = [dc for dc in currDC.child_set if dc.nh_set == newR.nh_set] # TODO how I compare nh_set?
-            if len(dc_child_list) > 1:
-                raise AssertionError
-            if len(dc_child_list) != 0:
-                dc: DesiredContainer
-
-                dc = dc_child_list[0]
-                currR.desired_container = dc
-                dc.ref_count += 1
-                self._log.log(_TRACE_LEVEL, "Using existing container %s for route %s\n", str(dc), str(currR))
-            elif currDC.Father and currDC.Father.dc.nh_set == newR.nh_set:
-                dc: DesiredContainer
-
-                dc = currDC.Father.dc
+            dc = next((dc for dc in self.DesiredContainers.lookup(newR.nh_set)
+                       if dc.current_state == DesiredContainer.State.RESOLVED), None)
+            if dc is not None:
                 currR.desired_container = dc
-                dc.ref_count += 1
-                self._log.log(_TRACE_LEVEL, "Using existing container %s for route %s\n", str(dc), str(currR))
-                
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "Using existing container %s for route %s\n", dc, currR)
             else:
                 ac: ActualContainer
 
-                dc = DesiredContainer(self._log)
-                self.DesiredContainers.add(dc)
+                # clone the container closest to the new set, the current
+                # one wins ties, so the fewest members are rewritten
+                src, distance = self.DesiredContainers.nearest(newR.nh_set)
+                if src is None or currDC.nh_set.distance(newR.nh_set) <= distance:
+                    src = currDC
+
+                dc = self._new_dc()
                 currR.desired_container = dc
                 dc.nh_set = newR.nh_set
-                dc.ref_count = 1
-                currDC.child_set.add(dc)
-                dc.father = currDC
+                self.DesiredContainers.add(dc)
+                src.child_set.add(dc)
+                dc.father = src
 
-                self._log.log(_TRACE_LEVEL, "Creating container %s for route %s\n", str(dc), str(currR))
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "Creating container %s for route %s from %s\n", dc, currR, src.nh_set)
 
-                assert currDC.actual_container
+                assert src.actual_container
 
-                ac = self.SdkObject.SDKCloneAC(currDC.actual_container)
+                ac = self.SdkObject.SDKCloneAC(src.actual_container)
                 if ac:
-                    ac.nh_set = currDC.actual_container.nh_set
+                    ac.nh_set = src.actual_container.nh_set
                     self.SdkObject.SDKAlign(ac, dc.nh_set)
                     ac.resolved = True
                     dc.current_state = DesiredContainer.State.RESOLVED
-                    dc.actual_container = ac
-                    
-                    ac.desired_container = dc
-                    self.ActualContainers.s.add(ac)
+                    self._use_ac(dc, ac)
                 else:
                     self._system_stable = self.SystemState.NON_STABLE
                     self._system_resolved = self.SystemResolved.NOT_RESOLVED
@@ -638,29 +2636,23 @@ class ConsistentHash:
                     self._optimize_non_stable()
         else:
 
-            dc_list = [dc for dc in self.DesiredContainers if dc.nh_set == newR.nh_set]
+            dc_list = self.DesiredContainers.lookup(newR.nh_set)
             if len(dc_list) > 1:
                 raise AssertionError
             if len(dc_list) == 1:
-                dc = dc_list[0]
-                dc.ref_count += 1
+                dc = next(iter(dc_list))
                 currR.desired_container = dc
             else:
-                dc = DesiredContainer(self._log)
+                dc = self._new_dc()
                 currR.desired_container = dc
-                dc.ref_count = 1
                 dc.nh_set = newR.nh_set
                 self._allocate_new_ac(dc)
                 self.DesiredContainers.add(dc)
-                self._log.log(_TRACE_LEVEL, "Creating container %s for route %s\n", str(dc), str(currR))
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "Creating container %s for route %s\n", dc, currR)
 
         if currDC.ref_count == 0:
-            self.DesiredContainers.remove(currDC)
-            
-            if currDC.actual_container != None:
-                self.ActualContainers.s.remove(currDC.actual_container)
-                self.SdkObject.SDKDeleteContainer(currDC.actual_container)
-            currDC.delete()
+            self._delete_dc(currDC)
 
         if currR.desired_container.current_state != DesiredContainer.State.FAILED:
             self.SdkObject.SDKProgramRoute(currR)
@@ -670,125 +2662,425 @@ class ConsistentHash:
         
     def del_route(self, route: Route):
 
-        self._lock.acquire()
-        
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.delete(self._now(), route)
+            self._del_route(route)
+        finally:
+            self._unlock()
+
+    def del_routes_in(self, supernet):
+
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.delete_in(self._now(), supernet)
+            self._begin_batch()
+
+            routes = list(self.Routes.covered_by(supernet))
+            for r in routes:
+                self._del_route(r)
+        finally:
+            self._end_batch()
+            self._unlock()
+
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "supernet=%s deleted=%d", supernet, len(routes))
+
+        return len(routes)
+
+    def _del_route(self, route: Route):
+
         currR: Route
         currDC: DesiredContainer
 
-        self._log.log(_TRACE_LEVEL, "route=%s", str(route))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "route=%s", route)
 
-        if route.prefix in self.Routes.prefixes():
-            
+        currR = self.Routes.get(route.prefix)
 
-            currR = self.Routes[route.prefix]
-            currDC = currR.desired_container
+        if currR:
+            if self._dampener is not None:
+                self._dampener.flap(route.prefix.hashable, self._timers.now())
 
-            currDC.ref_count -= 1
+            # withdrawn whatever the state, a failed container can still have
+            # the route programmed through the one it had before
+            currDC = currR.desired_container
+            self.SdkObject.SDKUnprogramRoute(currR)
+            currR.desired_container = None
+            self.Routes.pop(route.prefix)
 
             if currDC.ref_count == 0:
-                self.DesiredContainers.remove(currDC)
-
-                if currDC.actual_container != None:
-                    self.ActualContainers.s.remove(currDC.actual_container)
-                    self.SdkObject.SDKDeleteContainer(currDC.actual_container)
-    
-                currDC.delete()
+                self._delete_dc(currDC)
                 self._periodic(lock = False)
-            
-            self.Routes.remove(currR)
-        
-        self._lock.release()
+
+            return True
+
+        return False
 
     def _periodic(self, lock = True):
 
         if lock:
-            self._lock.acquire()
+            self._acquire()
+        elif self._batch:
+            # the batch runs a single pass once it is applied
+            self._periodic_pending = True
+            return
 
-        self._log.log(_TRACE_LEVEL, "Periodic: timer=%d", self._current_time)
+        try:
+            if _tracing:
+                self._log.log(_TRACE_LEVEL, "Periodic: timer=%.3f", self._now())
+
+            if self._system_resolved != self.SystemResolved.RESOLVED:
+                self._optimize_not_resolved()
+                self._check_for_resolution()
+            if self._system_stable != self.SystemState.STABLE:
+                self._check_for_stable()
+        finally:
+            if lock:
+                self._unlock()
+
+    def _arm_timers(self):
+
+        # called with the lock held whenever the system state may have changed
+        if self._freeze:
+            return
 
         if self._system_resolved != self.SystemResolved.RESOLVED:
-            self._optimize_not_resolved()
-            self._check_for_resolution()
+            if self._retry_timer is None:
+                self._retry_timer = self._timers.schedule(self._retry_interval, self._on_retry_timer)
+            return
+
+        self._retry_interval = self._periodic_timer
+
         if self._system_stable != self.SystemState.STABLE:
-            self._check_for_stable()
+            if self._consistent_adm:
+                deadline = self._stable_deadline
+            else:
+                deadline = self._timers.now()
 
-        if lock:
-            self._lock.release()
+            if self._stable_timer is None or self._stable_timer.deadline != deadline:
+                if self._stable_timer:
+                    self._stable_timer.cancel()
+                self._stable_timer = self._timers.schedule_at(deadline, self._on_stable_timer)
 
+    def _on_retry_timer(self):
 
-    def _periodic_tick(self):
-        
-        if self._running:
-            self._sched.enter(1, 1, self._periodic_tick)
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.tick(self._now())
 
-            self._current_time += self._timer_tick
+            self._retry_timer = None
 
-            if self._freeze == False:
-                if self._current_time - self._last_periodic  >= self._periodic_timer:
-                    self._last_periodic = self._current_time
-                    self._periodic()
-        
+            if not self._freeze:
+                unresolved = self.DesiredContainers.unresolved_count
+                self._periodic(lock = False)
+
+                # back off while a pass makes no progress
+                if self.DesiredContainers.unresolved_count >= unresolved:
+                    self._retry_interval = min(self._retry_interval * 2, self._retry_max)
+                else:
+                    self._retry_interval = self._periodic_timer
+        finally:
+            self._unlock()
+
+    def _on_stable_timer(self):
+
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.tick(self._now())
+
+            self._stable_timer = None
+
+            if not self._freeze:
+                self._periodic(lock = False)
+        finally:
+            self._unlock()
 
     def run(self):
         self._running = True
-        self._timer_thread.start()
+        self._timers.start()
    
 
     def stop(self):
         self._running = False
+        self._timers.stop()
+        self.SdkObject.flush()
+        if self._journal is not None:
+            self._journal.flush()
 
 
     def freeze(self):
-        self._freeze = True
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.freeze(self._now(), True)
+            self._freeze = True
+        finally:
+            self._unlock()
 
     def unfreeze(self):
-        self._freeze = False
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.freeze(self._now(), False)
+            self._freeze = False
+        finally:
+            self._unlock()
+
+    def checkpoint(self, path):
+        # writes the engine state for restore(). Flap dampening history is
+        # not kept, suppressed routes start over after a restore.
+        self._acquire()
+        try:
+            self.SdkObject.flush()
+            head, arrays = self._dump_state()
+        finally:
+            self._unlock()
+        ck.write_checkpoint(path, head, arrays)
+
+    @classmethod
+    def restore(cls, path, **options):
+        # engine from a checkpoint, taking over the containers the SDK still
+        # holds: only what differs from the SDK is written. The prefix index,
+        # the route sets of the desired containers, the prefix tries and the
+        # snapshot are built when first used.
+        head, arrays = ck.read_checkpoint(path)
+        same_random = "seed" not in options
+        options.setdefault("compact_routes", head[7])
+        options.setdefault("seed", head[10])
+
+        ch = cls(**options)
+        ch._acquire()
+        try:
+            ch._load_state(head, arrays, same_random)
+        finally:
+            ch._unlock()
+        return ch
+
+    def _dump_state(self):
+        a = {name: array.array(code) for name, code in ck.ARRAYS}
+        sdk = self.SdkObject
+
+        acs = sorted(self.ActualContainers, key = lambda ac: ac.sid)
+        dcs = sorted(self.DesiredContainers, key = lambda dc: dc.sid)
+        ac_index = {ac: i for i, ac in enumerate(acs)}
+        dc_index = {dc: i for i, dc in enumerate(dcs)}
+
+        used = 0
+        for ac in acs:
+            used |= ac.nh_set.s.bits
+            for m in ac.members:
+                if m is not None:
+                    used |= 1 << m
+        for dc in dcs:
+            used |= dc.nh_set.bits
+
+        a["nh_off"].append(0)
+        for i in NexthopSet(used).ids():
+            a["nh_id"].append(i)
+            a["nh_addr"].frombytes(_nh_registry.address(i).packed)
+            a["nh_off"].append(len(a["nh_addr"]))
+
+        for name in ("ac_nh_off", "ac_mem_off", "ac_bkt_off", "dc_nh_off"):
+            a[name].append(0)
+
+        for ac in acs:
+            a["ac_sid"].append(ac.sid)
+            a["ac_flags"].append(ac.consistent | ac.resolved << 1)
+            a["ac_block"].append(-1 if ac.block is None else ac.block)
+            a["ac_size"].append(sdk.charged(ac))
+            a["ac_users"].append(ac.users)
+            a["ac_dc"].append(dc_index[ac.desired_container] if ac.desired_container is not None else -1)
+            a["ac_nh"].extend(ac.nh_set.s.ids())
+            a["ac_nh_off"].append(len(a["ac_nh"]))
+            a["ac_mem"].extend(ck.NO_MEMBER if m is None else m for m in ac.members)
+            a["ac_mem_off"].append(len(a["ac_mem"]))
+            a["ac_bkt"].frombytes(memoryview(ac._buckets).cast("B"))
+            a["ac_bkt_off"].append(len(a["ac_bkt"]))
+
+        for dc in dcs:
+            a["dc_sid"].append(dc.sid)
+            a["dc_state"].append(dc.current_state.value)
+            a["dc_ac"].append(ac_index[dc.actual_container] if dc.actual_container is not None else -1)
+            a["dc_father"].append(dc_index[dc.father] if dc.father is not None else -1)
+            a["dc_nh"].extend(dc.nh_set.ids())
+            a["dc_nh_off"].append(len(a["dc_nh"]))
+
+        counts = [0] * len(dcs)
+        sums = [0] * len(dcs)
+        hi, lo, meta, slots = a["rt_hi"], a["rt_lo"], a["rt_meta"], a["rt_dc"]
+        for k, dc in self.Routes.dc_items():
+            i = dc_index[dc]
+            net = k >> 9
+            hi.append(net >> 64)
+            lo.append(net & ck.MASK)
+            meta.append(k & 0x1FF)
+            slots.append(i)
+            counts[i] += 1
+            sums[i] += k
+        a["dc_routes"].extend(counts)
+
+        # digest of the routes programmed to each container, restore compares
+        # it with the one the SDK reports
+        ac_count = [0] * len(acs)
+        ac_sum = [0] * len(acs)
+        for i, dc in enumerate(dcs):
+            if dc.actual_container is not None and dc.current_state != DesiredContainer.State.FAILED:
+                j = ac_index[dc.actual_container]
+                ac_count[j] += counts[i]
+                ac_sum[j] += sums[i]
+        a["ac_count"].extend(ac_count)
+        a["ac_sum"].extend(s & ck.MASK for s in ac_sum)
+
+        a["rng"].extend(self._random.getstate()[1])
+
+        memory = sdk._memory + sdk.used if sdk._accountant is None and sdk._allocator is None else 0
+        head = (ck.MAGIC, sys.byteorder == "little", array.array("l").itemsize, self._consistent_adm,
+                self._system_resolved.value, self._system_stable.value, self._freeze,
+                isinstance(self.Routes, CompactRouteContainer), self._now() - self._last_resolved,
+                self._retry_interval, self._seed, memory, _container_ids.peek())
+        return head, a
+
+    def _load_state(self, head, a, same_random):
+        adm, resolved, stable, frozen, _, age, retry, _, memory, next_id = head[3:]
+        sdk = self.SdkObject
+
+        ids = {}
+        off, addr = a["nh_off"], a["nh_addr"]
+        for n, i in enumerate(a["nh_id"]):
+            ids[i] = _nh_registry.intern(ipaddress.ip_address(addr[off[n]:off[n + 1]].tobytes()))
+
+        def sets(offs, flat):
+            out = []
+            for n in range(len(offs) - 1):
+                bits = 0
+                for i in flat[offs[n]:offs[n + 1]]:
+                    bits |= 1 << ids[i]
+                out.append(NexthopSet(bits))
+            return out
+
+        if sdk._accountant is None and sdk._allocator is None:
+            sdk._memory = memory
+
+        acs = []
+        mem_off, mem, bkt_off, bkt = a["ac_mem_off"], a["ac_mem"], a["ac_bkt_off"], a["ac_bkt"]
+        for n, nhset in enumerate(sets(a["ac_nh_off"], a["ac_nh"])):
+            ac = ActualContainer(self._log)
+            ac._sid = a["ac_sid"][n]
+            ac.consistent = bool(a["ac_flags"][n] & 1)
+            ac.resolved = bool(a["ac_flags"][n] & 2)
+            ac.block = a["ac_block"][n] if a["ac_block"][n] >= 0 else None
+            ac.users = a["ac_users"][n]
+            ac.nh_set = nhset
+            ac._members = [None if i == ck.NO_MEMBER else ids[i] for i in mem[mem_off[n]:mem_off[n + 1]]]
+            ac._buckets = _bucket_table(_bucket_code(len(ac._members)), bkt[bkt_off[n]:bkt_off[n + 1]].tobytes())
+            sdk.SDKAdopt(ac, a["ac_size"][n])
+            self._add_ac(ac)
+            acs.append(ac)
+
+        dcs = []
+        for n, nhset in enumerate(sets(a["dc_nh_off"], a["dc_nh"])):
+            dc = self._new_dc()
+            dc._sid = a["dc_sid"][n]
+            if dc._store is None:
+                dc._routes = None
+            dc._nh_set = pSet(nhset)
+            dc._current_state = DesiredContainer.State(a["dc_state"][n])
+            dc._ac = acs[a["dc_ac"][n]] if a["dc_ac"][n] >= 0 else None
+            dcs.append(dc)
+
+        for dc, f in zip(dcs, a["dc_father"]):
+            if f >= 0:
+                dc.father = dcs[f]
+                dcs[f].child_set.add(dc)
+        for ac, i in zip(acs, a["ac_dc"]):
+            ac.desired_container = dcs[i] if i >= 0 else None
+        for dc in dcs:
+            self.DesiredContainers.add(dc)
+
+        self.Routes.load_columns(a["rt_hi"], a["rt_lo"], a["rt_meta"], a["rt_dc"], dcs, a["dc_routes"])
+        self.DesiredContainers._route_source = self.Routes
+
+        # restored containers keep their ids, new ones are numbered after them
+        _container_ids.reserve(max(itertools.chain(a["ac_sid"], a["dc_sid"], (next_id - 1,))))
+
+        expected = {ac.sid: (c, s) for ac, c, s in zip(acs, a["ac_count"], a["ac_sum"]) if c}
+
+        def routes_of(sids):
+            want = {sid: set() for sid in sids}
+            unplaced = set()
+            target = {dc: dc.actual_container.sid for dc in dcs
+                      if dc.actual_container is not None and dc.current_state != DesiredContainer.State.FAILED}
+            for k, dc in self.Routes.dc_items():
+                sid = target.get(dc)
+                if sid is None:
+                    unplaced.add(k)
+                elif sid in want:
+                    want[sid].add(k)
+            return want, unplaced
+
+        sdk.SDKReconcile(acs, expected, routes_of)
+
+        self._consistent_adm = adm
+        self._system_resolved = self.SystemResolved(resolved)
+        self._system_stable = self.SystemState(stable)
+        self._freeze = frozen
+        self._resolved_at(self._now() - age)
+        self._retry_interval = retry
+        if same_random:
+            self._random.setstate((3, tuple(a["rng"]), None))
+
+        if _tracing:
+            self._log.log(logging.DEBUG, "restored acs=%d dcs=%d routes=%d", len(acs), len(dcs), len(a["rt_dc"]))
+
+    def _new_dc(self):
+        store = self.Routes if isinstance(self.Routes, CompactRouteContainer) else None
+        return DesiredContainer(self._log, store)
 
     def _allocate_new_ac(self, dc: DesiredContainer):
         ac: ActualContainer
 
-        self._log.log(_TRACE_LEVEL, "dc= %s", str(dc))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "dc= %s", dc)
 
         ac = self._create_new_ac(dc.nh_set, True)
 
-        if ac and ac.resolved:
+        if ac and ac.resolved and ac.nh_set.s == dc.nh_set:
             dc.current_state = DesiredContainer.State.RESOLVED
-            dc.actual_container = ac
-            self.ActualContainers.s.add(ac)
+            self._use_ac(dc, ac)
 
-            ac.desired_container = dc
-
-            self._log.log(_TRACE_LEVEL, "creating new ac: ac= %s", str(ac))
+            if _tracing:
+                self._log.log(_TRACE_LEVEL, "creating new ac: ac= %s", ac)
 
             return ac
         else:
-            self._system_resolved = False
+            self._system_resolved = self.SystemResolved.NOT_RESOLVED
             if self._system_stable == self.SystemState.STABLE:
                 self._system_stable = self.SystemState.NON_STABLE
                 self._clean_stable_state()
                 self._optimize_non_stable()
-                self._last_resolved = self._now()
-                self._log.log(_TRACE_LEVEL, "system state change: %s", str(self))
+                self._resolved_at(self._now())
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "system state change: %s", self)
 
             if ac:
 
-                dc.actual_container = ac
-
-                if ac.resolved:
-                    dc.current_state = dc.State.RESOLVED
-                else:
-                    dc.current_state = dc.State.PARTIAL
-                self.ActualContainers.s.add(ac)
+                dc.current_state = dc.State.PARTIAL
+                self._use_ac(dc, ac)
 
-                ac.desired_container = dc
-
-                self._log.log(_TRACE_LEVEL, "creating new ac: ac= %s", str(ac))
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "creating new ac: ac= %s", ac)
 
                 return ac
 
         dc.current_state = dc.State.FAILED
 
-        self._log.log(_TRACE_LEVEL, "AC alloction failed for dc=%s", str(dc))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "AC alloction failed for dc=%s", dc)
 
         return None
 
@@ -804,20 +3096,37 @@ class ConsistentHash:
     def _create_new_ac(self, nhset, fallback: bool, force_partial = False):
         ac: ActualContainer
 
-        self._log.log(_TRACE_LEVEL, "nhset=%s fallback=%s force_partial=%s", str(pSet(nhset)), str(fallback), str(force_partial))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "nhset=%s fallback=%s force_partial=%s", pSet(nhset), fallback, force_partial)
 
 
         if force_partial == False:
             ac = self.SdkObject.SDKCreateContainer(nhset, self._consistent_adm)
+            if ac is None and self.SdkObject.SDKDefragment(nhset, self._consistent_adm):
+                ac = self.SdkObject.SDKCreateContainer(nhset, self._consistent_adm)
             if ac:
                 ac.nh_set = nhset
                 ac.resolved = True
                 return ac
         
         if fallback:
-            any_nh_id = random.randint(0, len(nhset)-1)
-            any_nh = pSet(set())
-            any_nh.s.add(list(nhset)[any_nh_id])
+            nhset = NexthopSet.of(nhset)
+
+            # share the widest programmed container we can use, costs nothing.
+            # Only containers holding one of our next hops can qualify
+            best = None
+            for i in nhset.ids():
+                for ac in self._shared_by_nh.get(i, ()):
+                    if ac.nh_set.s.issubset(nhset):
+                        if best is None or (len(ac.nh_set.s), best.sid) > (len(best.nh_set.s), ac.sid):
+                            best = ac
+            if best is not None:
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "sharing ac %s", best.nh_set)
+                return best
+
+            any_nh_id = self._random.randint(0, len(nhset)-1)
+            any_nh = NexthopSet(1 << list(nhset.ids())[any_nh_id])
 
             ac = self.SdkObject.SDKCreateContainer(any_nh, False)
             if ac:
@@ -838,99 +3147,162 @@ class ConsistentHash:
 
     def _optimize_non_stable(self):
 
-        for dc in self.DesiredContainers:
-            equal = [dc1 for dc1 in self.DesiredContainers if dc1.nh_set == dc.nh_set]
-            programmed = [dc1 for dc1 in equal if dc1.current_state != DesiredContainer.State.FAILED]
+        # one pass over the next hop index, each group of equal containers
+        # is merged into its best programmed member
+        for equal in self.DesiredContainers.duplicates():
 
-            if len(equal) == 1:
-                continue
-            
-            if len(programmed) == 0:
-                return
+            c_dc = min(equal, key = lambda dc: (self._merge_rank[dc.current_state], dc.sid))
 
-            c_dc = programmed[0]
+            for dc1 in equal:
+                if dc1 is c_dc:
+                    continue
 
-            equal = equal.pop(c_dc)
+                keys = list(dc1.route_keys)
+                for k in keys:
+                    self.Routes.by_key(k).desired_container = c_dc
 
-            for dc1 in equal:
-                if dc1.current_state != DesiredContainer.State.FAILED:
-                    self.SdkObject.SDKReplaceContainer(dc1.AC, c_dc.AC)
-                routes = [route for route in self.Routes if route.desired_container == dc1]
-                for route in routes:
-                    route.desired_container = dc
-                    dc.ref_count += 1
-
-                if dc1.actual_container != None:
-                    self.ActualContainers.s.remove(dc1.actual_container)
-                    self.SdkObject.SDKDeleteContainer(dc1.actual_container)
-                    dc1.actual_container.delete()
-                 
-                dc1.delete()
+                if c_dc.current_state != DesiredContainer.State.FAILED:
+                    self._reprogram(keys, dc1.actual_container, c_dc.actual_container)
+
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "merging d_cont %s into %s", dc1, c_dc)
+
+                self._delete_dc(dc1)
+
+    def _delete_dc(self, dc: DesiredContainer):
+
+        if dc not in self.DesiredContainers:
+            return
+
+        self.DesiredContainers.remove(dc)
+
+        if dc.actual_container != None:
+            self._release_ac(dc, dc.actual_container)
+
+        dc.delete()
+
+    def _use_ac(self, dc: DesiredContainer, ac: ActualContainer):
+        dc.actual_container = ac
+        if ac.users == 0:
+            ac.desired_container = dc
+            self._add_ac(ac)
+        ac.users += 1
+
+    def _release_ac(self, dc: DesiredContainer, ac: ActualContainer):
+        # containers shared by several desired containers are freed with the last user
+        ac.users -= 1
+        if ac.desired_container is dc:
+            ac.desired_container = None
+        if ac.users > 0:
+            return
+
+        self._remove_ac(ac)
+        self.SdkObject.SDKDeleteContainer(ac)
+        ac.delete()
+
+    def _add_ac(self, ac: ActualContainer):
+        self.ActualContainers.s.add(ac)
+        if ac.resolved:
+            for i in ac.nh_set.s.ids():
+                self._shared_by_nh.setdefault(i, set()).add(ac)
+
+    def _remove_ac(self, ac: ActualContainer):
+        self.ActualContainers.s.remove(ac)
+        if ac.resolved:
+            for i in ac.nh_set.s.ids():
+                acs = self._shared_by_nh[i]
+                acs.discard(ac)
+                if not acs:
+                    del self._shared_by_nh[i]
 
-            
     def _optimize_not_resolved(self):
 
         dc: DesiredContainer
 
-        self._log.log(_TRACE_LEVEL,"enter")
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "enter")
 
-        for dc in self.DesiredContainers:
-            if dc.current_state == DesiredContainer.State.RESOLVED:
-                continue
+        for dc in self.DesiredContainers.unresolved():
             old_ac = dc.actual_container
             ac = self._create_new_ac(dc.nh_set, fallback = False)
             if ac:
 
-                self.SdkObject.SDKReplaceContainer(dc.actual_container, ac)
-                dc.actual_container = ac
                 dc.current_state = DesiredContainer.State.RESOLVED
-
-                self.ActualContainers.s.add(ac)
+                self._use_ac(dc, ac)
+                self._reprogram(dc.route_keys, old_ac, ac)
 
                 #TODO add the check
                 if old_ac:
-                    self.ActualContainers.s.remove(old_ac)
-                    self.SdkObject.SDKDeleteContainer(old_ac)
-                    old_ac.delete()
+                    self._release_ac(dc, old_ac)
+
+    def _reprogram(self, keys, old_ac: ActualContainer, ac: ActualContainer):
+        # the routes `keys` forward through ac from now on. A replace moves
+        # every route of old_ac, so it is only used when they all belong to
+        # this group. A failed group had no container and a shared one keeps
+        # forwarding its other users, the routes are programmed one by one.
+        if old_ac is ac:
+            return
+        if old_ac is not None and old_ac.users == 1:
+            self.SdkObject.SDKReplaceContainer(old_ac, ac)
+            return
+        for k in keys:
+            self.SdkObject.SDKProgramRoute(self.Routes.by_key(k))
 
     def _check_for_resolution(self):
         if self._system_resolved != self.SystemResolved.RESOLVED:
-            non_resolved = [dc for dc in self.DesiredContainers if dc.current_state != DesiredContainer.State.RESOLVED]
-
-            if len(non_resolved) == 0:
+            if self.DesiredContainers.unresolved_count == 0:
                 self._system_resolved = self.SystemResolved.RESOLVED
-                self._last_resolved = self._now()  
-                self._log.log(_TRACE_LEVEL, "State resolved time=%d", self._current_time)      
+                self._resolved_at(self._now())
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "State resolved time=%.3f", self._now())
 
 
+    def _resolved_at(self, t):
+        # the stable timer and the stable check compare the clock with this
+        # one deadline, working it out again from t can round below it
+        self._last_resolved = t
+        self._stable_deadline = self._start_time + t + self._long_period_of_time
+
     def _check_for_stable(self):
 
-        self._log.log(_TRACE_LEVEL, "%s", str(self))
+        if _tracing:
+            self._log.log(_TRACE_LEVEL, "%s", self)
         if self._system_stable != self.SystemState.STABLE:
             if (self._system_resolved == self.SystemResolved.RESOLVED) and \
-                ((self._now() - self._last_resolved >= self._long_period_of_time) or self._consistent_adm == False):
+                ((self._timers.now() >= self._stable_deadline) or self._consistent_adm == False):
 
                 self._system_stable = self.SystemState.STABLE
-                self._log.log(_TRACE_LEVEL, "State stable time=%d", self._current_time)
+                if _tracing:
+                    self._log.log(_TRACE_LEVEL, "State stable time=%.3f", self._now())
     
     def set_admin_state(self, consistent_adm):
         if self._consistent_adm == consistent_adm:
             return
-        
-        self._consistent_adm = consistent_adm
 
-        self._system_resolved = self.SystemResolved.NOT_RESOLVED
-        self._system_stable = self.SystemState.NON_STABLE
+        self._acquire()
+        try:
+            if self._journal is not None:
+                self._journal.admin(self._now(), consistent_adm)
 
-        for dc in self.DesiredContainers:
-            dc.current_state = DesiredContainer.State.REALLOCATE
+            self._consistent_adm = consistent_adm
+
+            self._system_resolved = self.SystemResolved.NOT_RESOLVED
+            self._system_stable = self.SystemState.NON_STABLE
+
+            # failed containers have nothing to reallocate and must stay failed,
+            # routes joining them later are not programmed
+            for dc in self.DesiredContainers:
+                if dc.actual_container is not None:
+                    dc.current_state = DesiredContainer.State.REALLOCATE
+        finally:
+            self._unlock()
 
 
     def __str__(self):
         return str(vars(self))
 
     def _now(self):
-        return self._current_time
+        return self._timers.now() - self._start_time
 
 
 
@@ -0,0 +1,254 @@
+import bisect
+
+
+class BestFitAllocator:
+    # ECMP member table of `size` entries, blocks are rounded up to `granule`
+    # entries and placed in the smallest hole that fits
+
+    def __init__(self, size, granule = 1):
+        self._size = size
+        self._granule = granule
+        self._holes = [(0, size)] if size > 0 else []   # (offset, length) sorted by offset
+        self._blocks = {}
+        self._free = size
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def free(self):
+        return self._free
+
+    @property
+    def largest_free(self):
+        return max((ln for off, ln in self._holes), default = 0)
+
+    @property
+    def holes(self):
+        return len(self._holes)
+
+    @property
+    def fragmentation(self):
+        return 1 - self.largest_free / self._free if self._free else 0.0
+
+    def block_size(self, n):
+        return -(-n // self._granule) * self._granule
+
+    def length(self, off):
+        return self._blocks[off]
+
+    def reserve(self, n):
+        n = self.block_size(n)
+        best = None
+        for i, (off, ln) in enumerate(self._holes):
+            if ln >= n and (best is None or ln < self._holes[best][1]):
+                best = i
+                if ln == n:
+                    break
+        if best is None:
+            return None
+
+        off, ln = self._holes[best]
+        if ln == n:
+            del self._holes[best]
+        else:
+            self._holes[best] = (off + n, ln - n)
+
+        self._blocks[off] = n
+        self._free -= n
+        return off
+
+    def reserve_at(self, off, n):
+        # a block at a known offset (restore), None if it is not free
+        n = self.block_size(n)
+        i = bisect.bisect(self._holes, (off, self._size + 1)) - 1
+        if i < 0:
+            return None
+        h_off, h_len = self._holes[i]
+        if off + n > h_off + h_len:
+            return None
+
+        parts = [(h_off, off - h_off), (off + n, h_off + h_len - off - n)]
+        self._holes[i:i + 1] = [h for h in parts if h[1] > 0]
+
+        self._blocks[off] = n
+        self._free -= n
+        return off
+
+    def release(self, off):
+        n = self._blocks.pop(off)
+        self._free += n
+
+        i = bisect.bisect(self._holes, (off, 0))
+        if i < len(self._holes) and off + n == self._holes[i][0]:
+            n += self._holes.pop(i)[1]
+        if i > 0 and self._holes[i - 1][0] + self._holes[i - 1][1] == off:
+            off, ln = self._holes[i - 1]
+            n += ln
+            i -= 1
+            del self._holes[i]
+        self._holes.insert(i, (off, n))
+
+    def compact(self):
+        # slide every block to the start of the table, returns {old: new} in
+        # offset order: a block only moves down, onto free entries or entries
+        # of blocks moved before it
+        moves = {}
+        blocks = {}
+        pos = 0
+        for off in sorted(self._blocks):
+            n = self._blocks[off]
+            if off != pos:
+                moves[off] = pos
+            blocks[pos] = n
+            pos += n
+        self._blocks = blocks
+        self._holes = [(pos, self._size - pos)] if pos < self._size else []
+        return moves
+
+
+class BuddyAllocator:
+    # ECMP member table of `size` entries split in power of two blocks of at
+    # least `min_block` entries
+
+    def __init__(self, size, min_block = 1):
+        self._size = size
+        self._min_block = min_block
+        units = size // min_block
+        self._orders = units.bit_length()
+        self._free_lists = [set() for _ in range(self._orders + 1)]
+        self._blocks = {}
+        self._free = units * min_block
+
+        off = 0
+        for order in range(self._orders, -1, -1):
+            if units & (1 << order):
+                self._free_lists[order].add(off)
+                off += 1 << order
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def free(self):
+        return self._free
+
+    @property
+    def largest_free(self):
+        for order in range(self._orders, -1, -1):
+            if self._free_lists[order]:
+                return (1 << order) * self._min_block
+        return 0
+
+    @property
+    def holes(self):
+        return sum(len(l) for l in self._free_lists)
+
+    @property
+    def fragmentation(self):
+        return 1 - self.largest_free / self._free if self._free else 0.0
+
+    def _order(self, n):
+        return max(0, (-(-n // self._min_block) - 1).bit_length())
+
+    def block_size(self, n):
+        return (1 << self._order(n)) * self._min_block
+
+    def length(self, off):
+        return (1 << self._blocks[off // self._min_block]) * self._min_block
+
+    def reserve(self, n):
+        want = self._order(n)
+        order = want
+        while order <= self._orders and not self._free_lists[order]:
+            order += 1
+        if order > self._orders:
+            return None
+
+        off = self._free_lists[order].pop()
+        while order > want:
+            order -= 1
+            self._free_lists[order].add(off + (1 << order))
+
+        self._blocks[off] = want
+        self._free -= (1 << want) * self._min_block
+        return off * self._min_block
+
+    def reserve_at(self, off, n):
+        # a block at a known offset (restore), None if it is not free
+        want = self._order(n)
+        unit = off // self._min_block
+        if unit & ((1 << want) - 1) or off % self._min_block:
+            return None
+
+        order = want
+        while order <= self._orders:
+            base = unit & ~((1 << order) - 1)
+            if base in self._free_lists[order]:
+                break
+            order += 1
+        else:
+            return None
+
+        self._free_lists[order].remove(base)
+        while order > want:
+            order -= 1
+            half = base + (1 << order)
+            if unit >= half:
+                self._free_lists[order].add(base)
+                base = half
+            else:
+                self._free_lists[order].add(half)
+
+        self._blocks[unit] = want
+        self._free -= (1 << want) * self._min_block
+        return off
+
+    def release(self, off):
+        off //= self._min_block
+        order = self._blocks.pop(off)
+        self._free += (1 << order) * self._min_block
+
+        while order < self._orders:
+            buddy = off ^ (1 << order)
+            if buddy not in self._free_lists[order]:
+                break
+            self._free_lists[order].remove(buddy)
+            off = min(off, buddy)
+            order += 1
+        self._free_lists[order].add(off)
+
+    def compact(self):
+        # re-place the blocks in offset order, each in the lowest free slot
+        # of its size. That slot is never above the block, so like a slide
+        # the moves, returned as {old: new} in that order, only write over
+        # free entries or entries of blocks moved before.
+        blocks = sorted(self._blocks.items())
+        self.__init__(self._size, self._min_block)
+
+        moves = {}
+        for off, order in blocks:
+            new = self._reserve_lowest(order)
+            if new != off:
+                moves[off * self._min_block] = new * self._min_block
+        return moves
+
+    def _reserve_lowest(self, want):
+        best = None
+        for order in range(want, self._orders + 1):
+            if self._free_lists[order]:
+                off = min(self._free_lists[order])
+                if best is None or off < best[0]:
+                    best = (off, order)
+
+        off, order = best
+        self._free_lists[order].remove(off)
+        while order > want:
+            order -= 1
+            self._free_lists[order].add(off + (1 << order))
+
+        self._blocks[off] = want
+        self._free -= (1 << want) * self._min_block
+        return off
@@ -0,0 +1,174 @@
+import random
+
+import pytest
+
+from consistent_alloc import BestFitAllocator, BuddyAllocator
+
+
+def _free_runs(alloc, offsets, size):
+    # (offset, length) of every run left free by the blocks at offsets
+    taken = bytearray(size)
+    for off in offsets:
+        n = alloc.length(off)
+        assert not any(taken[off:off + n]), "blocks overlap at %d" % off
+        taken[off:off + n] = b"\1" * n
+    runs = []
+    off = 0
+    while off < size:
+        if taken[off]:
+            off += 1
+            continue
+        end = off
+        while end < size and not taken[end]:
+            end += 1
+        runs.append((off, end - off))
+        off = end
+    return runs
+
+
+def test_bestfit_takes_the_smallest_hole():
+    a = BestFitAllocator(100)
+    blocks = [a.reserve(10) for _ in range(10)]
+    assert blocks == list(range(0, 100, 10))
+    assert a.reserve(1) is None
+
+    a.release(10)           # hole of 10
+    a.release(40)
+    a.release(50)           # hole of 20
+    assert a.holes == 2
+
+    assert a.reserve(8) == 10
+    assert a.reserve(15) == 40
+    assert a.free == 30 - 8 - 15
+
+
+def test_bestfit_release_merges_neighbours():
+    a = BestFitAllocator(60, granule = 4)
+    offs = [a.reserve(n) for n in (3, 9, 4, 5)]
+    assert offs == [0, 4, 16, 20]
+    assert [a.length(o) for o in offs] == [4, 12, 4, 8]
+
+    a.release(4)
+    a.release(20)
+    assert a.holes == 2
+    a.release(16)
+    assert a._holes == [(4, 56)]
+    assert a.largest_free == 56
+    assert a.fragmentation == 0.0
+
+
+def test_bestfit_reserve_at_splits_a_hole():
+    a = BestFitAllocator(64)
+    assert a.reserve_at(10, 6) == 10
+    assert a._holes == [(0, 10), (16, 48)]
+    assert a.reserve_at(12, 2) is None          # taken
+    assert a.reserve_at(8, 4) is None           # runs into the block
+    assert a.reserve_at(60, 8) is None          # past the end
+    assert a.reserve_at(0, 10) == 0
+    assert a._holes == [(16, 48)]
+    assert a.free == 48
+
+
+def test_bestfit_compact_slides_blocks_down():
+    a = BestFitAllocator(40)
+    offs = [a.reserve(n) for n in (5, 5, 5, 5, 5)]
+    a.release(offs[1])
+    a.release(offs[3])
+    assert a.largest_free == 15
+    assert a.fragmentation == pytest.approx(1 - 15 / 25)
+
+    moves = a.compact()
+    assert moves == {10: 5, 20: 10}
+    assert sorted(a._blocks) == [0, 5, 10]
+    assert a._holes == [(15, 25)]
+    assert a.fragmentation == 0.0
+    assert a.reserve(25) == 15
+
+
+def test_buddy_rounds_to_powers_of_two():
+    a = BuddyAllocator(64, min_block = 4)
+    assert [a.block_size(n) for n in (1, 4, 5, 8, 9, 33)] == [4, 4, 8, 8, 16, 64]
+
+    off = a.reserve(5)
+    assert a.length(off) == 8
+    assert a.free == 56
+    assert a.holes == 3                 # 8, 16 and 32 left of the split
+
+
+def test_buddy_release_merges_buddies():
+    a = BuddyAllocator(64)
+    offs = [a.reserve(16) for _ in range(4)]
+    assert sorted(offs) == [0, 16, 32, 48]
+    assert a.reserve(1) is None
+
+    for off in offs:
+        a.release(off)
+    assert a.holes == 1
+    assert a.largest_free == 64
+
+
+def test_buddy_reserve_at_needs_an_aligned_free_block():
+    a = BuddyAllocator(64, min_block = 2)
+    assert a.reserve_at(8, 8) == 8
+    assert a.reserve_at(4, 8) is None           # not aligned to its size
+    assert a.reserve_at(9, 2) is None           # not on a unit
+    assert a.reserve_at(12, 4) is None          # inside the block at 8
+    assert a.reserve_at(0, 8) == 0
+    assert a.reserve_at(32, 32) == 32
+    assert a.free == 64 - 48
+    assert _free_runs(a, [0, 8, 32], 64) == [(16, 16)]
+
+
+def test_buddy_compact_slides_blocks_down():
+    a = BuddyAllocator(64)
+    held = [a.reserve(n) for n in (2, 4, 2, 8, 2, 16, 2)]
+    for off in held[::2]:
+        a.release(off)
+    held = held[1::2]
+    before = {off: a.length(off) for off in held}
+    assert a.largest_free == 16
+
+    moves = a.compact()
+    assert list(moves) == sorted(moves)
+    assert all(new < old for old, new in moves.items())
+    after = {moves.get(off, off): n for off, n in before.items()}
+    assert sorted(after) == [0, 8, 16]
+    assert {off: a.length(off) for off in after} == after
+    assert _free_runs(a, after, 64) == [(4, 4), (32, 32)]
+    assert a.largest_free == 32
+
+
+def _unsafe_moves(lengths, moves):
+    # moves, applied in order, that write over a block still in place
+    live = dict(lengths)
+    bad = []
+    for old, new in moves.items():
+        n = live.pop(old)
+        if any(o < new + n and new < o + m for o, m in live.items()):
+            bad.append((old, new))
+        live[new] = n
+    return bad
+
+
+@pytest.mark.parametrize("make", [lambda: BestFitAllocator(256, granule = 2), lambda: BuddyAllocator(256, min_block = 2)],
+                         ids = ["bestfit", "buddy"])
+def test_random_reserve_release_keeps_the_table_consistent(make):
+    rnd = random.Random(5)
+    a = make()
+    held = []
+    for _ in range(2000):
+        if held and rnd.random() < 0.45:
+            a.release(held.pop(rnd.randrange(len(held))))
+        else:
+            off = a.reserve(rnd.randint(1, 24))
+            if off is not None:
+                held.append(off)
+        if rnd.random() < 0.02:
+            lengths = {off: a.length(off) for off in held}
+            moves = a.compact()
+            assert _unsafe_moves(lengths, moves) == []
+            held = [moves.get(off, off) for off in held]
+
+        runs = _free_runs(a, held, 256)
+        assert a.free == sum(n for _, n in runs)
+        assert a.largest_free <= max((n for _, n in runs), default = 0)
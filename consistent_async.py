@@ -0,0 +1,117 @@
+import asyncio
+import logging
+
+import consistent as cs
+
+
+class AsyncConsistentHash:
+
+    # updates are queued (bounded, put() waits when full) and drained by a
+    # single task. Every drain takes what is queued, keeps the last update
+    # per prefix and applies it with one del_routes/add_routes call in an
+    # executor thread, so a prefix changing several times while the
+    # previous batch is applied is programmed once.
+
+    def __init__(self, ch: cs.ConsistentHash = None, queue_size = 10000, batch_size = 4096, linger = 0, executor = None):
+        self._ch = ch if ch else cs.ConsistentHash()
+        self._log = logging.getLogger("c_hash").getChild("async")
+
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._linger = linger
+        self._executor = executor
+
+        self._queue = None
+        self._task = None
+
+        self.received = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.errors = 0
+
+    @property
+    def engine(self):
+        return self._ch
+
+    async def start(self):
+        if self._task:
+            return
+        self._queue = asyncio.Queue(maxsize = self._queue_size)
+        self._task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def stop(self):
+        if not self._task:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def add_route(self, route: cs.Route):
+        await self._queue.put((True, route))
+
+    async def del_route(self, route: cs.Route):
+        await self._queue.put((False, route))
+
+    async def flush(self):
+        await self._queue.join()
+
+    async def set_admin_state(self, consistent_adm):
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._ch.set_admin_state, consistent_adm)
+
+    def _take(self, first):
+        pending = {}
+        add, route = first
+        pending[route.prefix.hashable] = first
+        count = 1
+
+        while count < self._batch_size and not self._queue.empty():
+            add, route = self._queue.get_nowait()
+            pending[route.prefix.hashable] = (add, route)
+            count += 1
+
+        return pending, count
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            first = await self._queue.get()
+
+            if self._linger:
+                await asyncio.sleep(self._linger)
+
+            pending, count = self._take(first)
+
+            self.received += count
+            self.coalesced += count - len(pending)
+            self.batches += 1
+
+            adds = [r for add, r in pending.values() if add]
+            dels = [r for add, r in pending.values() if not add]
+
+            try:
+                if dels:
+                    await loop.run_in_executor(self._executor, self._ch.del_routes, dels)
+                if adds:
+                    await loop.run_in_executor(self._executor, self._ch.add_routes, adds)
+            except Exception:
+                self.errors += 1
+                self._log.exception("failed to apply batch of %d updates", len(pending))
+            finally:
+                for _ in range(count):
+                    self._queue.task_done()
+
+    def __str__(self):
+        return "".join(" {}: {}".format(a, getattr(self, a)) for a in ("received", "coalesced", "batches", "errors"))
@@ -0,0 +1,93 @@
+import asyncio
+
+import consistent as cs
+from consistent_async import AsyncConsistentHash
+from consistent_testing import nexthops, route
+
+
+_NEXTHOPS = nexthops(4)
+
+
+def _table(ch: cs.ConsistentHash):
+    return {str(r.prefix): r.nh_set for r in ch.Routes}
+
+
+def _engine():
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 100
+    return ch
+
+
+def test_updates_queued_together_are_applied_once_per_prefix():
+    async def run():
+        # nothing yields between the puts, the drain finds all of them queued
+        async with AsyncConsistentHash(_engine()) as ach:
+            for nhs in (_NEXTHOPS[:1], _NEXTHOPS[:2], _NEXTHOPS[:3]):
+                await ach.add_route(route("172.16.0.0/24", nhs))
+            await ach.add_route(route("172.16.1.0/24", _NEXTHOPS[3:]))
+            await ach.flush()
+            return ach
+
+    ach = asyncio.run(run())
+    assert (ach.received, ach.coalesced, ach.batches, ach.errors) == (4, 2, 1, 0)
+    assert _table(ach.engine) == {"172.16.0.0/24": cs.NexthopSet.of(_NEXTHOPS[:3]),
+                                  "172.16.1.0/24": cs.NexthopSet.of(_NEXTHOPS[3:])}
+
+
+def test_the_last_update_of_a_prefix_wins():
+    async def run():
+        async with AsyncConsistentHash(_engine()) as ach:
+            await ach.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+            await ach.del_route(route("172.16.0.0/24", []))
+            await ach.del_route(route("172.16.1.0/24", []))
+            await ach.add_route(route("172.16.1.0/24", _NEXTHOPS[:2]))
+            await ach.flush()
+            first = _table(ach.engine)
+
+            # a later batch replaces what an earlier one programmed
+            await ach.add_route(route("172.16.1.0/24", _NEXTHOPS[2:]))
+            await ach.flush()
+            return first, _table(ach.engine), ach
+
+    first, second, ach = asyncio.run(run())
+    assert first == {"172.16.1.0/24": cs.NexthopSet.of(_NEXTHOPS[:2])}
+    assert second == {"172.16.1.0/24": cs.NexthopSet.of(_NEXTHOPS[2:])}
+    assert ach.batches == 2
+
+
+def test_stop_applies_what_is_queued():
+    async def run():
+        ach = AsyncConsistentHash(_engine(), batch_size = 2, linger = 0.01)
+        await ach.start()
+        for i in range(5):
+            await ach.add_route(route("172.16.%d.0/24" % i, _NEXTHOPS[:2]))
+        await ach.stop()
+        await ach.stop()
+        return ach
+
+    ach = asyncio.run(run())
+    assert ach._task is None
+    assert (ach.received, ach.batches) == (5, 3)
+    assert len(_table(ach.engine)) == 5
+
+
+def test_a_failing_batch_does_not_stop_the_drain():
+    class _Failing(cs.ConsistentHash):
+        def add_routes(self, routes):
+            if any(str(r.prefix) == "172.16.9.0/24" for r in routes):
+                raise RuntimeError("rejected")
+            return super().add_routes(routes)
+
+    async def run():
+        ch = _Failing()
+        ch.SdkObject._memory = 100
+        async with AsyncConsistentHash(ch) as ach:
+            await ach.add_route(route("172.16.9.0/24", _NEXTHOPS[:2]))
+            await ach.flush()
+            await ach.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+            await ach.flush()
+            return ach
+
+    ach = asyncio.run(run())
+    assert (ach.batches, ach.errors) == (2, 1)
+    assert list(_table(ach.engine)) == ["172.16.0.0/24"]
@@ -0,0 +1,332 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import consistent as cs
+
+
+_SIZES = (1000, 10000, 100000, 1000000)
+_NEXTHOPS = (2, 8, 32, 128)
+_QUICK_SIZES = (1000, 10000)
+_QUICK_NEXTHOPS = (2, 8)
+
+# compact routes keep everything in columns, a route costs about 120 bytes.
+# Smaller tables are dominated by the containers and are not checked.
+_COMPACT_BYTES_PER_ROUTE = 140
+_COMPACT_CHECK_ROUTES = 10000
+
+
+def _prefixes(n, rnd):
+    # distinct IPv4 /24 keys in random order, built without ipaddress parsing
+    base = 10 << 24
+    nets = rnd.sample(range(1 << 22), n)
+    return [cs.Prefix.from_key((((base + (i << 8)) << 8 | 24) << 1)) for i in nets]
+
+
+def _groups(nexthops, groups, rnd):
+    pool = ["192.0.%d.%d" % (i >> 8, i & 0xff) for i in range(1, nexthops + 1)]
+    sets = []
+    for _ in range(groups):
+        sets.append(cs.NexthopSet.of(rnd.sample(pool, rnd.randint(1, nexthops))))
+    return sets
+
+
+class Workload:
+    def __init__(self, routes, nexthops, groups, seed):
+        rnd = random.Random(seed)
+        self.routes = routes
+        self.nexthops = nexthops
+        self.prefixes = _prefixes(routes, rnd)
+        self.sets = _groups(nexthops, groups, rnd)
+        self.initial = [rnd.randrange(groups) for _ in range(routes)]
+        self.changed = [(g + 1 + rnd.randrange(groups - 1)) % groups if groups > 1 else g for g in self.initial]
+
+    def add(self):
+        return [cs.Route(p, self.sets[g]) for p, g in zip(self.prefixes, self.initial)]
+
+    def change(self):
+        return [cs.Route(p, self.sets[g]) for p, g in zip(self.prefixes, self.changed)]
+
+    def delete(self):
+        empty = cs.NexthopSet()
+        return [cs.Route(p, empty) for p in self.prefixes]
+
+
+def _engine(memory, admin = False):
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = memory
+    ch.set_admin_state(admin)
+    return ch
+
+
+def _loaded(w, memory, admin = False):
+    ch = _engine(memory, admin)
+    ch.add_routes(w.add())
+    return ch
+
+
+def _repeat(repeats, setup, fn):
+    # times fn(setup()) on a fresh state each run
+    times = []
+    for _ in range(repeats):
+        state = setup()
+        gc.collect()
+        t = time.perf_counter()
+        fn(state)
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def _each(fn, items):
+    def run(state):
+        for item in items:
+            fn(state, item)
+    return run
+
+
+def _result(name, w, ops, times, **extra):
+    # throughput of the best run, noise only ever makes a run slower. The
+    # spread of all runs is relative to the median.
+    times = sorted(times)
+    best, median = times[0], statistics.median(times)
+    res = {"bench": name, "routes": w.routes, "nexthops": w.nexthops, "ops": ops, "repeats": len(times),
+           "seconds": round(best, 6), "median": round(median, 6),
+           "spread": round((times[-1] - best) / median, 3) if median else 0.0,
+           "ops_per_sec": round(ops / best, 1) if best else None}
+    res.update(extra)
+    return res
+
+
+def _starved(w, memory, admin):
+    # an engine loaded with memory for about a third of the groups, so they
+    # fail or are partial, then given the rest for the timed pass to resolve
+    ch = cs.ConsistentHash()
+    need = sum(ch.SdkObject._container_size(s, admin) for s in set(w.sets))
+    ch.SdkObject._memory = need // 3
+    ch.set_admin_state(admin)
+    ch.add_routes(w.add())
+    ch.SdkObject._memory += memory
+    return ch
+
+
+def bench_routes(w, memory, admin, repeats):
+    res = []
+    adds = w.add()
+    times = _repeat(repeats, lambda: _engine(memory, admin), _each(cs.ConsistentHash.add_route, adds))
+    res.append(_result("add_route_new", w, len(adds), times, admin = admin))
+
+    changes = w.change()
+    times = _repeat(repeats, lambda: _loaded(w, memory, admin), _each(cs.ConsistentHash.add_route, changes))
+    res.append(_result("add_route_changed", w, len(changes), times, admin = admin))
+
+    unresolved = _starved(w, memory, admin).DesiredContainers.unresolved_count
+    times = _repeat(repeats, lambda: _starved(w, memory, admin), cs.ConsistentHash._periodic)
+    res.append(_result("periodic", w, 1, times, admin = admin, unresolved = unresolved))
+
+    # an admin toggle marks every container for reallocation, the next pass redoes them all
+    def toggled():
+        ch = _loaded(w, memory, admin)
+        ch.set_admin_state(not admin)
+        return ch
+
+    ch = toggled()
+    times = _repeat(repeats, toggled, cs.ConsistentHash._periodic)
+    res.append(_result("periodic_realloc", w, 1, times, admin = admin,
+                       desired_containers = len(ch.DesiredContainers)))
+
+    dels = w.delete()
+    times = _repeat(repeats, lambda: _loaded(w, memory, admin), _each(cs.ConsistentHash.del_route, dels))
+    res.append(_result("del_route", w, len(dels), times, admin = admin))
+    return res
+
+
+def bench_batch(w, memory, repeats):
+    res = []
+    adds = w.add()
+    times = _repeat(repeats, lambda: _engine(memory), lambda ch: ch.add_routes(adds))
+    res.append(_result("add_routes_new", w, len(adds), times))
+
+    changes = w.change()
+    times = _repeat(repeats, lambda: _loaded(w, memory), lambda ch: ch.add_routes(changes))
+    res.append(_result("add_routes_changed", w, len(changes), times))
+
+    dels = w.delete()
+    times = _repeat(repeats, lambda: _loaded(w, memory), lambda ch: ch.del_routes(dels))
+    res.append(_result("del_routes", w, len(dels), times))
+    return res
+
+
+def bench_lookup(w, memory, repeats, lookups = 100000):
+    # lookups leave the engine as it is, the runs share one
+    ch = _loaded(w, memory)
+    dcs = ch.DesiredContainers
+
+    rnd = random.Random(w.routes)
+    sets = [rnd.choice(w.sets) for _ in range(lookups)]
+    times = _repeat(repeats, lambda: dcs, _each(cs.cDesiredContainers.lookup, sets))
+    res = [_result("dc_lookup", w, lookups, times, desired_containers = len(dcs))]
+
+    sets = sets[:lookups // 10]
+    times = _repeat(repeats, lambda: dcs, _each(cs.cDesiredContainers.nearest, sets))
+    res.append(_result("dc_nearest", w, len(sets), times))
+    return res
+
+
+def bench_memory(w, memory, compact):
+    gc.collect()
+    tracemalloc.start()
+    ch = cs.ConsistentHash(compact_routes = compact)
+    ch.SdkObject._memory = memory
+    ch.add_routes(w.add())
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return [_result("memory_compact" if compact else "memory", w, w.routes, [0.0], current_bytes = current,
+                    peak_bytes = peak, bytes_per_route = round(current / w.routes, 1))]
+
+
+def bench_restore(w, memory, compact, repeats):
+    # warm restart: checkpoint a loaded engine, restore it, then the first
+    # update pays for the lazily built indexes
+    ch = cs.ConsistentHash(compact_routes = compact)
+    ch.SdkObject._memory = memory
+    ch.add_routes(w.add())
+
+    fd, path = tempfile.mkstemp(suffix = ".ck")
+    os.close(fd)
+    try:
+        times = _repeat(repeats, lambda: ch, lambda ch: ch.checkpoint(path))
+        res = [_result("checkpoint", w, w.routes, times, compact = compact, bytes = os.path.getsize(path))]
+        del ch
+
+        times = _repeat(repeats, lambda: path, cs.ConsistentHash.restore)
+        res.append(_result("restore", w, w.routes, times, compact = compact))
+
+        first = w.change()[:1]
+        times = _repeat(repeats, lambda: cs.ConsistentHash.restore(path), lambda ch: ch.add_routes(first))
+        res.append(_result("restore_first_update", w, 1, times, compact = compact))
+    finally:
+        os.unlink(path)
+    return res
+
+
+def _meta(args):
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                             cwd = sys.path[0] or ".").stdout.strip()
+    except OSError:
+        rev = ""
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "revision": rev, "seed": args.seed, "groups": args.groups,
+            "repeats": args.repeats,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def run(args):
+    results = []
+    for routes in args.sizes:
+        for nexthops in args.nexthops:
+            w = Workload(routes, nexthops, args.groups, args.seed)
+            print("routes={} nexthops={}".format(routes, nexthops), file = sys.stderr)
+
+            for admin in (False, True):
+                results.extend(bench_routes(w, args.memory, admin, args.repeats))
+            results.extend(bench_batch(w, args.memory, args.repeats))
+            results.extend(bench_lookup(w, args.memory, args.repeats))
+            for compact in (False, True):
+                results.extend(bench_restore(w, args.memory, compact, args.repeats))
+            if not args.no_memory:
+                for compact in (False, True):
+                    results.extend(bench_memory(w, args.memory, compact))
+
+    return {"meta": _meta(args), "results": results}
+
+
+def _key(r):
+    return (r["bench"], r["routes"], r["nexthops"], r.get("admin"), r.get("compact"))
+
+
+def compare(baseline, current, threshold):
+    # returns the benchmarks whose throughput dropped or whose memory per
+    # route grew by more than threshold
+    old = {_key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in current["results"]:
+        o = old.get(_key(r))
+        if o is None:
+            continue
+        if o.get("bytes_per_route") and r.get("bytes_per_route"):
+            change = r["bytes_per_route"] / o["bytes_per_route"] - 1
+            if change > threshold:
+                regressions.append((_key(r), o["bytes_per_route"], r["bytes_per_route"], change))
+        if not o.get("ops_per_sec") or not r.get("ops_per_sec"):
+            continue
+        change = r["ops_per_sec"] / o["ops_per_sec"] - 1
+        if change < -threshold:
+            regressions.append((_key(r), o["ops_per_sec"], r["ops_per_sec"], change))
+    return regressions
+
+
+def check_memory(report, limit):
+    # compact runs above limit bytes per route
+    return [(_key(r), r["bytes_per_route"]) for r in report["results"]
+            if r["bench"] == "memory_compact" and r["routes"] >= _COMPACT_CHECK_ROUTES and r["bytes_per_route"] > limit]
+
+
+def _ints(s):
+    return tuple(int(float(x)) for x in s.split(","))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "ConsistentHash micro benchmarks")
+    parser.add_argument("--sizes", type = _ints, default = _SIZES, help = "route counts, comma separated")
+    parser.add_argument("--nexthops", type = _ints, default = _NEXTHOPS, help = "next hop pool sizes, comma separated")
+    parser.add_argument("--groups", type = int, default = 64, help = "distinct next hop sets per workload")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--memory", type = int, default = 1 << 40, help = "SDK memory, large enough not to fall back")
+    parser.add_argument("--repeats", type = int, default = 5, help = "runs per timing, on a fresh engine each")
+    parser.add_argument("--quick", action = "store_true", help = "small grid for a fast check")
+    parser.add_argument("--no-memory", action = "store_true", help = "skip the tracemalloc runs")
+    parser.add_argument("--max-compact-bytes", type = float, default = _COMPACT_BYTES_PER_ROUTE,
+                        help = "bytes per route allowed with compact routes, exit 1 above")
+    parser.add_argument("--output", "-o", default = "-", help = "JSON output file, - for stdout")
+    parser.add_argument("--compare", help = "baseline JSON, exit 1 on regressions")
+    parser.add_argument("--threshold", type = float, default = 0.2, help = "allowed throughput drop for --compare")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.sizes, args.nexthops = _QUICK_SIZES, _QUICK_NEXTHOPS
+
+    report = run(args)
+
+    data = json.dumps(report, indent = 1)
+    if args.output == "-":
+        print(data)
+    else:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+
+    failed = False
+    for key, size in check_memory(report, args.max_compact_bytes):
+        print("memory {}: {:.1f} bytes/route above {:.1f}".format(key, size, args.max_compact_bytes), file = sys.stderr)
+        failed = True
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for key, old, new, change in regressions:
+            print("regression {}: {:.1f} -> {:.1f} ({:+.0%})".format(key, old, new, change), file = sys.stderr)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import random
+
+import pytest
+
+import consistent as cs
+from consistent_testing import log, prefix
+
+
+_POOL = ["10.%d.%d.1" % (i >> 8, i & 0xff) for i in range(400)]
+
+
+def _nhs(n, start = 0):
+    return cs.NexthopSet.of(_POOL[start:start + n])
+
+
+def _filled(nhset, size = 64):
+    ac = cs.ActualContainer(log)
+    ac.fill(nhset, size)
+    return ac
+
+
+def _owners(ac):
+    return [ac.bucket(i) for i in range(len(ac.buckets))]
+
+
+def _assert_balanced(ac, nhset):
+    counts = ac.bucket_counts()
+    assert set(counts) == set(nhset.ids())
+    assert sum(counts.values()) == len(ac.buckets)
+    assert max(counts.values()) - min(counts.values()) <= 1
+
+
+def test_fill_spreads_buckets_evenly():
+    ac = _filled(_nhs(3))
+    _assert_balanced(ac, _nhs(3))
+    assert sorted(ac.bucket_counts().values()) == [21, 21, 22]
+    assert type(ac.buckets) is bytes
+
+
+def test_added_member_takes_only_its_share():
+    ac = _filled(_nhs(3))
+    before = _owners(ac)
+
+    moved = ac.rebalance(_nhs(4))
+    after = _owners(ac)
+    new = next(iter(_nhs(1, 3).ids()))
+
+    assert moved == 16
+    assert [i for i in range(64) if before[i] != after[i]] == [i for i in range(64) if after[i] == new]
+    _assert_balanced(ac, _nhs(4))
+
+
+def test_removed_member_gives_up_only_its_buckets():
+    ac = _filled(_nhs(4))
+    before = _owners(ac)
+    gone = next(iter(_nhs(1, 2).ids()))
+    keep = _nhs(2) | _nhs(1, 3)
+
+    moved = ac.rebalance(keep)
+    after = _owners(ac)
+
+    assert moved == before.count(gone) == 16
+    assert all(a == b for a, b in zip(before, after) if a != gone)
+    _assert_balanced(ac, keep)
+    assert None in ac.members                   # the slot waits for the next member
+
+
+def test_unchanged_set_moves_nothing():
+    ac = _filled(_nhs(5))
+    before = ac.buckets
+    assert ac.rebalance(_nhs(5)) == 0
+    assert ac.buckets == before
+
+
+def test_empty_set_frees_every_bucket():
+    ac = _filled(_nhs(3))
+    assert ac.rebalance(cs.NexthopSet()) == 64
+    assert _owners(ac) == [None] * 64
+    assert ac.rebalance(_nhs(2)) == 64
+    _assert_balanced(ac, _nhs(2))
+
+
+@pytest.mark.parametrize("size, pool", [(64, 12), (1024, 300)], ids = ["byte", "wide"])
+def test_random_changes_stay_balanced_and_count_moves(size, pool):
+    rnd = random.Random(size)
+    nhset = _nhs(rnd.randint(1, pool))
+    ac = _filled(nhset, size)
+
+    for _ in range(60):
+        nhset = cs.NexthopSet.of(rnd.sample(_POOL[:pool], rnd.randint(1, pool)))
+        before = _owners(ac)
+        moved = ac.rebalance(nhset)
+        after = _owners(ac)
+
+        assert moved == sum(1 for a, b in zip(before, after) if a != b)
+        _assert_balanced(ac, nhset)
+        # members that stay and are within their share keep every bucket
+        share = size // len(nhset)
+        for m in set(before) & set(nhset.ids()):
+            if before.count(m) <= share:
+                assert all(b == m for a, b in zip(before, after) if a == m)
+
+
+def test_tables_widen_past_254_members():
+    ac = _filled(_nhs(254), 1024)
+    assert type(ac.buckets) is bytes
+
+    before = _owners(ac)
+    moved = ac.rebalance(_nhs(300))
+    assert type(ac.buckets) is tuple
+    assert cs._table_code(ac._buckets) == "H"
+    _assert_balanced(ac, _nhs(300))
+    assert moved == sum(1 for a, b in zip(before, _owners(ac)) if a != b)
+
+    # the table narrows again once the trailing slots are gone
+    ac.rebalance(_nhs(10))
+    _assert_balanced(ac, _nhs(10))
+    assert type(ac.buckets) is bytes
+    assert len(ac.members) < 255
+
+
+def test_wide_fill_and_copy():
+    ac = _filled(_nhs(300), 600)
+    assert cs._table_code(ac._buckets) == "H"
+    _assert_balanced(ac, _nhs(300))
+
+    clone = cs.ActualContainer(log)
+    clone.copy_buckets(ac)
+    clone.rebalance(_nhs(299))
+    assert _owners(ac) != _owners(clone)
+    _assert_balanced(ac, _nhs(300))
+
+
+def test_engine_route_with_many_next_hops(tmp_path):
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 1 << 20
+    ch.set_admin_state(True)
+
+    p = prefix("192.0.2.0/24")
+    ch.add_route(cs.Route(p, _nhs(300)))
+    ch.add_route(cs.Route(p, _nhs(297)))
+
+    ac = ch.Routes.get(p).desired_container.actual_container
+    _assert_balanced(ac, _nhs(297))
+
+    path = str(tmp_path / "ck")
+    ch.checkpoint(path)
+    restored = cs.ConsistentHash.restore(path)
+    assert sorted(a.buckets for a in restored.ActualContainers) == sorted(a.buckets for a in ch.ActualContainers)
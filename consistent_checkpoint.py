@@ -0,0 +1,76 @@
+import array
+import os
+import struct
+import sys
+
+
+# Checkpoint file: header, element count of every array, then the arrays
+# in ARRAYS order, each 8 byte aligned. Arrays are written in native
+# byte order and item sizes, the header records both and restore refuses
+# a file from a different platform. *_off arrays are offsets into the flat
+# array that follows them, one entry more than there are rows. ac_bkt holds
+# the raw bucket tables, their width follows from the member count.
+
+MAGIC = b"CHC1"
+
+# magic, little endian, size of "l", admin, resolved, stable, frozen,
+# compact routes, seconds since resolved, retry interval, seed, SDK memory,
+# next container id
+HEAD = struct.Struct("<4sBB?BB??ddQqq")
+
+ARRAYS = (
+    ("nh_id", "I"), ("nh_off", "I"), ("nh_addr", "B"),
+    ("ac_sid", "q"), ("ac_flags", "B"), ("ac_block", "q"), ("ac_size", "q"), ("ac_users", "I"), ("ac_dc", "q"),
+    ("ac_nh_off", "I"), ("ac_nh", "I"), ("ac_mem_off", "I"), ("ac_mem", "I"), ("ac_bkt_off", "I"), ("ac_bkt", "B"),
+    ("ac_count", "Q"), ("ac_sum", "Q"),
+    ("dc_sid", "q"), ("dc_state", "B"), ("dc_ac", "q"), ("dc_father", "q"),
+    ("dc_nh_off", "I"), ("dc_nh", "I"), ("dc_routes", "L"),
+    ("rt_hi", "Q"), ("rt_lo", "Q"), ("rt_meta", "H"), ("rt_dc", "l"),
+    ("rng", "I"),
+)
+
+NO_MEMBER = 0xffffffff
+
+MASK = (1 << 64) - 1
+
+
+def write_checkpoint(path, head, arrays):
+    # written next to path and renamed over it, a crash leaves the old one
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEAD.pack(*head))
+        f.write(struct.pack("<%dQ" % len(ARRAYS), *(len(arrays[name]) for name, _ in ARRAYS)))
+        for name, _ in ARRAYS:
+            f.write(bytes(-f.tell() % 8))
+            f.write(arrays[name])
+    os.replace(tmp, path)
+
+
+def read_checkpoint(path):
+    # every array is read straight into its own buffer with fromfile, the
+    # engine keeps (and the compact route table grows) them after restore
+    with open(path, "rb") as f:
+        data = f.read(HEAD.size)
+        if len(data) < HEAD.size or data[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a checkpoint: " + path)
+        head = HEAD.unpack(data)
+        if head[1] != (sys.byteorder == "little") or head[2] != array.array("l").itemsize:
+            raise ValueError("checkpoint written on another platform: " + path)
+
+        data = f.read(8 * len(ARRAYS))
+        if len(data) < 8 * len(ARRAYS):
+            raise ValueError("truncated checkpoint: " + path)
+        counts = struct.unpack("<%dQ" % len(ARRAYS), data)
+
+        arrays = {}
+        for (name, code), n in zip(ARRAYS, counts):
+            pad = -f.tell() % 8
+            a = array.array(code)
+            try:
+                if len(f.read(pad)) < pad:
+                    raise EOFError
+                a.fromfile(f, n)
+            except EOFError:
+                raise ValueError("truncated checkpoint: " + path) from None
+            arrays[name] = a
+    return head, arrays
@@ -0,0 +1,166 @@
+import copy
+import random
+
+import pytest
+
+import consistent as cs
+import consistent_checkpoint as ck
+from consistent_scenario import ScenarioClock
+from consistent_testing import nexthops, route
+from sdk_driver import LocalSDKBackend
+
+
+_NEXTHOPS = nexthops(8)
+
+
+def _loaded(seed, backend = None, **options):
+    # an engine through adds, changes, withdrawals, an admin toggle and
+    # timer passes, with too little memory for every group
+    rnd = random.Random(seed)
+    clock = ScenarioClock()
+    ch = cs.ConsistentHash(clock = clock, sdk_backend = backend, seed = seed, **options)
+    if "allocator" not in options:
+        ch.SdkObject._memory = 30
+    ch.set_admin_state(True)
+
+    nets = ["172.16.%d.0/24" % i for i in range(60)]
+    ch.add_routes([route(n, rnd.sample(_NEXTHOPS, rnd.randint(1, 5))) for n in nets])
+    for _ in range(3):
+        clock.advance(10.0)
+        ch._timers.run_due()
+        for n in rnd.sample(nets, 20):
+            ch.add_route(route(n, rnd.sample(_NEXTHOPS, rnd.randint(1, 5))))
+    ch.del_routes([route(n, []) for n in nets[:5]])
+    ch.set_admin_state(False)
+    ch.set_admin_state(True)
+    clock.advance(1.0)
+    ch._timers.run_due()
+    return ch
+
+
+def _state(ch: cs.ConsistentHash):
+    sdk = ch.SdkObject
+    acs = {ac.sid: (ac.nh_set.s.bits, ac.consistent, ac.resolved, ac.block, ac.users, ac.members, ac.buckets,
+                    sdk.charged(ac), ac.desired_container.sid if ac.desired_container else None)
+           for ac in ch.ActualContainers}
+    dcs = {dc.sid: (dc.nh_set.bits, dc.current_state, dc.actual_container.sid if dc.actual_container else None,
+                    dc.father.sid if dc.father else None, sorted(c.sid for c in dc.child_set),
+                    sorted(dc.route_keys), dc.ref_count)
+           for dc in ch.DesiredContainers}
+    routes = {r.key: (r.desired_container.sid, r.nh_set.bits) for r in ch.Routes}
+    engine = (ch._consistent_adm, ch._system_resolved, ch._system_stable, ch._freeze, ch._retry_interval,
+              sdk.memory, sdk.used, ch._random.getstate())
+    return acs, dcs, routes, engine
+
+
+def _expected(ch: cs.ConsistentHash):
+    # driver tables the engine state stands for, routes of failed groups
+    # are left out, the SDK keeps whatever they had
+    containers = {ac.sid: cs.SDK._op(("create", ac))[1] for ac in ch.ActualContainers}
+    routes = {r.key: r.desired_container.actual_container.sid for r in ch.Routes
+              if r.desired_container.current_state != cs.DesiredContainer.State.FAILED}
+    return containers, routes
+
+
+@pytest.mark.parametrize("options", [{}, {"compact_routes": True}, {"allocator": cs.BestFitAllocator(64, granule = 2)},
+                                     {"allocator": cs.BuddyAllocator(64)}],
+                         ids = ["dict", "compact", "bestfit", "buddy"])
+def test_round_trip_keeps_the_engine_state(tmp_path, options):
+    path = str(tmp_path / "ck")
+    ch = _loaded(1, **options)
+    ch.checkpoint(path)
+
+    restore_options = {"allocator": type(options["allocator"])(64)} if "allocator" in options else {}
+    restored = cs.ConsistentHash.restore(path, clock = ScenarioClock(ch._now()), **restore_options)
+
+    assert _state(restored) == _state(ch)
+    assert isinstance(restored.Routes, type(ch.Routes))
+    snap = restored.snapshot()
+    assert len(snap) == len(ch.Routes)
+    assert all(snap.group(r.prefix).id == r.desired_container.sid for r in ch.Routes)
+
+
+def _sids(ch):
+    return [ac.sid for ac in ch.ActualContainers] + [dc.sid for dc in ch.DesiredContainers]
+
+
+def test_restored_engine_carries_on(tmp_path):
+    path = str(tmp_path / "ck")
+    ch = _loaded(2)
+    ch.checkpoint(path)
+    restored = cs.ConsistentHash.restore(path)
+    last = max(_sids(restored))
+
+    restored.SdkObject._memory += 100
+    restored.add_route(route("192.0.2.0/24", _NEXTHOPS))
+    ch.SdkObject._memory += 100
+    ch.add_route(route("192.0.2.0/24", _NEXTHOPS))
+
+    assert min(sid for sid in _sids(restored) if sid > last) > last
+    assert _state(restored)[2].keys() == _state(ch)[2].keys()
+
+
+def test_unchanged_driver_is_adopted(tmp_path):
+    path = str(tmp_path / "ck")
+    backend = LocalSDKBackend()
+    ch = _loaded(3, backend)
+    ch.checkpoint(path)
+    assert _expected(ch) == (backend.driver.containers, {k: backend.driver.routes[k] for k in _expected(ch)[1]})
+
+    tables = copy.deepcopy((backend.driver.containers, backend.driver.routes))
+    restored = cs.ConsistentHash.restore(path, sdk_backend = LocalSDKBackend(backend.driver))
+
+    assert restored.SdkObject.repaired == 0
+    assert restored.SdkObject.adopted == len(ch.ActualContainers)
+    assert (backend.driver.containers, backend.driver.routes) == tables
+
+
+def test_diverged_driver_is_repaired(tmp_path):
+    path = str(tmp_path / "ck")
+    backend = LocalSDKBackend()
+    ch = _loaded(4, backend)
+    ch.checkpoint(path)
+    containers, routes = _expected(ch)
+    driver = backend.driver
+
+    sids = sorted({sid for sid in routes.values()})
+    assert len(sids) >= 3
+    lost, bent, other = sids[:3]
+    moved = next(k for k, sid in routes.items() if sid == bent)
+
+    # a container lost with its routes, a route on the wrong container, a
+    # table rewritten, and a container and route the engine never had
+    driver._apply([("unprogram", (k,)) for k, sid in routes.items() if sid == lost] + [("delete", (lost,))])
+    driver._apply([("program", (moved, other))])
+    sid, consistent, block, members, buckets = containers[other]
+    driver._apply([("align", (sid, consistent, block, members, buckets[::-1]))])
+    driver._apply([("create", (9999, False, None, (), b"")), ("program", (12345, 9999))])
+
+    restored = cs.ConsistentHash.restore(path, sdk_backend = LocalSDKBackend(driver))
+    restored.SdkObject.flush()
+
+    assert restored.SdkObject.repaired > 0
+    assert driver.containers == containers
+    assert {k: driver.routes.get(k) for k in routes} == routes
+    assert 12345 not in driver.routes
+
+
+def test_bad_checkpoints_are_refused(tmp_path):
+    path = tmp_path / "ck"
+    _loaded(5).checkpoint(str(path))
+    data = path.read_bytes()
+
+    path.write_bytes(b"XXXX" + data[len(ck.MAGIC):])
+    with pytest.raises(ValueError):
+        cs.ConsistentHash.restore(str(path))
+
+    for size in (len(ck.MAGIC), ck.HEAD.size, len(data) // 2, len(data) - 1):
+        path.write_bytes(data[:size])
+        with pytest.raises(ValueError):
+            cs.ConsistentHash.restore(str(path))
+
+
+def test_seed_above_63_bits(tmp_path):
+    path = str(tmp_path / "ck")
+    cs.ConsistentHash(seed = 2 ** 64 - 1).checkpoint(path)
+    assert cs.ConsistentHash.restore(path)._seed == 2 ** 64 - 1
@@ -0,0 +1,67 @@
+import pytest
+
+import consistent as cs
+from consistent_scenario import ScenarioClock
+
+
+def _dampener(clock, released):
+    timers = cs.TimerEngine(clock)
+    return cs.FlapDampener(cs.Dampening(), timers, lambda key: released.append(key)), timers
+
+
+def test_decayed_entries_are_dropped_without_a_release():
+    clock = ScenarioClock()
+    d, _ = _dampener(clock, [])
+    for key in range(100):
+        d.flap(key, clock())
+    assert len(d) == 100
+
+    # one flap penalty falls below reuse / 2 after half_life * log2(1000 / 375)
+    clock.advance(cs.Dampening().time_to_decay(1000, 375) + 0.01)
+    d.flap(1000, clock())
+    assert len(d) == 1
+    assert len(d._expiry) == 1
+
+
+def test_suppressed_entries_are_kept_until_released():
+    clock = ScenarioClock()
+    released = []
+    d, timers = _dampener(clock, released)
+    config = d.config
+
+    assert not d.flap(1, clock(), "r1")
+    assert d.flap(1, clock(), "r2")
+    assert d.is_suppressed(1)
+    d.flap(2, clock())
+
+    # the quiet prefix goes while the suppressed one stays
+    clock.advance(config.time_to_decay(2000, config.reuse / 2))
+    d.flap(3, clock())
+    assert d.is_suppressed(1) and sorted(d._d) == [1, 3]
+
+    clock.advance(config.time_to_reuse(d.penalty(1, clock())))
+    timers.run_due()
+    assert released == [1]
+    assert d.release(1, clock()) == "r2"
+    assert not d.is_suppressed(1)
+
+    # released below reuse / 2, dropped on the next pass
+    clock.advance(config.half_life * 4)
+    d.flap(4, clock())
+    assert sorted(d._d) == [4]
+
+
+@pytest.mark.parametrize("gap", [0.5, 3.0, 20.0])
+def test_penalties_match_a_plain_decay(gap):
+    clock = ScenarioClock()
+    d, _ = _dampener(clock, [])
+    config = d.config
+    penalty = 0.0
+    for _ in range(30):
+        if penalty < config.reuse / 2:
+            penalty = 0.0
+        d.flap(7, clock())
+        penalty = min(penalty + config.penalty, config.max_penalty)
+        clock.advance(gap)
+        penalty = config.decay(penalty, gap)
+    assert d.penalty(7, clock()) == pytest.approx(penalty)
@@ -0,0 +1,122 @@
+import concurrent.futures
+
+import consistent as cs
+from consistent_testing import nexthops, route
+from sdk_driver import SDKDriver
+
+
+_NEXTHOPS = nexthops(8)
+
+
+class _Backend:
+    # applies every batch to the driver model as it is submitted
+
+    def __init__(self):
+        self.driver = SDKDriver(None)
+
+    def submit(self, ops):
+        fut = concurrent.futures.Future()
+        fut.set_result(self.driver._apply(ops))
+        return fut
+
+    def flush(self):
+        pass
+
+
+def _programmed(ch: cs.ConsistentHash):
+    # route key -> container the engine has it on, failed groups left out
+    return {r.key: r.desired_container.actual_container.sid for r in ch.Routes
+            if r.desired_container.current_state != cs.DesiredContainer.State.FAILED}
+
+
+def test_admin_change_keeps_failed_groups_failed():
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 0
+    ch.set_admin_state(True)
+    ch.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+    ch.add_route(route("172.16.1.0/24", _NEXTHOPS[2:4]))
+    assert all(dc.current_state == cs.DesiredContainer.State.FAILED for dc in ch.DesiredContainers)
+
+    ch.set_admin_state(False)
+    assert all(dc.current_state == cs.DesiredContainer.State.FAILED for dc in ch.DesiredContainers)
+
+    # the route joins a group without a container, nothing to program it to
+    ch.add_route(route("172.16.1.0/24", _NEXTHOPS[:2]))
+    dc, = ch.DesiredContainers
+    assert dc.current_state == cs.DesiredContainer.State.FAILED
+    assert dc.ref_count == 2
+
+
+def test_container_sets_iterate_in_id_order():
+    # set order only depends on the ids, not on where the objects live, so
+    # a replayed run walks its containers in the recorded order
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 100
+    ch.set_admin_state(True)
+    for n in range(20):
+        ch.add_route(route("172.16.%d.0/24" % n, _NEXTHOPS[n % 5:n % 5 + 1 + n % 3]))
+
+    for containers in (ch.ActualContainers.s, set(ch.DesiredContainers)):
+        assert all(hash(c) == c.sid for c in containers)
+        sids = sorted(c.sid for c in containers)
+        assert [c.sid for c in set(sorted(containers, key = lambda c: c.sid))] == list(set(sids))
+
+
+def test_routes_joining_a_group_are_programmed():
+    backend = _Backend()
+    ch = cs.ConsistentHash(sdk_backend = backend)
+    ch.SdkObject._memory = 100
+    ch.set_admin_state(True)
+    for n in range(6):
+        ch.add_route(route("172.16.%d.0/24" % n, _NEXTHOPS[:3]))
+    ch.add_routes([route("172.16.%d.0/24" % n, _NEXTHOPS[n % 2:n % 2 + 2]) for n in range(6, 12)])
+
+    assert len(ch.DesiredContainers) == 3
+    assert backend.driver.routes == _programmed(ch)
+
+
+def test_deleted_routes_are_unprogrammed():
+    backend = _Backend()
+    ch = cs.ConsistentHash(sdk_backend = backend)
+    ch.SdkObject._memory = 100
+    ch.set_admin_state(True)
+    for n in range(8):
+        ch.add_route(route("172.16.%d.0/24" % n, _NEXTHOPS[n % 3:n % 3 + 2]))
+    ch.del_route(route("172.16.0.0/24", []))
+    ch.del_routes([route("172.16.%d.0/24" % n, []) for n in (1, 4)])
+    assert backend.driver.routes == _programmed(ch)
+
+    # a route whose new group failed is still programmed through the old one
+    ch.SdkObject._memory = 0
+    ch.add_route(route("172.16.5.0/24", _NEXTHOPS[5:8]))
+    assert ch.Routes.get(route("172.16.5.0/24", []).prefix).desired_container.current_state == \
+        cs.DesiredContainer.State.FAILED
+    key = route("172.16.5.0/24", []).key
+    assert key in backend.driver.routes
+
+    ch.del_route(route("172.16.5.0/24", []))
+    assert key not in backend.driver.routes
+
+
+def test_fallback_shares_the_widest_programmed_subset():
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 100
+    ch.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+    ch.add_route(route("172.16.1.0/24", _NEXTHOPS[:3]))
+    ch.add_route(route("172.16.2.0/24", _NEXTHOPS[5:7]))
+
+    def shared(net):
+        ch.SdkObject._memory = 0
+        r = route(net, _NEXTHOPS[:5])
+        ch.add_route(r)
+        ac = ch.Routes.by_key(r.key).desired_container.actual_container
+        ch.del_route(route(net, []))
+        return ac.nh_set.s
+
+    assert shared("172.16.9.0/24") == cs.NexthopSet.of(_NEXTHOPS[:3])
+    ch.del_route(route("172.16.1.0/24", []))
+    assert shared("172.16.9.0/24") == cs.NexthopSet.of(_NEXTHOPS[:2])
+
+    for net in ("172.16.0.0/24", "172.16.2.0/24"):
+        ch.del_route(route(net, []))
+    assert ch._shared_by_nh == {}
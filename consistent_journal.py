@@ -0,0 +1,508 @@
+import argparse
+import ipaddress
+import logging
+import mmap
+import queue
+import struct
+import sys
+import threading
+import time
+
+import consistent as cs
+from consistent_scenario import DriveStats, ScenarioClock
+
+
+# Journal format, little endian, after the 4 byte magic:
+#
+#   TIME          B q          absolute time in microseconds
+#   NH            B I B ...    next hop id, address length, address
+#   ADD4/ADD6     B I B 4s|16s H I*n
+#                              time delta (us), prefix length, network,
+#                              next hop count and ids
+#   DEL4/DEL6     B I B 4s|16s
+#   DELIN4/DELIN6 B I B 4s|16s supernet withdraw
+#   ADMIN/FREEZE  B I B        value
+#   TICK          B I          timers ran
+#   SEED          B Q          engine random seed
+#   BATCH         B I          the next n updates came in one call
+#
+# Next hop ids are those of the recording process, an NH record defines
+# each id before its first use.
+
+MAGIC = b"CHJ1"
+
+_TIME, _NH, _ADD4, _ADD6, _DEL4, _DEL6, _DELIN4, _DELIN6, _ADMIN, _FREEZE, _TICK, _SEED, _BATCH = range(13)
+
+_S_TIME = struct.Struct("<Bq")
+_S_SEED = struct.Struct("<BQ")
+_S_NH = struct.Struct("<BIB")
+_S_HEAD = struct.Struct("<BIB")     # type, delta, prefix length / value
+_S_TICK = struct.Struct("<BI")      # also BATCH
+_S_COUNT = struct.Struct("<H")
+
+_MAX_DELTA = 0xffffffff
+
+_log = logging.getLogger("c_hash").getChild("journal")
+
+
+class JournalWriter:
+
+    # the engine hands over (kind, time, key, bits) tuples under its lock,
+    # a writer thread encodes and writes them in blocks
+
+    def __init__(self, path, block = 8192):
+        self._f = open(path, "wb", buffering = 1 << 20)
+        self._f.write(MAGIC)
+        self._block = block
+
+        self._lock = threading.Lock()
+        self._items = []
+        self._queue = queue.Queue()
+
+        self._known = set()
+        self._last = 0
+
+        self.records = 0
+        self.bytes = len(MAGIC)
+
+        # first failure of the writer thread, raised by flush() and close()
+        self._error = None
+
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _put(self, item):
+        with self._lock:
+            self._items.append(item)
+            if len(self._items) >= self._block:
+                self._queue.put(self._items)
+                self._items = []
+
+    def _put_many(self, items):
+        with self._lock:
+            self._items.extend(items)
+            if len(self._items) >= self._block:
+                self._queue.put(self._items)
+                self._items = []
+
+    def add(self, t, route: cs.Route):
+        self._put((_ADD4, t, route.prefix.hashable, route.nh_set.bits))
+
+    def add_batch(self, t, routes):
+        self._put_many([(_BATCH, t, len(routes), 0)] + [(_ADD4, t, r.prefix.hashable, r.nh_set.bits) for r in routes])
+
+    def delete(self, t, route: cs.Route):
+        self._put((_DEL4, t, route.prefix.hashable, 0))
+
+    def delete_batch(self, t, routes):
+        self._put_many([(_BATCH, t, len(routes), 0)] + [(_DEL4, t, r.prefix.hashable, 0) for r in routes])
+
+    def delete_in(self, t, supernet):
+        self._put((_DELIN4, t, cs.Prefix.make_key(ipaddress.ip_network(supernet, strict = False)), 0))
+
+    def admin(self, t, value):
+        self._put((_ADMIN, t, int(bool(value)), 0))
+
+    def freeze(self, t, value):
+        self._put((_FREEZE, t, int(bool(value)), 0))
+
+    def tick(self, t):
+        self._put((_TICK, t, 0, 0))
+
+    def seed(self, seed):
+        self._put((_SEED, 0.0, seed, 0))
+
+    def flush(self):
+        with self._lock:
+            items, self._items = self._items, []
+        self._queue.put(items)
+        self._queue.put(None)
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._queue.put(False)
+            self._thread.join()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            items = self._queue.get()
+            try:
+                if items is False:
+                    return
+                if self._error is not None:
+                    # the journal has a gap, nothing after it is written
+                    continue
+                if items is None:
+                    self._f.flush()
+                else:
+                    data = self._encode(items)
+                    self._f.write(data)
+                    self.bytes += len(data)
+                    self.records += len(items)
+            except Exception as e:
+                _log.error("journal writer failed: %s", e)
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _encode(self, items):
+        out = bytearray()
+        known = self._known
+        last = self._last
+
+        for kind, t, key, bits in items:
+            if kind == _SEED:
+                out += _S_SEED.pack(_SEED, key)
+                continue
+            if kind == _BATCH:
+                out += _S_TICK.pack(_BATCH, key)
+                continue
+
+            t_us = round(t * 1e6)
+            delta = t_us - last
+            if delta < 0 or delta > _MAX_DELTA:
+                out += _S_TIME.pack(_TIME, t_us)
+                delta = 0
+            last = t_us
+
+            if kind == _TICK:
+                out += _S_TICK.pack(_TICK, delta)
+                continue
+            if kind == _ADMIN or kind == _FREEZE:
+                out += _S_HEAD.pack(kind, delta, key)
+                continue
+
+            v6 = key & 1
+            plen = (key >> 1) & 0xff
+            net = (key >> 9).to_bytes(16 if v6 else 4, "big")
+
+            if kind == _ADD4:
+                ids = []
+                while bits:
+                    low = bits & -bits
+                    i = low.bit_length() - 1
+                    bits ^= low
+                    if i not in known:
+                        addr = cs._nh_registry.address(i).packed
+                        out += _S_NH.pack(_NH, i, len(addr)) + addr
+                        known.add(i)
+                    ids.append(i)
+                out += _S_HEAD.pack(kind + v6, delta, plen) + net + _S_COUNT.pack(len(ids))
+                out += struct.pack("<%dI" % len(ids), *ids)
+            else:
+                out += _S_HEAD.pack(kind + v6, delta, plen) + net
+
+        self._last = last
+        return bytes(out)
+
+
+def read_journal(path):
+    # yields (kind, time, arg): ("add", t, (key, NexthopSet)), ("del", t, key),
+    # ("del_in", t, key), ("admin", t, bool), ("freeze", t, bool), ("tick", t, None),
+    # ("seed", t, int), ("batch", t, count). A journal cut short by a crash
+    # ends with ("truncated", t, bytes) for the partial record left out.
+    with open(path, "rb") as f:
+        size = f.seek(0, 2)
+        if size < len(MAGIC):
+            raise ValueError("not a journal: " + path)
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a journal: " + path)
+            yield from _records(m, size)
+
+
+def _record_size(m, pos, size):
+    # bytes of the record at pos, None if the journal ends inside it
+    kind = m[pos]
+    if kind == _TIME:
+        n = _S_TIME.size
+    elif kind == _SEED:
+        n = _S_SEED.size
+    elif kind == _NH:
+        n = _S_NH.size
+        if pos + n <= size:
+            n += m[pos + n - 1]
+    elif kind == _TICK or kind == _BATCH:
+        n = _S_TICK.size
+    elif kind == _ADMIN or kind == _FREEZE:
+        n = _S_HEAD.size
+    else:
+        n = _S_HEAD.size + (16 if (kind - _ADD4) & 1 else 4)
+        if kind <= _ADD6:
+            if pos + n + _S_COUNT.size > size:
+                return None
+            count, = _S_COUNT.unpack_from(m, pos + n)
+            n += _S_COUNT.size + 4 * count
+    return n if pos + n <= size else None
+
+
+def _nexthops(m, size):
+    # interns the journal next hops in their recorded id order first, in a
+    # fresh process they get the same ids and hash the same as when recorded.
+    # Also returns where the last complete record ends.
+    found = {}
+    pos = len(MAGIC)
+    while pos < size:
+        n = _record_size(m, pos, size)
+        if n is None:
+            break
+        if m[pos] == _NH:
+            _, i, _ = _S_NH.unpack_from(m, pos)
+            found[i] = ipaddress.ip_address(bytes(m[pos + _S_NH.size:pos + n]))
+        pos += n
+    return {i: 1 << cs._nh_registry.intern(found[i]) for i in sorted(found)}, pos
+
+
+def _records(m, size):
+    ids, end = _nexthops(m, size)       # journal next hop id -> bit in this process
+    pos = len(MAGIC)
+    t_us = 0
+
+    while pos < end:
+        kind = m[pos]
+
+        if kind == _TIME:
+            _, t_us = _S_TIME.unpack_from(m, pos)
+            pos += _S_TIME.size
+            continue
+
+        if kind == _SEED:
+            _, seed = _S_SEED.unpack_from(m, pos)
+            pos += _S_SEED.size
+            yield "seed", t_us / 1e6, seed
+            continue
+
+        if kind == _NH:
+            _, i, n = _S_NH.unpack_from(m, pos)
+            pos += _S_NH.size + n
+            continue
+
+        if kind == _BATCH:
+            _, count = _S_TICK.unpack_from(m, pos)
+            pos += _S_TICK.size
+            yield "batch", t_us / 1e6, count
+            continue
+
+        if kind == _TICK:
+            _, delta = _S_TICK.unpack_from(m, pos)
+            pos += _S_TICK.size
+            t_us += delta
+            yield "tick", t_us / 1e6, None
+            continue
+
+        _, delta, plen = _S_HEAD.unpack_from(m, pos)
+        pos += _S_HEAD.size
+        t_us += delta
+        t = t_us / 1e6
+
+        if kind == _ADMIN or kind == _FREEZE:
+            yield ("admin" if kind == _ADMIN else "freeze"), t, bool(plen)
+            continue
+
+        v6 = (kind - _ADD4) & 1
+        n = 16 if v6 else 4
+        key = (((int.from_bytes(m[pos:pos + n], "big") << 8) | plen) << 1) | v6
+        pos += n
+
+        if kind <= _ADD6:
+            count, = _S_COUNT.unpack_from(m, pos)
+            pos += _S_COUNT.size
+            bits = 0
+            for i in struct.unpack_from("<%dI" % count, m, pos):
+                bits |= ids[i]
+            pos += 4 * count
+            yield "add", t, (key, cs.NexthopSet(bits))
+        elif kind <= _DEL6:
+            yield "del", t, key
+        elif kind <= _DELIN6:
+            yield "del_in", t, key
+        else:
+            raise ValueError("bad journal record type %d at %d" % (kind, pos))
+
+    if end < size:
+        _log.warning("journal truncated, %d bytes after offset %d discarded", size - end, end)
+        yield "truncated", t_us / 1e6, size - end
+
+
+def replay(path, ch: cs.ConsistentHash = None, clock: ScenarioClock = None, pace = 0.0, batch_size = None,
+           **engine_options):
+
+    # feeds a journal to an engine. The engine clock follows the recorded
+    # times and timers run at the recorded ticks. With batch_size None every
+    # recorded call is repeated as it was made, so the run is reproduced
+    # exactly; with a batch_size consecutive updates are merged into
+    # add_routes/del_routes calls of up to that many routes, the fastest way
+    # to push a journal through as a benchmark input. pace 0 replays as fast
+    # as possible, pace 1.0 keeps the recorded timing (2.0 twice as fast, ...)
+    # and then only updates written at the same time are merged.
+    # Returns (engine, stats).
+
+    if ch is None:
+        clock = ScenarioClock()
+        ch = cs.ConsistentHash(clock = clock, **engine_options)
+
+    stats = DriveStats()
+    pending = []
+    pending_kind = None
+    pending_t = None
+    group = 0           # updates left in the recorded batch being read
+    wall = time.perf_counter()
+
+    def at(t):
+        if pace:
+            delay = wall + t / pace - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if clock is not None and t > clock():
+            clock.advance(t - clock())
+
+    def flush(batched):
+        if not pending:
+            return
+        at(pending_t)
+        if pending_kind == "add":
+            if batched:
+                ch.add_routes(pending)
+            else:
+                ch.add_route(pending[0])
+            stats.added += len(pending)
+        else:
+            if batched:
+                ch.del_routes(pending)
+            else:
+                ch.del_route(pending[0])
+            stats.deleted += len(pending)
+        stats.batches += 1
+        pending.clear()
+
+    for kind, t, arg in read_journal(path):
+        if kind == "truncated":
+            continue
+        if kind == "batch":
+            if batch_size is None:
+                flush(True)
+                group = arg
+            continue
+
+        stats.events += 1
+
+        if kind == "add" or kind == "del":
+            if batch_size is not None:
+                if kind != pending_kind or len(pending) >= batch_size or (pace and t != pending_t):
+                    flush(True)
+            pending_kind = kind
+            # a batch is applied at the time of its last record
+            pending_t = t
+            if kind == "add":
+                pending.append(cs.Route(cs.Prefix.from_key(arg[0]), arg[1]))
+            else:
+                pending.append(cs.Route(cs.Prefix.from_key(arg), cs.NexthopSet()))
+            if batch_size is None:
+                if group:
+                    group -= 1
+                    if not group:
+                        flush(True)
+                else:
+                    flush(False)
+            continue
+
+        flush(True)
+        at(t)
+        if kind == "tick":
+            stats.ticks += 1
+            ch._timers.run_due()
+        elif kind == "admin":
+            stats.admin += 1
+            ch.set_admin_state(arg)
+        elif kind == "freeze":
+            if arg:
+                ch.freeze()
+            else:
+                ch.unfreeze()
+        elif kind == "del_in":
+            stats.deleted += ch.del_routes_in(str(cs.Prefix.from_key(arg)))
+        elif kind == "seed":
+            ch._random.seed(arg)
+
+    flush(True)
+    stats.seconds = time.perf_counter() - wall
+    return ch, stats
+
+
+def record(path, events, block = 8192):
+    # writes scenario events (see consistent_scenario) as a journal, ticks
+    # move the recorded time, so any scenario becomes a replayable input
+    t = 0.0
+    with JournalWriter(path, block) as j:
+        for kind, arg in events:
+            if kind == "add":
+                j.add(t, arg)
+            elif kind == "del":
+                j.delete(t, arg)
+            elif kind == "admin":
+                j.admin(t, arg)
+            elif kind == "tick":
+                t += arg
+                j.tick(t)
+    return j.records
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "ConsistentHash journal tools")
+    sub = parser.add_subparsers(dest = "cmd", required = True)
+
+    p = sub.add_parser("replay", help = "replay a journal into a new engine")
+    p.add_argument("path")
+    p.add_argument("--pace", type = float, default = 0.0, help = "0 as fast as possible, 1 recorded pace")
+    p.add_argument("--batch", type = int, default = None,
+                   help = "merge updates into calls of this many routes, default repeats the recorded calls")
+    p.add_argument("--memory", type = int, default = 7)
+
+    p = sub.add_parser("dump", help = "print the records")
+    p.add_argument("path")
+
+    p = sub.add_parser("record", help = "write a scenario as a journal")
+    p.add_argument("path")
+    p.add_argument("scenario")
+    p.add_argument("--spines", type = int, default = 4)
+    p.add_argument("--leaves", type = int, default = 32)
+    p.add_argument("--prefixes", type = int, default = 1000)
+    p.add_argument("--seed", type = int, default = 1)
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "dump":
+        for kind, t, arg in read_journal(args.path):
+            if kind == "add":
+                arg = "{} {}".format(cs.Prefix.from_key(arg[0]), arg[1])
+            elif kind in ("del", "del_in"):
+                arg = cs.Prefix.from_key(arg)
+            print("{:.6f} {} {}".format(t, kind, "" if arg is None else arg))
+    elif args.cmd == "record":
+        import consistent_scenario as sc
+        fabric = sc.Fabric(args.spines, args.leaves, args.prefixes)
+        print("records:", record(args.path, sc.generate(args.scenario, fabric, args.seed)))
+    else:
+        clock = ScenarioClock()
+        ch = cs.ConsistentHash(clock = clock)
+        ch.SdkObject._memory = args.memory
+        ch, stats = replay(args.path, ch, clock, args.pace, args.batch)
+        print(stats)
+        print(ch)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import ipaddress
+import struct
+
+import pytest
+
+import consistent as cs
+import consistent_journal as cj
+from consistent_scenario import ScenarioClock
+from consistent_testing import route
+
+
+_NH = "192.0.2.1"
+
+
+def _write(path, *calls):
+    with cj.JournalWriter(str(path)) as j:
+        for name, args in calls:
+            getattr(j, name)(*args)
+    return j
+
+
+def _sample(path):
+    # the records of the sample journal, one chunk each, and what reading
+    # them gives back
+    r = route("10.1.2.0/24", [_NH])
+    i = next(iter(r.nh_set.ids()))
+    net = bytes([10, 1, 2, 0])
+
+    _write(path, ("seed", (42,)), ("add", (1.5, r)), ("delete", (2.0, r)), ("admin", (1.0, True)),
+           ("tick", (1.25,)))
+
+    chunks = [cj.MAGIC,
+              struct.pack("<Bq", cj._SEED, 42),
+              struct.pack("<BIB", cj._NH, i, 4) + bytes([192, 0, 2, 1]),
+              struct.pack("<BIB", cj._ADD4, 1500000, 24) + net + struct.pack("<HI", 1, i),
+              struct.pack("<BIB", cj._DEL4, 500000, 24) + net,
+              struct.pack("<Bq", cj._TIME, 1000000),
+              struct.pack("<BIB", cj._ADMIN, 0, 1),
+              struct.pack("<BI", cj._TICK, 250000)]
+    records = [("seed", 0.0, 42),
+               ("add", 1.5, (r.key, r.nh_set)),
+               ("del", 2.0, r.key),
+               ("admin", 1.0, True),
+               ("tick", 1.25, None)]
+    return chunks, records
+
+
+def test_record_format(tmp_path):
+    path = tmp_path / "j"
+    chunks, _ = _sample(path)
+    assert path.read_bytes() == b"".join(chunks)
+
+
+def test_read_returns_the_written_records(tmp_path):
+    path = tmp_path / "j"
+    _, records = _sample(path)
+    assert list(cj.read_journal(str(path))) == records
+
+
+def test_ipv6_and_large_gaps(tmp_path):
+    path = tmp_path / "j"
+    r = route("2001:db8::/48", [_NH, "2001:db8::1"])
+    _write(path, ("add", (0.5, r)), ("delete_in", (10000.0, "2001:db8::/32")), ("freeze", (10000.0, False)))
+
+    assert list(cj.read_journal(str(path))) == [
+        ("add", 0.5, (r.key, r.nh_set)),
+        ("del_in", 10000.0, cs.Prefix.make_key(ipaddress.ip_network("2001:db8::/32"))),
+        ("freeze", 10000.0, False)]
+
+
+def test_not_a_journal(tmp_path):
+    path = tmp_path / "j"
+    path.write_bytes(b"CHJ0" + bytes(16))
+    with pytest.raises(ValueError):
+        list(cj.read_journal(str(path)))
+
+
+def test_truncated_journal_stops_at_the_last_complete_record(tmp_path):
+    full = tmp_path / "j"
+    chunks, records = _sample(full)
+    data = full.read_bytes()
+
+    ends = [len(b"".join(chunks[:n + 1])) for n in range(len(chunks))]
+    cut = tmp_path / "cut"
+    for size in range(len(cj.MAGIC), len(data)):
+        cut.write_bytes(data[:size])
+        got = list(cj.read_journal(str(cut)))
+
+        end = max(e for e in ends if e <= size)
+        if end < size:
+            kind, _, discarded = got.pop()
+            assert (kind, discarded) == ("truncated", size - end)
+        assert got == records[:len(got)]
+        assert all(kind != "truncated" for kind, _, _ in got)
+
+
+def test_seed_takes_the_full_64_bits(tmp_path):
+    path = str(tmp_path / "j")
+    with cj.JournalWriter(path) as j:
+        cs.ConsistentHash(seed = 2 ** 64 - 1, journal = j)
+    assert list(cj.read_journal(path)) == [("seed", 0.0, 2 ** 64 - 1)]
+
+    with pytest.raises(ValueError):
+        cs.ConsistentHash(seed = 2 ** 64)
+    with pytest.raises(ValueError):
+        cs.ConsistentHash(seed = -1)
+
+
+def test_writer_failure_is_raised_not_hung(tmp_path):
+    j = cj.JournalWriter(str(tmp_path / "j"))
+    j.seed(2 ** 64)
+    with pytest.raises(struct.error):
+        j.flush()
+
+    # later records are dropped, the journal would have a gap
+    j.add(1.0, route("10.1.2.0/24", [_NH]))
+    with pytest.raises(struct.error):
+        j.close()
+    assert (tmp_path / "j").read_bytes() == cj.MAGIC
+
+
+@pytest.mark.parametrize("call", ["add_routes", "del_routes"])
+def test_failing_batch_iterable_releases_the_lock(tmp_path, call):
+    def routes():
+        yield route("10.1.2.0/24", [_NH])
+        raise RuntimeError("feed broke")
+
+    with cj.JournalWriter(str(tmp_path / "j")) as j:
+        ch = cs.ConsistentHash(journal = j)
+        with pytest.raises(RuntimeError):
+            getattr(ch, call)(routes())
+        assert not ch._lock.locked()
+        assert not ch._batch
+        ch.add_route(route("10.1.3.0/24", [_NH]))
+    assert len(ch.Routes) == 1
+
+
+def _session(ch: cs.ConsistentHash, clock: ScenarioClock):
+    nhs = ["10.0.0.%d" % i for i in range(1, 7)]
+    nets = ["172.16.%d.0/24" % i for i in range(40)]
+
+    ch.set_admin_state(True)
+    ch.add_routes([route(n, nhs[:4]) for n in nets])
+    for n, net in enumerate(nets):
+        ch.add_route(route(net, nhs[n % 3:n % 3 + 3]))
+        if n % 7 == 0:
+            clock.advance(2.0)
+            ch._timers.run_due()
+    ch.freeze()
+    ch.del_routes([route(n, []) for n in nets[:5]])
+    ch.unfreeze()
+    ch.del_route(route(nets[10], []))
+    ch.del_routes_in("172.16.32.0/21")
+    ch.set_admin_state(False)
+    clock.advance(60.0)
+    ch._timers.run_due()
+
+
+def _state(ch: cs.ConsistentHash):
+    routes = {r.key: r.nh_set.bits for r in ch.Routes}
+    groups = sorted((dc.nh_set.bits, dc.current_state.value, dc.ref_count,
+                     dc.actual_container.nh_set.s.bits if dc.actual_container else None,
+                     dc.actual_container.buckets if dc.actual_container else None)
+                    for dc in ch.DesiredContainers)
+    return routes, groups
+
+
+@pytest.mark.parametrize("batch_size", [None, 16])
+def test_replay_reproduces_the_recorded_engine(tmp_path, batch_size):
+    path = str(tmp_path / "j")
+    clock = ScenarioClock()
+    with cj.JournalWriter(path, block = 16) as j:
+        ch = cs.ConsistentHash(clock = clock, journal = j, seed = 3)
+        ch.SdkObject._memory = 8
+        _session(ch, clock)
+
+    clock2 = ScenarioClock()
+    ch2 = cs.ConsistentHash(clock = clock2)
+    ch2.SdkObject._memory = 8
+    ch2, stats = cj.replay(path, ch2, clock2, batch_size = batch_size)
+
+    assert stats.admin == 2
+    assert clock2() == clock()
+    if batch_size is None:
+        assert _state(ch2) == _state(ch)
+    else:
+        assert _state(ch2)[0] == _state(ch)[0]
+
+
+def test_replay_of_a_truncated_journal(tmp_path):
+    path = tmp_path / "j"
+    clock = ScenarioClock()
+    with cj.JournalWriter(str(path)) as j:
+        ch = cs.ConsistentHash(clock = clock, journal = j)
+        _session(ch, clock)
+
+    # the last record is the tick of the final timer pass
+    path.write_bytes(path.read_bytes()[:-3])
+    ch2, stats = cj.replay(str(path))
+    assert {r.key for r in ch2.Routes} == {r.key for r in ch.Routes}
+    assert stats.ticks == sum(1 for kind, _, _ in cj.read_journal(str(path)) if kind == "tick")
@@ -0,0 +1,167 @@
+class _PNode:
+    __slots__ = ("kids", "edit")
+
+    def __init__(self, kids, edit):
+        self.kids = kids
+        self.edit = edit
+
+
+_PMAP_SHIFT_MAX = 60
+_PMAP_HASH_MASK = (1 << 64) - 1
+_MISSING = object()
+
+
+class PMap:
+    # persistent hash trie (32 way), versions share every untouched node.
+    # Leaves are (key, value, hash) tuples, keys whose 64 bit hashes
+    # collide end up in a dict that is copied on write.
+
+    __slots__ = ("_root", "_len")
+
+    def __init__(self, root = None, length = 0):
+        self._root = root if root is not None else _PNode([None] * 32, None)
+        self._len = length
+
+    def __len__(self):
+        return self._len
+
+    def get(self, key, default = None):
+        h = hash(key) & _PMAP_HASH_MASK
+        node = self._root
+        shift = 0
+        while True:
+            slot = node.kids[(h >> shift) & 31]
+            if slot is None:
+                return default
+            t = type(slot)
+            if t is tuple:
+                return slot[1] if slot[0] == key else default
+            if t is _PNode:
+                node = slot
+                shift += 5
+                continue
+            return slot.get(key, default)
+
+    def __getitem__(self, key):
+        v = self.get(key, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def items(self):
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            for slot in node.kids:
+                if slot is None:
+                    continue
+                t = type(slot)
+                if t is tuple:
+                    yield slot[0], slot[1]
+                elif t is _PNode:
+                    stack.append(slot)
+                else:
+                    yield from slot.items()
+
+    def __iter__(self):
+        for k, v in self.items():
+            yield k
+
+    def values(self):
+        for k, v in self.items():
+            yield v
+
+    def transient(self):
+        return TransientMap(self)
+
+
+class TransientMap:
+    # writer side of a PMap: nodes created since the last persistent() call
+    # are changed in place, older ones are copied along the path
+
+    def __init__(self, pmap: PMap = None):
+        pmap = pmap if pmap is not None else PMap()
+        self._root = pmap._root
+        self._len = pmap._len
+        self._edit = object()
+
+    def __len__(self):
+        return self._len
+
+    def get(self, key, default = None):
+        return PMap(self._root, self._len).get(key, default)
+
+    def persistent(self):
+        self._edit = object()
+        return PMap(self._root, self._len)
+
+    def _own(self, node):
+        return node if node.edit is self._edit else _PNode(list(node.kids), self._edit)
+
+    def set(self, key, value):
+        h = hash(key) & _PMAP_HASH_MASK
+        self._root = self._set(self._root, h, key, value, 0)
+
+    def _set(self, node, h, key, value, shift):
+        node = self._own(node)
+        i = (h >> shift) & 31
+        slot = node.kids[i]
+        t = type(slot)
+
+        if slot is None:
+            node.kids[i] = (key, value, h)
+            self._len += 1
+        elif t is tuple:
+            if slot[0] == key:
+                node.kids[i] = (key, value, h)
+            elif shift + 5 > _PMAP_SHIFT_MAX:
+                node.kids[i] = {slot[0]: slot[1], key: value}
+                self._len += 1
+            else:
+                child = _PNode([None] * 32, self._edit)
+                child.kids[(slot[2] >> (shift + 5)) & 31] = slot
+                node.kids[i] = self._set(child, h, key, value, shift + 5)
+        elif t is _PNode:
+            node.kids[i] = self._set(slot, h, key, value, shift + 5)
+        else:
+            bucket = dict(slot)
+            if key not in bucket:
+                self._len += 1
+            bucket[key] = value
+            node.kids[i] = bucket
+
+        return node
+
+    def delete(self, key):
+        if self.get(key, _MISSING) is _MISSING:
+            return False
+        h = hash(key) & _PMAP_HASH_MASK
+        self._root = self._delete(self._root, h, key, 0) or _PNode([None] * 32, self._edit)
+        self._len -= 1
+        return True
+
+    def _delete(self, node, h, key, shift):
+        node = self._own(node)
+        i = (h >> shift) & 31
+        slot = node.kids[i]
+        t = type(slot)
+
+        if t is tuple:
+            node.kids[i] = None
+        elif t is _PNode:
+            node.kids[i] = self._delete(slot, h, key, shift + 5)
+        else:
+            bucket = dict(slot)
+            del bucket[key]
+            node.kids[i] = bucket if len(bucket) > 1 else (next(iter(bucket.items())) + (h,))
+
+        # collapse nodes left empty or holding a single leaf
+        kids = [k for k in node.kids if k is not None]
+        if not kids:
+            return None
+        if shift and len(kids) == 1 and type(kids[0]) is tuple:
+            return kids[0]
+        return node
@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+import consistent as cs
+from consistent_pmap import PMap, TransientMap
+from consistent_testing import nexthops, route
+
+
+_NEXTHOPS = nexthops(4)
+
+
+class _Key:
+    # keys with a chosen hash, to force collisions at any depth
+
+    def __init__(self, name, h):
+        self.name = name
+        self.h = h
+
+    def __hash__(self):
+        return self.h
+
+    def __eq__(self, other):
+        return isinstance(other, _Key) and self.name == other.name
+
+    def __repr__(self):
+        return "_Key(%r)" % self.name
+
+
+def _keys(rnd, n):
+    # full hash collisions, keys differing only in the high bits and
+    # plain ones, all mixed in one map
+    keys = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            h = rnd.randrange(4)
+        elif kind == 1:
+            h = rnd.randrange(4) << 55 | 7
+        else:
+            h = rnd.getrandbits(64)
+        keys.append(_Key(i, h))
+    return keys
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_versions_match_a_dict(seed):
+    rnd = random.Random(seed)
+    keys = _keys(rnd, 60)
+    t = TransientMap()
+    model = {}
+    versions = []
+    for step in range(2000):
+        k = rnd.choice(keys)
+        if rnd.random() < 0.6:
+            t.set(k, step)
+            model[k] = step
+        else:
+            assert t.delete(k) == (model.pop(k, None) is not None)
+        if step % 50 == 0:
+            versions.append((t.persistent(), dict(model)))
+
+    versions.append((t.persistent(), dict(model)))
+    # every version is untouched by the writes made after it
+    for pmap, expected in versions:
+        assert len(pmap) == len(expected)
+        assert dict(pmap.items()) == expected
+        for k in keys:
+            assert pmap.get(k) == expected.get(k)
+            assert (k in pmap) == (k in expected)
+
+
+def test_colliding_keys_are_kept_apart():
+    a, b, c = _Key("a", 5), _Key("b", 5), _Key("c", 5)
+    t = PMap().transient()
+    for k in (a, b, c):
+        t.set(k, k.name)
+    one = t.persistent()
+    t.delete(b)
+    t.delete(a)
+    two = t.persistent()
+
+    assert dict(one.items()) == {a: "a", b: "b", c: "c"}
+    assert dict(two.items()) == {c: "c"}
+    assert two[c] == "c"
+    with pytest.raises(KeyError):
+        two[a]
+    assert not t.delete(a)
+
+
+def test_snapshot_is_unaffected_by_later_updates():
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 100
+    ch.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+    ch.add_route(route("172.16.1.0/24", _NEXTHOPS[:2]))
+    old = ch.snapshot()
+    assert ch.snapshot() is old
+
+    ch.del_route(route("172.16.0.0/24", []))
+    ch.add_route(route("172.16.1.0/24", _NEXTHOPS[2:]))
+    ch.add_route(route("172.16.2.0/24", _NEXTHOPS[:1]))
+    new = ch.snapshot()
+
+    def table(snap):
+        return {str(p): g.nh_set for p, g in snap.items()}
+
+    assert table(old) == {"172.16.0.0/24": cs.NexthopSet.of(_NEXTHOPS[:2]),
+                          "172.16.1.0/24": cs.NexthopSet.of(_NEXTHOPS[:2])}
+    assert table(new) == {"172.16.1.0/24": cs.NexthopSet.of(_NEXTHOPS[2:]),
+                          "172.16.2.0/24": cs.NexthopSet.of(_NEXTHOPS[:1])}
+    assert new.version > old.version
+    assert len(old) == 2 and len(old.groups) == 1
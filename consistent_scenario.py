@@ -0,0 +1,332 @@
+import argparse
+import ipaddress
+import math
+import random
+import sys
+import time
+
+import consistent as cs
+
+
+# Events are plain tuples:
+#   ("add", Route)      route added or changed
+#   ("del", Route)      route withdrawn
+#   ("admin", bool)     consistent admin state
+#   ("tick", seconds)   time passes
+#
+# Scenarios are generators, nothing is built before it is consumed, so a
+# scenario over millions of prefixes streams in constant memory.
+
+
+class Fabric:
+
+    # two tier fat tree seen from one leaf: every remote leaf announces
+    # `prefixes` /24s, reachable through each spine that has an up link to it
+
+    def __init__(self, spines = 4, leaves = 32, prefixes = 1000, base_nh = "10.255.0.1", base_net = "10.0.0.0"):
+        self.spines = spines
+        self.leaves = leaves
+        self.prefixes = prefixes
+
+        nh = ipaddress.ip_address(base_nh)
+        self._spine_bits = [cs.NexthopSet.of([nh + s]).bits for s in range(spines)]
+        self._all = 0
+        for b in self._spine_bits:
+            self._all |= b
+
+        self._net = int(ipaddress.ip_address(base_net))
+        self._links = [self._all] * leaves      # bits of the spines with an up link to each leaf
+        self._spine_up = [True] * spines
+
+    def __len__(self):
+        return self.leaves * self.prefixes
+
+    def key(self, i):
+        # prefix i of the fabric, leaf i // prefixes
+        return (((self._net + (i << 8)) << 8) | 24) << 1
+
+    def leaf_of(self, i):
+        return i // self.prefixes
+
+    def nh_bits(self, leaf):
+        bits = self._links[leaf]
+        for s, up in enumerate(self._spine_up):
+            if not up:
+                bits &= ~self._spine_bits[s]
+        return bits
+
+    def spine_bits(self, spine):
+        return self._spine_bits[spine]
+
+    def set_spine(self, spine, up):
+        self._spine_up[spine] = up
+
+    def set_link(self, leaf, spine, up):
+        if up:
+            self._links[leaf] |= self._spine_bits[spine]
+        else:
+            self._links[leaf] &= ~self._spine_bits[spine]
+
+    def route(self, i, bits = None):
+        if bits is None:
+            bits = self.nh_bits(self.leaf_of(i))
+        return cs.Route(cs.Prefix.from_key(self.key(i)), cs.NexthopSet(bits))
+
+    def leaf_routes(self, leaf):
+        bits = self.nh_bits(leaf)
+        first = leaf * self.prefixes
+        for i in range(first, first + self.prefixes):
+            yield self.route(i, bits)
+
+    def leaf_events(self, leaf):
+        # withdrawn when no spine reaches the leaf any more
+        kind = "add" if self.nh_bits(leaf) else "del"
+        for r in self.leaf_routes(leaf):
+            yield kind, r
+
+
+def permutation(n, rnd):
+    # seeded pseudo random order of range(n) without materializing it:
+    # i -> (a * i + b) mod n with a coprime to n
+    if n <= 1:
+        yield from range(n)
+        return
+    a = rnd.randrange(1, n)
+    while math.gcd(a, n) != 1:
+        a = rnd.randrange(1, n)
+    b = rnd.randrange(n)
+    for i in range(n):
+        yield (a * i + b) % n
+
+
+def full_table(fabric, rnd):
+    # every prefix announced once with its full next hop set, random order
+    for i in permutation(len(fabric), rnd):
+        yield "add", fabric.route(i)
+
+
+def converge(fabric, rnd, interval = 0.0):
+    # spines come up one by one, every prefix grows by one next hop per round
+    order = list(range(fabric.spines))
+    rnd.shuffle(order)
+
+    for s in range(fabric.spines):
+        fabric.set_spine(s, False)
+
+    for s in order:
+        fabric.set_spine(s, True)
+        for i in permutation(len(fabric), rnd):
+            yield "add", fabric.route(i)
+        if interval:
+            yield "tick", interval
+
+
+def spine_failure(fabric, rnd, spine = None, downtime = 30.0):
+    # a spine dies, every prefix loses it, then it comes back
+    if spine is None:
+        spine = rnd.randrange(fabric.spines)
+
+    yield from full_table(fabric, rnd)
+
+    fabric.set_spine(spine, False)
+    for leaf in range(fabric.leaves):
+        yield from fabric.leaf_events(leaf)
+    yield "tick", downtime
+
+    fabric.set_spine(spine, True)
+    for leaf in range(fabric.leaves):
+        yield from fabric.leaf_events(leaf)
+
+
+def leaf_drain(fabric, rnd, leaf = None, downtime = 30.0):
+    # a remote leaf is drained for maintenance: its prefixes are withdrawn
+    # and announced again afterwards
+    if leaf is None:
+        leaf = rnd.randrange(fabric.leaves)
+
+    yield from full_table(fabric, rnd)
+
+    for r in fabric.leaf_routes(leaf):
+        yield "del", r
+    yield "tick", downtime
+
+    yield from fabric.leaf_events(leaf)
+
+
+def link_flap_storm(fabric, rnd, flaps = 100, interval = 0.5):
+    # random leaf-spine links go down and come back, each flap rewrites the
+    # prefixes of one leaf twice
+    yield from full_table(fabric, rnd)
+
+    for _ in range(flaps):
+        leaf = rnd.randrange(fabric.leaves)
+        spine = rnd.randrange(fabric.spines)
+
+        fabric.set_link(leaf, spine, False)
+        yield from fabric.leaf_events(leaf)
+        yield "tick", interval
+
+        fabric.set_link(leaf, spine, True)
+        yield from fabric.leaf_events(leaf)
+        yield "tick", interval
+
+
+def rolling_maintenance(fabric, rnd, hold = 60.0):
+    # spines are taken out of service one at a time and returned
+    yield from full_table(fabric, rnd)
+
+    order = list(range(fabric.spines))
+    rnd.shuffle(order)
+    for spine in order:
+        fabric.set_spine(spine, False)
+        for leaf in range(fabric.leaves):
+            yield from fabric.leaf_events(leaf)
+        yield "tick", hold
+
+        fabric.set_spine(spine, True)
+        for leaf in range(fabric.leaves):
+            yield from fabric.leaf_events(leaf)
+        yield "tick", hold
+
+
+def admin_toggle(fabric, rnd, toggles = 4, interval = 5.0):
+    # the table is loaded while the consistent admin state flips
+    total = len(fabric)
+    step = max(1, total // (toggles + 1))
+    state = True
+
+    yield "admin", state
+    for n, i in enumerate(permutation(total, rnd), 1):
+        yield "add", fabric.route(i)
+        if n % step == 0 and toggles:
+            state = not state
+            toggles -= 1
+            yield "admin", state
+            yield "tick", interval
+
+
+SCENARIOS = {
+    "full_table": full_table,
+    "converge": converge,
+    "spine_failure": spine_failure,
+    "leaf_drain": leaf_drain,
+    "link_flap_storm": link_flap_storm,
+    "rolling_maintenance": rolling_maintenance,
+    "admin_toggle": admin_toggle,
+}
+
+
+def generate(name, fabric = None, seed = 1, **params):
+    return SCENARIOS[name](fabric if fabric is not None else Fabric(), random.Random(seed), **params)
+
+
+class ScenarioClock:
+    # clock for ConsistentHash(clock = ...) that only moves on tick events
+
+    def __init__(self, start = 0.0):
+        self._now = start
+
+    def __call__(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+
+class DriveStats:
+    def __init__(self):
+        self.events = 0
+        self.added = 0
+        self.deleted = 0
+        self.admin = 0
+        self.ticks = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        return self.events / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return "".join(" {}: {}".format(a, b) for a, b in vars(self).items()) + " rate: {:.0f}/s".format(self.rate)
+
+
+def drive(ch: cs.ConsistentHash, events, batch_size = 1024, clock: ScenarioClock = None):
+    # feeds events to the engine, consecutive updates of one kind go in one
+    # add_routes/del_routes call. Ticks move `clock` and fire due timers.
+    stats = DriveStats()
+    pending = []
+    pending_kind = None
+
+    def flush():
+        if not pending:
+            return
+        if pending_kind == "add":
+            ch.add_routes(pending)
+            stats.added += len(pending)
+        else:
+            ch.del_routes(pending)
+            stats.deleted += len(pending)
+        stats.batches += 1
+        pending.clear()
+
+    t = time.perf_counter()
+    for kind, arg in events:
+        stats.events += 1
+
+        if kind == "add" or kind == "del":
+            if kind != pending_kind or len(pending) >= batch_size:
+                flush()
+                pending_kind = kind
+            pending.append(arg)
+            continue
+
+        flush()
+        if kind == "admin":
+            ch.set_admin_state(arg)
+            stats.admin += 1
+        elif kind == "tick":
+            stats.ticks += 1
+            if clock is not None:
+                clock.advance(arg)
+                ch._timers.run_due()
+        else:
+            raise ValueError("unknown event " + kind)
+
+    flush()
+    stats.seconds = time.perf_counter() - t
+    return stats
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "drive ConsistentHash with a fabric scenario")
+    parser.add_argument("scenario", choices = sorted(SCENARIOS))
+    parser.add_argument("--spines", type = int, default = 4)
+    parser.add_argument("--leaves", type = int, default = 32)
+    parser.add_argument("--prefixes", type = int, default = 1000, help = "prefixes per leaf")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--batch", type = int, default = 1024)
+    parser.add_argument("--memory", type = int, default = 1000)
+    parser.add_argument("--generate-only", action = "store_true", help = "only time the generator")
+    args = parser.parse_args(argv)
+
+    fabric = Fabric(args.spines, args.leaves, args.prefixes)
+    events = generate(args.scenario, fabric, args.seed)
+
+    if args.generate_only:
+        t = time.perf_counter()
+        n = sum(1 for _ in events)
+        dt = time.perf_counter() - t
+        print("events: {} seconds: {:.3f} rate: {:.0f}/s".format(n, dt, n / dt if dt else 0))
+        return 0
+
+    clock = ScenarioClock()
+    ch = cs.ConsistentHash(clock = clock)
+    ch.SdkObject._memory = args.memory
+    print(drive(ch, events, args.batch, clock))
+    print(ch)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
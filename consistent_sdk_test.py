@@ -0,0 +1,252 @@
+import os
+import random
+import threading
+import time
+
+import pytest
+
+import consistent as cs
+from consistent_scenario import ScenarioClock
+from consistent_testing import log, nexthops, prefix
+from sdk_driver import LocalSDKBackend, SDKDriver, SocketSDKBackend
+
+
+_NEXTHOPS = nexthops(6)
+_PREFIXES = [cs.Prefix.from_key((((10 << 24 | i << 8) << 8) | 24) << 1) for i in range(20)]
+
+
+def _random_series(ch: cs.ConsistentHash, clock: ScenarioClock, rnd: random.Random, steps = 300):
+    # single and batched updates over a small prefix and next hop pool, so
+    # groups are shared, merged, fail and resolve again
+    def route():
+        return cs.Route(rnd.choice(_PREFIXES), cs.NexthopSet.of(rnd.sample(_NEXTHOPS, rnd.randint(1, 4))))
+
+    def withdrawal():
+        return cs.Route(rnd.choice(_PREFIXES), cs.NexthopSet())
+
+    for _ in range(steps):
+        x = rnd.random()
+        if x < 0.05:
+            ch.set_admin_state(not ch._consistent_adm)
+        elif x < 0.15:
+            clock.advance(rnd.choice((0.5, 2.0, 5.0)))
+            ch._timers.run_due()
+        elif x < 0.3:
+            ch.add_routes([route() for _ in range(rnd.randint(1, 8))])
+        elif x < 0.35:
+            ch.del_routes([withdrawal() for _ in range(rnd.randint(1, 4))])
+        elif x < 0.45:
+            ch.del_route(withdrawal())
+        else:
+            ch.add_route(route())
+
+
+def _drift(ch: cs.ConsistentHash, driver: SDKDriver):
+    # what the driver holds that the engine does not expect. Routes of failed
+    # groups are left out, they keep whatever they were programmed with.
+    out = []
+    if ch.SdkObject.failed_batches:
+        out.append("failed batches: %d" % ch.SdkObject.failed_batches)
+
+    acs = {ac.sid: ac for ac in ch.ActualContainers}
+    for sid, ac in acs.items():
+        if driver.containers.get(sid) != cs.SDK._op(("create", ac))[1]:
+            out.append("container %d: %s" % (sid, driver.containers.get(sid)))
+    out.extend("stray container %d" % sid for sid in driver.containers if sid not in acs)
+
+    keys = set()
+    for r in ch.Routes:
+        keys.add(r.key)
+        dc = r.desired_container
+        if dc.current_state != cs.DesiredContainer.State.FAILED and driver.routes.get(r.key) != dc.actual_container.sid:
+            out.append("%s on %s instead of %d" % (r.prefix, driver.routes.get(r.key), dc.actual_container.sid))
+    out.extend("withdrawn %s still on %d" % (cs.Prefix.from_key(k), sid) for k, sid in driver.routes.items() if k not in keys)
+    return out
+
+
+class _TableCheck(LocalSDKBackend):
+    # member table as the batches leave it, counts creates and moves that
+    # write over the block of another container still in place
+
+    def __init__(self, allocator):
+        super().__init__()
+        self._allocator = allocator
+        self.blocks = {}
+        self.overlaps = {"create": 0, "move": 0}
+
+    def submit(self, ops):
+        for name, arg in ops:
+            if name == "create" and arg[2] is not None:
+                self._write(name, arg[0], arg[2], self._allocator.length(arg[2]))
+            elif name == "move":
+                self._write(name, arg[0], arg[1], self.blocks[arg[0]][1])
+            elif name == "delete":
+                self.blocks.pop(arg[0], None)
+        return super().submit(ops)
+
+    def _write(self, name, sid, off, n):
+        for other, (o, m) in self.blocks.items():
+            if other != sid and o < off + n and off < o + m:
+                self.overlaps[name] += 1
+        self.blocks[sid] = (off, n)
+
+
+def _run(seed, **options):
+    rnd = random.Random(seed)
+    clock = ScenarioClock()
+    backend = _TableCheck(options["allocator"]) if "allocator" in options else LocalSDKBackend()
+    ch = cs.ConsistentHash(clock = clock, sdk_backend = backend, seed = seed, **options)
+    if "allocator" not in options:
+        ch.SdkObject._memory = rnd.choice((6, 10, 20, 40))
+
+    _random_series(ch, clock, rnd)
+    return ch, _drift(ch, backend.driver), backend
+
+
+def test_driver_tables_follow_the_engine():
+    drifted = {}
+    for seed in range(200):
+        ch, drift, _ = _run(seed)
+        if drift:
+            drifted[seed] = drift[:3]
+    assert drifted == {}
+
+
+@pytest.mark.parametrize("allocator", [lambda: cs.BestFitAllocator(16), lambda: cs.BuddyAllocator(32)], ids = ["bestfit", "buddy"])
+def test_driver_tables_follow_the_engine_with_an_allocator(allocator):
+    drifted = {}
+    compactions = 0
+    overlaps = {"create": 0, "move": 0}
+    for seed in range(50):
+        ch, drift, backend = _run(seed, allocator = allocator())
+        if drift:
+            drifted[seed] = drift[:3]
+        compactions += ch.SdkObject.compactions
+        for name, n in backend.overlaps.items():
+            overlaps[name] += n
+    assert drifted == {}
+    assert compactions > 0
+    # make before break: a block is reused only once its delete was sent,
+    # and compaction moves never write over a block that has not moved yet
+    assert overlaps == {"create": 0, "move": 0}
+
+
+def _container(sdk: cs.SDK, nhs = ("10.0.0.1", "10.0.0.2")):
+    return sdk.SDKCreateContainer(cs.NexthopSet.of(nhs), False)
+
+
+def _programmed(sdk: cs.SDK, ac: cs.ActualContainer, net):
+    dc = cs.DesiredContainer(log)
+    dc.actual_container = ac
+    r = cs.Route(prefix(net), ac.nh_set.s)
+    r.desired_container = dc
+    sdk.SDKProgramRoute(r)
+    return r
+
+
+def test_cancelled_container_hands_its_routes_to_the_replacement():
+    backend = LocalSDKBackend()
+    sdk = cs.SDK(log, memory = 100, backend = backend)
+    old = _container(sdk)
+    on_old = _programmed(sdk, old, "10.1.0.0/24")
+
+    sdk.begin()
+    tmp = _container(sdk)
+    on_tmp = _programmed(sdk, tmp, "10.2.0.0/24")
+    sdk.SDKReplaceContainer(old, tmp)
+    new = _container(sdk)
+    sdk.SDKReplaceContainer(tmp, new)
+    sdk.SDKDeleteContainer(tmp)
+    sdk.commit()
+
+    assert set(backend.driver.containers) == {old.sid, new.sid}
+    assert backend.driver.routes == {on_old.key: new.sid, on_tmp.key: new.sid}
+
+
+def test_cancelled_container_without_a_successor_drops_its_programs():
+    backend = LocalSDKBackend()
+    sdk = cs.SDK(log, memory = 100, backend = backend)
+    old = _container(sdk)
+    r = _programmed(sdk, old, "10.1.0.0/24")
+
+    sdk.begin()
+    tmp = _container(sdk)
+    sdk.SDKReplaceContainer(old, tmp)
+    _programmed(sdk, tmp, "10.2.0.0/24")
+    sdk.SDKDeleteContainer(tmp)
+    sdk.commit()
+
+    assert backend.sent == 2
+    assert backend.driver.routes == {r.key: old.sid}
+    assert set(backend.driver.containers) == {old.sid}
+
+
+def test_deleted_block_is_kept_until_the_delete_is_sent():
+    alloc = cs.BestFitAllocator(4)
+    backend = _TableCheck(alloc)
+    sdk = cs.SDK(log, allocator = alloc, backend = backend)
+    old = _container(sdk)
+    block = old.block
+
+    sdk.begin()
+    sdk.SDKDeleteContainer(old)
+    assert _container(sdk, ("10.0.0.3", "10.0.0.4", "10.0.0.5")) is None
+    new = _container(sdk)
+    assert new.block != block
+    sdk.commit()
+
+    assert alloc.free == 2 and sdk.used == 2
+    assert _container(sdk).block == block
+    assert backend.overlaps == {"create": 0, "move": 0}
+
+
+@pytest.mark.parametrize("buckets", [3, 5, 16])
+def test_consistent_container_is_charged_its_bucket_table(buckets):
+    alloc = cs.BestFitAllocator(32)
+    sdk = cs.SDK(log, allocator = alloc, buckets = buckets)
+    ac = sdk.SDKCreateContainer(cs.NexthopSet.of(_NEXTHOPS[:2]), True)
+    assert len(ac.buckets) == buckets
+    assert sdk.charged(ac) == alloc.length(ac.block) == buckets
+    assert alloc.free == 32 - buckets
+
+    sdk.SDKDeleteContainer(ac)
+    assert alloc.free == 32 and sdk.used == 0
+
+    ch = cs.ConsistentHash(buckets = buckets)
+    assert ch.SdkObject._container_size(_NEXTHOPS[:2], True) == buckets
+
+
+def _connect(path, timeout = 5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return SocketSDKBackend(path, window = 4)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def test_pipelined_backend_reaches_the_same_tables(tmp_path):
+    path = str(tmp_path / "sdk.sock")
+    driver = SDKDriver(path, latency = 0.001)
+    threading.Thread(target = driver.serve_forever, daemon = True).start()
+    backend = _connect(path)
+
+    try:
+        rnd = random.Random(7)
+        clock = ScenarioClock()
+        ch = cs.ConsistentHash(clock = clock, sdk_backend = backend, seed = 7)
+        ch.SdkObject._memory = 20
+
+        _random_series(ch, clock, rnd)
+        ch.SdkObject.flush()
+
+        assert backend.errors == 0
+        assert backend.completed == backend.sent
+        assert _drift(ch, driver) == []
+    finally:
+        backend.close()
+        driver.close()
+        if os.path.exists(path):
+            os.unlink(path)
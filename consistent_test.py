@@ -3,7 +3,6 @@ import consistent as cs
 import time
 import logging
 import random
-import copy
 
 
 
@@ -91,61 +90,47 @@ def generate_full_route():
 
 def generate_fat_tree_converge():
 
-    test_dictionary = {}
+    # every prefix gets its next hops one by one in random order, prefixes
+    # are interleaved at random. Linear, see consistent_scenario for more.
 
-    print("prefixes {} nh={}".format(len(list(prefix_set)), len(list(next_hop_set))))
+    print("prefixes {} nh={}".format(len(prefix_set), len(next_hop_set)))
+
+    pending = []
 
     for prefix in prefix_set:
         p_list = []
 
-        p_nh = copy.copy(next_hop_set)
+        order = list(next_hop_set)
+        random.shuffle(order)
 
         p = cs.Prefix()
         p.set_prefix(prefix)
         s = set()
 
-        for i in range(len(next_hop_set)):
-            idx = random.randint(0, len(p_nh) - 1)
-            nh = list(p_nh)[idx]
-
+        for nh in order:
             s.add(nh)
-            p_nh.remove(nh)
-
             r = cs.Route(p, s)
             p_list.append(r)
 
-        test_dictionary[prefix] = p_list
-
-    
-#    print(", ".join("{}: [{}] ".format(str(a),", ".join(str(c) for c in b))  for a,b in test_dictionary.items()))
-
-    while True:
-
-        if len(test_dictionary.keys()) == 0:
-            break
-
-        idx = random.randint(0, len(test_dictionary.keys()) - 1 )
+        p_list.reverse()
+        pending.append(p_list)
 
-        key = list(test_dictionary.keys())[idx]
+    while pending:
 
-        l = test_dictionary[key]
-        
-        if len(l) == 0:
-            del test_dictionary[key]
-            continue
+        idx = random.randrange(len(pending))
 
-        r = l[0]
+        l = pending[idx]
 
-        test_route_list.append(r)
-        l.remove(r)
+        test_route_list.append(l.pop())
 
         if len(l) == 0:
-            del test_dictionary[key]
+            pending[idx] = pending[-1]
+            pending.pop()
 
-#    print(cs.pSet(test_route_list))
 
+def generate_run(routes, next_hops, seed = 1):
 
-def generate_run(routes, next_hops):
+    random.seed(seed)
 
     print("Generating data...\n")
     generate_data(routes, next_hops)
@@ -213,5 +198,6 @@ def small_test():
     ch.stop()
 
 
-#generate_run(200,5)   
-small_test()
\ No newline at end of file
+if __name__ == "__main__":
+    #generate_run(200,5)
+    small_test()
\ No newline at end of file
@@ -0,0 +1,22 @@
+import logging
+
+import consistent as cs
+
+
+# helpers shared by the consistent_*_test.py files
+
+log = logging.getLogger("c_hash").getChild("test")
+
+
+def nexthops(n):
+    return ["10.0.0.%d" % i for i in range(1, n + 1)]
+
+
+def prefix(net):
+    p = cs.Prefix()
+    p.set_prefix(net)
+    return p
+
+
+def route(net, nhs):
+    return cs.Route(prefix(net), cs.NexthopSet.of(nhs))
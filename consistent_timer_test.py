@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+import consistent as cs
+from consistent_scenario import ScenarioClock
+from consistent_testing import nexthops, route
+
+
+_NEXTHOPS = nexthops(4)
+
+
+class _Clock(ScenarioClock):
+    # a timer that keeps re-arming itself at a deadline already passed
+    # would spin in run_due, this fails the test instead of hanging it
+
+    def __init__(self, start = 0.0):
+        super().__init__(start)
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        if self.reads > 10000:
+            raise RuntimeError("clock read in a loop at %r" % self._now)
+        return self._now
+
+    def advance(self, seconds):
+        super().advance(seconds)
+        self.reads = 0
+
+
+def _step(ch: cs.ConsistentHash, clock: ScenarioClock, seconds):
+    clock.advance(seconds)
+    return ch._timers.run_due()
+
+
+def test_timers_fire_in_deadline_order():
+    clock = _Clock()
+    timers = cs.TimerEngine(clock)
+    fired = []
+    for deadline in (3.0, 1.0, 2.0, 1.0):
+        timers.schedule_at(deadline, fired.append, deadline)
+    timers.cancel(timers.schedule(1.5, fired.append, "cancelled"))
+    assert len(timers) == 4
+    assert timers.next_deadline() == 1.0
+
+    clock.advance(1.0)
+    assert timers.run_due() == 2
+    clock.advance(1.5)
+    assert timers.run_due() == 1
+    assert fired == [1.0, 1.0, 2.0]
+    assert timers.next_deadline() == 3.0
+
+
+def test_timer_thread_fires_and_stops():
+    timers = cs.TimerEngine()
+    done = threading.Event()
+    timers.start()
+    try:
+        timers.schedule(0.01, done.set)
+        assert done.wait(5.0)
+    finally:
+        timers.stop()
+    assert timers._thread is None
+
+
+def test_retry_backs_off_while_nothing_resolves():
+    clock = _Clock()
+    ch = cs.ConsistentHash(clock = clock)
+    ch.SdkObject._memory = 0
+    ch.set_admin_state(True)
+    ch.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+
+    deadlines = []
+    for _ in range(6):
+        deadlines.append(ch._timers.next_deadline())
+        clock.advance(deadlines[-1] - clock())
+        assert ch._timers.run_due() == 1
+    assert [b - a for a, b in zip(deadlines, deadlines[1:])] == [4, 8, 16, 16, 16]
+
+    # memory comes back, the next pass resolves and the interval resets
+    ch.SdkObject._memory = 100
+    _step(ch, clock, 16)
+    assert ch._system_resolved == cs.ConsistentHash.SystemResolved.RESOLVED
+    assert ch._retry_interval == ch._periodic_timer
+
+
+@pytest.mark.parametrize("start", [0.1, 0.3, 0.7, 1.1, 2.9])
+def test_stable_after_the_hold_down(start):
+    clock = _Clock()
+    ch = cs.ConsistentHash(clock = clock)
+    ch.SdkObject._memory = 100
+    _step(ch, clock, start)
+    ch.set_admin_state(True)
+    ch.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+
+    # resolved by the first retry pass
+    _step(ch, clock, ch._periodic_timer)
+    assert ch._system_resolved == cs.ConsistentHash.SystemResolved.RESOLVED
+    resolved = clock()
+
+    _step(ch, clock, ch._long_period_of_time - 0.05)
+    assert ch._system_stable == cs.ConsistentHash.SystemState.NON_STABLE
+
+    # the deadline is not a round number, the timer still fires exactly once
+    clock.advance(resolved + ch._long_period_of_time - clock())
+    assert ch._timers.run_due() == 1
+    assert ch._system_stable == cs.ConsistentHash.SystemState.STABLE
+    assert len(ch._timers) == 0
+
+
+def test_stable_at_once_without_consistent_hashing():
+    clock = _Clock()
+    ch = cs.ConsistentHash(clock = clock)
+    ch.SdkObject._memory = 100
+    ch.set_admin_state(True)
+    ch.add_route(route("172.16.0.0/24", _NEXTHOPS[:2]))
+    ch.set_admin_state(False)
+
+    _step(ch, clock, ch._periodic_timer)
+    assert ch._system_stable == cs.ConsistentHash.SystemState.STABLE
+    assert len(ch._timers) == 0
@@ -0,0 +1,145 @@
+import ipaddress
+import random
+
+import pytest
+
+import consistent as cs
+from consistent_testing import log, route
+
+
+def _key(net):
+    return cs.Prefix.make_key(ipaddress.ip_network(net))
+
+
+def _route(net):
+    return route(net, ["192.0.2.1"])
+
+
+def _longest(nets, addr):
+    addr = ipaddress.ip_address(addr)
+    best = None
+    for n in nets:
+        if n.version == addr.version and addr in n and (best is None or n.prefixlen > best.prefixlen):
+            best = n
+    return best
+
+
+def _random_nets(rnd, version, count):
+    width = 32 if version == 4 else 128
+    base = ipaddress.ip_network("10.0.0.0/8" if version == 4 else "2001:db8::/32")
+    nets = set()
+    while len(nets) < count:
+        plen = rnd.randint(base.prefixlen, min(width, base.prefixlen + 24))
+        addr = int(base.network_address) | rnd.getrandbits(width - base.prefixlen)
+        nets.add(ipaddress.ip_network((addr, plen), strict = False))
+    return sorted(nets, key = lambda n: (n.version, n))
+
+
+def test_lookup_returns_the_longest_match():
+    t = cs.PrefixTrie(32)
+    for net in ("0.0.0.0/0", "10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24", "10.1.2.128/25", "10.1.2.200/32"):
+        t.insert(_key(net))
+
+    def match(addr):
+        k = t.lookup(int(ipaddress.ip_address(addr)))
+        return None if k is None else str(cs.Prefix.from_key(k))
+
+    assert match("10.1.2.200") == "10.1.2.200/32"
+    assert match("10.1.2.201") == "10.1.2.128/25"
+    assert match("10.1.2.1") == "10.1.2.0/24"
+    assert match("10.1.3.1") == "10.1.0.0/16"
+    assert match("10.2.0.1") == "10.0.0.0/8"
+    assert match("11.0.0.1") == "0.0.0.0/0"
+    assert len(t) == 6
+
+
+def test_remove_splices_the_trie():
+    t = cs.PrefixTrie(32)
+    keys = [_key(n) for n in ("10.0.0.0/8", "10.1.0.0/16", "10.128.0.0/16", "10.1.2.0/24")]
+    for k in keys:
+        t.insert(k)
+    t.insert(keys[1])
+    assert len(t) == 4
+
+    assert t.remove(keys[0])
+    assert not t.remove(keys[0])
+    assert not t.remove(_key("10.2.0.0/16"))
+    assert t.lookup(int(ipaddress.ip_address("10.1.9.9"))) == keys[1]
+    assert t.lookup(int(ipaddress.ip_address("10.2.0.1"))) is None
+
+    for k in keys[1:]:
+        assert t.remove(k)
+    assert len(t) == 0
+    assert t._root.kids == [None, None]
+
+
+def test_covered_lists_the_prefixes_inside_a_supernet():
+    t = cs.PrefixTrie(32)
+    nets = ["10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24", "10.1.3.0/24", "10.2.0.0/16", "11.0.0.0/8"]
+    for n in nets:
+        t.insert(_key(n))
+
+    def covered(net):
+        return sorted(str(cs.Prefix.from_key(k)) for k in t.covered(_key(net)))
+
+    assert covered("10.1.0.0/16") == ["10.1.0.0/16", "10.1.2.0/24", "10.1.3.0/24"]
+    assert covered("10.1.0.0/23") == []
+    assert covered("10.1.2.0/23") == ["10.1.2.0/24", "10.1.3.0/24"]
+    assert covered("10.0.0.0/7") == sorted(nets)
+    assert covered("12.0.0.0/8") == []
+
+
+@pytest.mark.parametrize("compact", [False, True], ids = ["dict", "compact"])
+@pytest.mark.parametrize("version", [4, 6])
+def test_route_table_queries_match_a_linear_scan(compact, version):
+    rnd = random.Random(version)
+    nets = _random_nets(rnd, version, 300)
+    rc = cs.CompactRouteContainer(log) if compact else cs.RouteContainer(log)
+    for n in nets:
+        rc.add(_route(n))
+
+    # withdraw some after the index exists, so removal is covered too
+    rc.lookup(str(nets[0].network_address))
+    for n in rnd.sample(nets, 100):
+        rc.pop(_route(n).prefix)
+        nets.remove(n)
+
+    base = nets[0].supernet(new_prefix = 8 if version == 4 else 32)
+    for _ in range(300):
+        addr = ipaddress.ip_address(int(base.network_address) | rnd.getrandbits(base.max_prefixlen - base.prefixlen))
+        r = rc.lookup(str(addr))
+        want = _longest(nets, addr)
+        assert (None if r is None else str(r.prefix)) == (None if want is None else str(want))
+
+    for _ in range(50):
+        n = rnd.choice(nets)
+        sup = n.supernet(new_prefix = rnd.randint(base.prefixlen, n.prefixlen))
+        got = sorted(str(r.prefix) for r in rc.covered_by(str(sup)))
+        assert got == sorted(str(n) for n in nets if n.subnet_of(sup))
+
+
+def test_del_routes_in_withdraws_the_covered_routes():
+    ch = cs.ConsistentHash()
+    for net in ("10.1.0.0/16", "10.1.2.0/24", "10.1.3.0/24", "10.2.0.0/16", "2001:db8::/48"):
+        ch.add_route(_route(net))
+
+    assert ch.del_routes_in("10.1.0.0/16") == 3
+    assert sorted(str(p) for p in ch.Routes.prefixes()) == ["10.2.0.0/16", "2001:db8::/48"]
+    assert ch.Routes.lookup("10.1.2.1") is None
+    assert str(ch.Routes.lookup("2001:db8::1").prefix) == "2001:db8::/48"
+
+
+def test_del_routes_in_runs_one_pass_for_the_whole_withdrawal():
+    ch = cs.ConsistentHash()
+    ch.SdkObject._memory = 100
+    for i in range(20):
+        r = _route("10.1.%d.0/24" % i)
+        ch.add_route(cs.Route(r.prefix, cs.NexthopSet.of(["192.0.2.%d" % (i + 1)])))
+
+    # every withdrawal empties a group and asks for a pass, only the one at the end runs
+    batched = []
+    periodic = ch._periodic
+    ch._periodic = lambda lock = True: batched.append(ch._batch) or periodic(lock = lock)
+    assert ch.del_routes_in("10.1.0.0/16") == 20
+    assert batched == [True] * 20 + [False]
+    assert not ch._batch
@@ -0,0 +1,226 @@
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import zlib
+
+import consistent as cs
+
+
+class SharedMemoryAccountant(cs.MemoryAccountant):
+    # the budget lives in shared memory so engines in every worker process
+    # draw from the same pool
+
+    def __init__(self, value):
+        self._value = value
+
+    @property
+    def free(self):
+        return self._value.value
+
+    def reserve(self, size):
+        with self._value.get_lock():
+            if self._value.value < size:
+                return False
+            self._value.value -= size
+            return True
+
+    def release(self, size):
+        with self._value.get_lock():
+            self._value.value += size
+
+
+class TableStats:
+    def __init__(self, table, ch: cs.ConsistentHash):
+        self.table = table
+        self.routes = len(ch.Routes)
+        self.desired_containers = len(ch.DesiredContainers)
+        self.actual_containers = len(ch.ActualContainers)
+        self.memory_used = ch.SdkObject.used
+        self.resolved = ch._system_resolved == ch.SystemResolved.RESOLVED
+        self.stable = ch._system_stable == ch.SystemState.STABLE
+
+    def __str__(self):
+        return "".join(" {}: {}".format(a,b) for a,b in vars(self).items())
+
+
+def _encode(routes):
+    # prefix keys plus an index into the distinct next hop sets of the batch,
+    # much cheaper to pickle than Route objects
+    sets = {}
+    keys = []
+    idx = []
+    for r in routes:
+        keys.append(r.prefix.hashable)
+        idx.append(sets.setdefault(r.nh_set, len(sets)))
+    return keys, idx, [tuple(str(a) for a in s) for s in sets]
+
+
+def _decode(batch):
+    keys, idx, sets = batch
+    sets = [cs.NexthopSet.of(s) for s in sets]
+    return [cs.Route(cs.Prefix.from_key(k), sets[i]) for k, i in zip(keys, idx)]
+
+
+def _worker_main(conn, budget, engine_options):
+
+    accountant = SharedMemoryAccountant(budget)
+    engines = {}
+
+    def engine(table):
+        ch = engines.get(table)
+        if ch is None:
+            ch = cs.ConsistentHash(accountant = accountant, **engine_options)
+            ch.run()
+            engines[table] = ch
+        return ch
+
+    while True:
+        op, table, arg = conn.recv()
+
+        try:
+            if op == "add":
+                res = engine(table).add_routes(_decode(arg))
+            elif op == "del":
+                res = engine(table).del_routes(_decode(arg))
+            elif op == "del_in":
+                res = engine(table).del_routes_in(arg)
+            elif op == "admin":
+                res = engine(table).set_admin_state(arg)
+            elif op == "stats":
+                res = [TableStats(t, ch) for t, ch in engines.items() if table is None or t == table]
+            elif op == "stop":
+                for ch in engines.values():
+                    ch.stop()
+                conn.send((True, None))
+                return
+            else:
+                raise ValueError("unknown op " + op)
+        except Exception as e:
+            conn.send((False, e))
+        else:
+            conn.send((True, res))
+
+
+class _Worker:
+    def __init__(self, ctx, budget, engine_options):
+        self._conn, child = ctx.Pipe()
+        self._proc = ctx.Process(target = _worker_main, args = (child, budget, engine_options), daemon = True)
+        self._proc.start()
+        child.close()
+
+        self._pending = collections.deque()
+        self._send_lock = threading.Lock()
+        self._reader = threading.Thread(target = self._read, daemon = True)
+        self._reader.start()
+
+    def submit(self, op, table, arg):
+        fut = concurrent.futures.Future()
+        with self._send_lock:
+            self._pending.append(fut)
+            self._conn.send((op, table, arg))
+        return fut
+
+    def _read(self):
+        while True:
+            try:
+                ok, res = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            fut = self._pending.popleft()
+            if ok:
+                fut.set_result(res)
+            else:
+                fut.set_exception(res)
+
+        while self._pending:
+            self._pending.popleft().set_exception(RuntimeError("worker exited"))
+
+    def join(self):
+        self._proc.join()
+        self._reader.join()
+        self._conn.close()
+
+
+class MultiTableConsistentHash:
+
+    # one ConsistentHash per table (VRF), tables are spread over worker
+    # processes so independent tables converge in parallel. All engines
+    # allocate containers from one budget kept by a shared accountant.
+    # Calls return futures, updates for one table are applied in order.
+
+    def __init__(self, workers = None, memory = 7, **engine_options):
+        self._log = logging.getLogger("c_hash").getChild("vrf")
+        self._ctx = multiprocessing.get_context()
+        self._budget = self._ctx.Value("q", memory)
+        self._engine_options = engine_options
+        self._nworkers = workers if workers else os.cpu_count()
+        self._workers = []
+        self._tables = {}
+
+    def start(self):
+        if not self._workers:
+            self._workers = [_Worker(self._ctx, self._budget, self._engine_options) for _ in range(self._nworkers)]
+
+    def stop(self):
+        for w in self._workers:
+            w.submit("stop", None, None).result()
+        for w in self._workers:
+            w.join()
+        self._workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def memory(self):
+        return self._budget.value
+
+    @property
+    def tables(self):
+        return list(self._tables)
+
+    def _worker(self, table):
+        w = self._tables.get(table)
+        if w is None:
+            w = self._workers[zlib.crc32(repr(table).encode()) % len(self._workers)]
+            self._tables[table] = w
+        return w
+
+    def add_routes(self, table, routes):
+        return self._worker(table).submit("add", table, _encode(routes))
+
+    def del_routes(self, table, routes):
+        return self._worker(table).submit("del", table, _encode(routes))
+
+    def del_routes_in(self, table, supernet):
+        return self._worker(table).submit("del_in", table, supernet)
+
+    def set_admin_state(self, table, consistent_adm):
+        return self._worker(table).submit("admin", table, consistent_adm)
+
+    def add_route(self, table, route: cs.Route):
+        return self.add_routes(table, [route])
+
+    def del_route(self, table, route: cs.Route):
+        return self.del_routes(table, [route])
+
+    def apply(self, updates):
+        # {table: routes} -> {table: BatchResult}, all tables in flight at once
+        futures = {table: self.add_routes(table, routes) for table, routes in updates.items()}
+        return {table: f.result() for table, f in futures.items()}
+
+    def stats(self, table = None):
+        if table is not None:
+            return self._worker(table).submit("stats", table, None).result()
+
+        res = []
+        for f in [w.submit("stats", None, None) for w in self._workers]:
+            res.extend(f.result())
+        return res
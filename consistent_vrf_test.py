@@ -0,0 +1,72 @@
+import pytest
+
+from consistent_testing import nexthops, route
+from consistent_vrf import MultiTableConsistentHash
+
+
+_NEXTHOPS = nexthops(4)
+
+
+def _routes(n, nhs):
+    return [route("172.16.%d.0/24" % i, nhs) for i in range(n)]
+
+
+def test_every_table_gets_its_own_result():
+    with MultiTableConsistentHash(workers = 2, memory = 100) as vrf:
+        res = vrf.apply({"red": _routes(3, _NEXTHOPS[:2]), "blue": _routes(5, _NEXTHOPS[2:])})
+        assert {t: r.added for t, r in res.items()} == {"red": 3, "blue": 5}
+
+        # the same prefixes in another table are left alone
+        assert vrf.del_routes_in("red", "172.16.0.0/16").result() == 3
+        res = vrf.del_route("blue", route("172.16.9.0/24", [])).result()
+        assert (res.deleted, res.missing) == (0, 1)
+
+        stats = {s.table: s for s in vrf.stats()}
+        assert (stats["red"].routes, stats["blue"].routes) == (0, 5)
+        assert stats["red"].memory_used == 0
+        assert vrf.memory == 100 - stats["blue"].memory_used
+        assert sorted(vrf.tables) == ["blue", "red"]
+
+
+def test_tables_draw_from_one_budget():
+    with MultiTableConsistentHash(workers = 2, memory = 3) as vrf:
+        vrf.apply({"red": _routes(1, _NEXTHOPS[:2])})
+        # what red left is not enough, blue falls back to one next hop
+        vrf.apply({"blue": _routes(1, _NEXTHOPS[2:])})
+        stats = {s.table: s for s in vrf.stats()}
+        assert (stats["red"].memory_used, stats["blue"].memory_used) == (2, 1)
+        assert vrf.memory == 0
+
+
+def test_errors_come_back_through_the_future():
+    with MultiTableConsistentHash(workers = 1) as vrf:
+        with pytest.raises(ValueError):
+            vrf._worker("red").submit("rename", "red", None).result()
+        # the worker keeps serving after a failed call
+        assert vrf.add_route("red", route("172.16.0.0/24", _NEXTHOPS[:1])).result().added == 1
+
+
+def test_stop_shuts_the_workers_down():
+    vrf = MultiTableConsistentHash(workers = 2)
+    vrf.start()
+    workers = list(vrf._workers)
+    vrf.add_route("red", route("172.16.0.0/24", _NEXTHOPS[:1])).result()
+    vrf.stop()
+
+    assert vrf._workers == []
+    assert all(w._proc.exitcode == 0 and not w._reader.is_alive() for w in workers)
+    vrf.stop()
+
+
+def test_calls_fail_when_a_worker_dies():
+    vrf = MultiTableConsistentHash(workers = 1)
+    vrf.start()
+    w, = vrf._workers
+    try:
+        w._proc.kill()
+        w._proc.join()
+        with pytest.raises((RuntimeError, OSError)):
+            vrf.add_route("red", route("172.16.0.0/24", _NEXTHOPS[:1])).result(timeout = 5)
+    finally:
+        w._reader.join(5)
+        w._conn.close()
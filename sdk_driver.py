@@ -0,0 +1,337 @@
+import argparse
+import concurrent.futures
+import heapq
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+
+
+_HEADER = struct.Struct("!I")
+
+_DIGEST_MASK = (1 << 64) - 1
+
+
+def _send_frame(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise EOFError
+        buf += chunk
+    return buf
+
+
+def _recv_frame(sock):
+    n, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return pickle.loads(_recv_exact(sock, n))
+
+
+class SDKDriver:
+
+    # stand-in for the SDK driver process. Requests are batches of SDK
+    # operations, each is applied to a table model and answered `latency`
+    # seconds after it arrived (requests in flight overlap), plus
+    # `op_latency` seconds per operation of serialized service time.
+    # The tables outlive client connections, like the hardware outlives a
+    # restart of the engine.
+
+    def __init__(self, path, latency = 0.0, op_latency = 0.0):
+        self._log = logging.getLogger("c_hash").getChild("driver")
+        self._path = path
+        self._latency = latency
+        self._op_latency = op_latency
+
+        self.containers = {}
+        self.routes = {}
+        self.users = {}         # container -> keys of the routes programmed to it
+        self.requests = 0
+        self.ops = 0
+
+        self._server = None
+
+    def _program(self, key, sid):
+        old = self.routes.get(key)
+        if old is not None:
+            self.users[old].discard(key)
+        self.routes[key] = sid
+        self.users.setdefault(sid, set()).add(key)
+
+    def _digests(self):
+        # per container: route count and key sum, enough to tell whether a
+        # client's view of the routes matches without sending them all
+        return {sid: (len(keys), sum(keys) & _DIGEST_MASK) for sid, keys in self.users.items() if keys}
+
+    def _apply(self, ops):
+        result = None
+        for name, arg in ops:
+            if name == "create":
+                self.containers[arg[0]] = arg
+            elif name == "align":
+                if arg[0] not in self.containers:
+                    raise KeyError("align of unknown container %d" % arg[0])
+                self.containers[arg[0]] = arg
+            elif name == "move":
+                sid, block = arg
+                c = self.containers[sid]
+                self.containers[sid] = (sid, c[1], block) + c[3:]
+            elif name == "program":
+                if arg[1] not in self.containers:
+                    raise KeyError("route programmed to unknown container %d" % arg[1])
+                self._program(*arg)
+            elif name == "unprogram":
+                sid = self.routes.pop(arg[0], None)
+                if sid is not None:
+                    self.users[sid].discard(arg[0])
+            elif name == "replace":
+                # users of the first container move to the second
+                if arg[0] is not None:
+                    for key in list(self.users.get(arg[0], ())):
+                        self._program(key, arg[1])
+            elif name == "delete":
+                del self.containers[arg[0]]
+            elif name == "read":
+                result = (dict(self.containers), self._digests())
+            elif name == "read_routes":
+                result = {sid: set(self.users.get(sid, ())) for sid in arg}
+            else:
+                raise ValueError("unknown operation " + name)
+        return result
+
+    def serve_forever(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._path)
+        self._server.listen()
+
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                break
+            threading.Thread(target = self._serve, args = (conn,), daemon = True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def _serve(self, conn):
+        replies = []
+        cond = threading.Condition()
+        done = []
+
+        def respond():
+            while True:
+                with cond:
+                    while not replies and not done:
+                        cond.wait()
+                    if not replies:
+                        return
+                    due, seq, err, result = replies[0]
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        cond.wait(delay)
+                        continue
+                    heapq.heappop(replies)
+                try:
+                    _send_frame(conn, (seq, err, result))
+                except OSError:
+                    return
+
+        responder = threading.Thread(target = respond, daemon = True)
+        responder.start()
+
+        busy_until = 0.0
+        try:
+            while True:
+                seq, ops = _recv_frame(conn)
+                now = time.monotonic()
+
+                err = None
+                result = None
+                try:
+                    result = self._apply(ops)
+                except Exception as e:
+                    err = "{}: {}".format(type(e).__name__, e)
+                    self._log.warning("request %d failed: %s", seq, err)
+
+                self.requests += 1
+                self.ops += len(ops)
+
+                busy_until = max(now, busy_until) + len(ops) * self._op_latency
+                with cond:
+                    heapq.heappush(replies, (busy_until + self._latency, seq, err, result))
+                    cond.notify()
+        except (EOFError, OSError):
+            pass
+        finally:
+            with cond:
+                done.append(True)
+                cond.notify()
+            responder.join()
+            conn.close()
+
+
+def _driver_main(path, latency, op_latency):
+    SDKDriver(path, latency, op_latency).serve_forever()
+
+
+def start_driver(path, latency = 0.0, op_latency = 0.0, timeout = 5.0):
+    # run the driver in its own process, returns once it accepts connections
+    if os.path.exists(path):
+        os.unlink(path)
+    proc = multiprocessing.Process(target = _driver_main, args = (path, latency, op_latency), daemon = True)
+    proc.start()
+
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline or not proc.is_alive():
+            proc.terminate()
+            raise RuntimeError("sdk driver did not start on " + path)
+        time.sleep(0.01)
+    return proc
+
+
+class SocketSDKBackend:
+
+    # sends SDK batches to the driver without waiting for the answer, at most
+    # `window` requests are in flight, submit() blocks while the window is
+    # full. Every request completes a future, reads complete it with the data.
+
+    def __init__(self, path, window = 32):
+        self._log = logging.getLogger("c_hash").getChild("sdk_backend")
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+
+        self._window = threading.BoundedSemaphore(window)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._seq = 0
+
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+
+        self._reader = threading.Thread(target = self._read, daemon = True)
+        self._reader.start()
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def submit(self, ops):
+        self._window.acquire()
+        fut = concurrent.futures.Future()
+        with self._lock:
+            self._seq += 1
+            self._pending[self._seq] = fut
+            try:
+                _send_frame(self._sock, (self._seq, ops))
+            except OSError as e:
+                del self._pending[self._seq]
+                self._window.release()
+                fut.set_exception(e)
+                return fut
+            self.sent += 1
+        return fut
+
+    def _read(self):
+        while True:
+            try:
+                seq, err, result = _recv_frame(self._sock)
+            except (EOFError, OSError):
+                break
+
+            with self._lock:
+                fut = self._pending.pop(seq)
+            self._window.release()
+            self.completed += 1
+
+            if err is None:
+                fut.set_result(result)
+            else:
+                self.errors += 1
+                fut.set_exception(RuntimeError(err))
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            fut.set_exception(EOFError("sdk driver closed the connection"))
+
+    def read(self):
+        # future of ({sid: container table}, {sid: (route count, key sum)})
+        return self.submit([("read", None)])
+
+    def read_routes(self, sids):
+        # future of {sid: keys of the routes programmed to it}
+        return self.submit([("read_routes", list(sids))])
+
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending.values())
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        self.flush()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._reader.join()
+
+
+class LocalSDKBackend:
+
+    # the driver table model in process: every batch is applied when it is
+    # submitted and the tables can be read straight from .driver. For tests
+    # and runs that do not need the socket.
+
+    def __init__(self, driver: SDKDriver = None):
+        self.driver = driver if driver is not None else SDKDriver(None)
+        self.sent = 0
+        self.errors = 0
+
+    def submit(self, ops):
+        self.sent += 1
+        fut = concurrent.futures.Future()
+        try:
+            fut.set_result(self.driver._apply(ops))
+        except Exception as e:
+            self.errors += 1
+            fut.set_exception(e)
+        return fut
+
+    def read(self):
+        return self.submit([("read", None)])
+
+    def read_routes(self, sids):
+        return self.submit([("read_routes", list(sids))])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "stand-in SDK driver")
+    parser.add_argument("path", help = "unix socket path")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "round trip latency per request, seconds")
+    parser.add_argument("--op-latency", type = float, default = 0.0, help = "service time per operation, seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    SDKDriver(args.path, args.latency, args.op_latency).serve_forever()